@@ -0,0 +1,402 @@
+#!/usr/bin/env python3
+"""
+Async Bridge - The MQTT/RF bridge on one asyncio event loop
+
+Runs the same bridge as lamp_control_mqtt.py, but instead of paho's network
+thread, TX worker threads and timer threads, everything that touches lamp
+state is a coroutine or callback on one event loop:
+
+- MQTT I/O is driven from the loop through paho's socket callbacks, and a
+  dropped connection is retried with paho's backoff until the broker is back
+- Received frames are handed to the loop as they are decoded
+- The TX scheduler is a coroutine per transmitter, draining the same
+  CommandQueue the threaded TxWorker uses
+- State batching, held-button and state-saving timers are loop timers
+
+Only blocking radio work runs on executor threads: transmitting one code,
+and waiting for the receiver. Lamp state is only changed on the loop, in the
+order events arrived, and the pause after each frame is an asyncio sleep
+rather than a blocked thread.
+
+Takes the same options as lamp_control_mqtt.py, except -c, --cluster and
+--rx-mode poll.
+
+Usage:
+    python3 async_bridge.py [lamp_control_mqtt.py options]
+"""
+
+import asyncio
+import logging
+import signal
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import lamp_control_mqtt as lcm
+
+
+class MqttSocket:
+    """Drives a paho client from the event loop, in place of loop_start().
+
+    paho reports when its socket opens, closes and has data waiting to be
+    written; the socket is registered with the loop so loop_read and
+    loop_write run on it, and loop_misc (keepalives, retries) is a coroutine.
+    An unexpected disconnect starts a coroutine that reconnects with paho's
+    backoff, as loop_start() would, until the broker is back.
+    """
+
+    MISC_INTERVAL = 1  # Seconds between loop_misc calls
+    FLUSH_TIMEOUT = 2  # Seconds to spend writing out queued messages on shutdown
+    RECONNECT_MIN_DELAY = 1  # paho's reconnect_delay_set() defaults (seconds)
+    RECONNECT_MAX_DELAY = 120
+
+    def __init__(self, client, loop, min_delay=RECONNECT_MIN_DELAY, max_delay=RECONNECT_MAX_DELAY):
+        self.client = client
+        self.loop = loop
+        self.misc = None
+        self.reconnecting = None
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        client.reconnect_delay_set(min_delay, max_delay)
+        client.on_socket_open = self.on_socket_open
+        client.on_socket_close = self.on_socket_close
+        client.on_socket_register_write = self.on_socket_register_write
+        client.on_socket_unregister_write = self.on_socket_unregister_write
+        client.on_disconnect = self.on_disconnect
+
+    def on_socket_open(self, client, userdata, sock):
+        self.loop.add_reader(sock, client.loop_read)
+        self.misc = self.loop.create_task(self.loop_misc())
+
+    def on_socket_close(self, client, userdata, sock):
+        self.loop.remove_reader(sock)
+        if self.misc is not None:
+            self.misc.cancel()
+            self.misc = None
+
+    def on_socket_register_write(self, client, userdata, sock):
+        self.loop.add_writer(sock, client.loop_write)
+
+    def on_socket_unregister_write(self, client, userdata, sock):
+        self.loop.remove_writer(sock)
+
+    async def loop_misc(self):
+        while self.client.loop_misc() == lcm.mqtt.MQTT_ERR_SUCCESS:
+            await asyncio.sleep(self.MISC_INTERVAL)
+
+    def on_disconnect(self, client, userdata, rc):
+        if rc == 0:
+            logging.info("Clean disconnect.")
+            return
+        logging.warning("Unexpected disconnect (rc=%s). Reconnecting...", rc)
+        if self.reconnecting is None or self.reconnecting.done():
+            self.reconnecting = self.loop.create_task(self.reconnect())
+
+    async def reconnect(self):
+        """Retry reconnect(), doubling the delay from min_delay up to max_delay."""
+        delay = self.min_delay
+        while True:
+            try:
+                self.client.reconnect()
+                logging.info("Reconnected.")
+                return
+            except Exception as e:
+                logging.error("Reconnection failed: %s; retrying in %ss", e, delay)
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, self.max_delay)
+
+    async def flush(self, timeout=FLUSH_TIMEOUT):
+        """Write out everything paho has queued, such as the last state and DISCONNECT."""
+        deadline = self.loop.time() + timeout
+        while self.client.want_write() and self.loop.time() < deadline:
+            if self.client.loop_write() != lcm.mqtt.MQTT_ERR_SUCCESS:
+                break
+            await asyncio.sleep(0)
+
+    def stop(self):
+        for task in (self.misc, self.reconnecting):
+            if task is not None:
+                task.cancel()
+
+
+class LoopStatePublisher(lcm.StatePublisher):
+    """StatePublisher whose batching window is a loop timer."""
+
+    def __init__(self, client, window, loop):
+        super().__init__(client, window)
+        self.loop = loop
+
+    def _schedule(self, delay, callback):
+        return self.loop.call_later(delay, callback)
+
+
+class LoopBurstAggregator(lcm.BurstAggregator):
+    """BurstAggregator whose release timers are loop timers."""
+
+    def __init__(self, loop, gap=lcm.MIN_GAP / 1000000, update_interval=0):
+        super().__init__(gap, update_interval)
+        self.loop = loop
+
+    def _schedule(self, burst, delay):
+        burst.timer = self.loop.call_later(delay, self._expire, burst)
+
+
+class LoopLampStateStore(lcm.LampStateStore):
+    """LampStateStore whose save delay is a loop timer."""
+
+    def __init__(self, path, loop, delay=lcm.STATE_SAVE_DELAY):
+        super().__init__(path, delay)
+        self.loop = loop
+
+    def _schedule(self, delay, callback):
+        return self.loop.call_later(delay, callback)
+
+
+class LoopCommandQueue(lcm.CommandQueue):
+    """CommandQueue that wakes the coroutine draining it."""
+
+    def __init__(self):
+        super().__init__()
+        self.ready = asyncio.Event()
+        self.idle = asyncio.Event()
+        self.idle.set()
+
+    def submit(self, lamp, command_type, payload, trace=None):
+        super().submit(lamp, command_type, payload, trace)
+        self.idle.clear()
+        self.ready.set()
+
+
+def command_steps(lamp, command_type, payload):
+    """A command other than brightness, as a generator like brightness_steps."""
+    yield
+    if command_type == 'reset':
+        lamp.reset_lamp()
+    elif command_type == 'on_off':
+        lamp.on_off(payload, True)
+    elif command_type == 'cct':
+        lamp.cct(True)
+
+
+class AsyncTxScheduler:
+    """A coroutine per transmitter draining its CommandQueue, like TxPool's threads.
+
+    Each step of a command runs on the loop with send_rf captured, so the
+    lamp's state changes there; the codes it would have sent are then
+    transmitted on the executor, one at a time with RF_DELAY between them.
+    """
+
+    def __init__(self, loop, executor):
+        self.loop = loop
+        self.executor = executor
+        # gpio -> LoopCommandQueue
+        self.queues = {}
+        self.tasks = []
+
+    def queue(self, lamp_id):
+        gpio = lcm.tx_pins(lamp_id)[0]
+        queue = self.queues.get(gpio)
+        if queue is None:
+            queue = self.queues[gpio] = LoopCommandQueue()
+            self.tasks.append(self.loop.create_task(self.drain(queue)))
+        return queue
+
+    def start(self):
+        for info in lcm.registry:
+            self.queue(info.lamp_id)
+
+    def submit(self, lamp, command_type, payload, trace=None):
+        self.queue(lamp.lamp_id).submit(lamp, command_type, payload, trace)
+
+    @property
+    def coalesced(self):
+        return sum(queue.coalesced for queue in self.queues.values())
+
+    async def wait_idle(self):
+        """Wait until everything queued has been sent."""
+        for queue in list(self.queues.values()):
+            await queue.idle.wait()
+
+    def stop(self, timeout=None):
+        for task in self.tasks:
+            task.cancel()
+
+    async def drain(self, queue):
+        while True:
+            if not queue.pending:
+                queue.busy = False
+                queue.idle.set()
+                queue.ready.clear()
+                await queue.ready.wait()
+                continue
+            queue.busy = True
+            lamp, commands, traces = queue.take()
+            for command_type in lcm.COMMAND_ORDER:
+                if command_type in commands:
+                    await self.execute(queue, lamp, command_type, commands[command_type],
+                                       traces[command_type])
+
+    async def execute(self, queue, lamp, command_type, payload, trace=None):
+        try:
+            if command_type == 'cct':
+                for i in range(payload):
+                    await self.run_command(lamp, command_type, None,
+                                           trace=trace if i == payload - 1 else None)
+            elif not await self.run_command(lamp, command_type, payload,
+                                            lambda: queue.preempted(lamp), trace):
+                queue.requeue(lamp, payload, trace)
+        except Exception as e:
+            logging.error("%s for %s failed: %s", command_type, lamp.lamp_id, e)
+
+    async def run_command(self, lamp, command_type, payload, preempt=None, trace=None):
+        """lamp_control_mqtt.run_command for the loop.
+
+        Returns:
+            False if a brightness change was interrupted by preempt, else True
+        """
+        if trace is not None and trace.started is None:
+            trace.started = time.monotonic()
+        if command_type == 'brightness':
+            steps = lamp.brightness_steps(int(payload))
+        else:
+            steps = command_steps(lamp, command_type, payload)
+        while True:
+            codes, done = self.step(steps, trace)
+            await self.send(codes, trace)
+            if done:
+                break
+            if preempt is not None and preempt():
+                steps.close()
+                logging.debug("Brightness change to %s interrupted at %s", payload, lamp.brightness)
+                return False
+        if trace is not None:
+            trace.done = time.monotonic()
+            lcm.latency_stats.record(trace)
+        return True
+
+    def step(self, steps, trace):
+        """Advance a command by one step on the loop.
+
+        Returns:
+            (codes it sent, True if the command is finished)
+        """
+        lcm.tx_capture.codes = codes = []
+        lcm.trace_context.trace = trace
+        try:
+            next(steps)
+            return codes, False
+        except StopIteration:
+            return codes, True
+        finally:
+            lcm.tx_capture.codes = None
+            lcm.trace_context.trace = None
+
+    async def send(self, codes, trace=None):
+        for code in codes:
+            start = time.monotonic()
+            await self.loop.run_in_executor(self.executor, lcm.transmit, code)
+            if trace is not None:
+                trace.tx.append((start, time.monotonic()))
+            await asyncio.sleep(lcm.RF_DELAY)
+
+
+class AsyncBridge:
+    """Delivers received frames to the handler on the loop until stopped."""
+
+    def __init__(self, loop, receiver, handler=lcm.handle_rx):
+        self.loop = loop
+        self.receiver = receiver
+        self.handler = handler
+        self.stopping = asyncio.Event()
+        # Waiting for the receiver blocks, so it gets a thread of its own
+        self.rx_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="rf-rx")
+
+    async def receive(self):
+        timestamp = None
+        while True:
+            frame = await self.loop.run_in_executor(self.rx_executor, self.receiver.get)
+            if frame is None:
+                return
+            lcm.journal_frame(frame)
+            if lcm.own_frame(frame.code):
+                continue
+            gap = lcm.rx_gap(frame.timestamp, timestamp)
+            timestamp = frame.timestamp
+            self.handler(frame.code, timestamp, gap)
+
+    async def run(self):
+        rx = self.loop.create_task(self.receive())
+        await self.stopping.wait()
+        self.receiver.close()
+        await rx
+        self.rx_executor.shutdown()
+
+    def stop(self):
+        logging.info("Shutting down.")
+        self.stopping.set()
+
+
+async def shutdown(client, mqtt_socket, rxdevice, receiver):
+    """lamp_control_mqtt.shutdown on the loop.
+
+    The last retained state and the DISCONNECT are only queued by paho; the
+    loop has to be running for them to be written to the socket.
+    """
+    lcm.tx_worker.stop()
+    await asyncio.gather(*lcm.tx_worker.tasks, return_exceptions=True)
+    lcm.shutdown(client, rxdevice, receiver)
+    await mqtt_socket.flush()
+    mqtt_socket.stop()
+
+
+def main():
+    args = lcm.init()
+    if args.code or args.cluster or args.rx_mode == 'poll':
+        sys.exit("The asyncio engine doesn't support -c, --cluster or --rx-mode poll; "
+                 "use lamp_control_mqtt.py")
+    lcm.setup_bridge()
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+
+    client = lcm.mqtt.Client("homebridge_mqtt_rfclient")
+    mqtt_socket = MqttSocket(client, loop)
+    client.on_connect = lcm.on_connect
+    client.on_message = lcm.TopicRouter(lcm.registry)
+    lcm.state_publisher = LoopStatePublisher(client, args.publish_window, loop)
+
+    rxdevice, receiver = lcm.open_receiver()
+    lcm.open_journal()
+    if args.verify_tx:
+        # Transmissions wait on an executor thread; the loop hands them what it hears
+        lcm.tx_verifier = lcm.TxVerifier(args.verify_window / 1000, args.verify_retries)
+    if args.echo_window:
+        lcm.echo_filter = lcm.EchoFilter(args.echo_window * 1000)
+    # A thread per transmitter, so lamps on different radios are sent in parallel
+    radios = {lcm.tx_pins(info.lamp_id)[0] for info in lcm.registry}
+    tx_executor = ThreadPoolExecutor(max_workers=max(1, len(radios)), thread_name_prefix="rf-tx")
+    lcm.tx_worker = AsyncTxScheduler(loop, tx_executor)
+    lcm.tx_worker.start()
+    lcm.burst_aggregator = LoopBurstAggregator(loop, update_interval=args.burst_updates)
+
+    bridge = AsyncBridge(loop, receiver)
+    loop.add_signal_handler(signal.SIGTERM, bridge.stop)
+    loop.add_signal_handler(signal.SIGINT, bridge.stop)
+    if args.stats_file:
+        loop.add_signal_handler(signal.SIGUSR1, lcm.latency_stats.dump, args.stats_file)
+
+    if args.state_file:
+        lcm.warm_start(client, LoopLampStateStore(args.state_file, loop))
+
+    logging.info("Waiting for mqtt messages (asyncio engine).")
+    try:
+        client.connect("localhost")
+        lcm.log_startup()
+        loop.run_until_complete(bridge.run())
+    finally:
+        loop.run_until_complete(shutdown(client, mqtt_socket, rxdevice, receiver))
+        tx_executor.shutdown()
+        loop.close()
+
+
+if __name__ == "__main__":
+    main()
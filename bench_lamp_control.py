@@ -0,0 +1,416 @@
+#!/usr/bin/env python3
+"""
+Microbenchmarks for the lamp_control_mqtt hot paths
+
+Runs on any Linux box: the GPIO, rpi_rf and paho modules are replaced by
+small fakes, so nothing touches hardware or a broker. Startup is measured
+in a fresh interpreter, as systemd would start the bridge. Results can be
+saved as JSON and compared against an earlier run.
+
+Usage:
+    python3 bench_lamp_control.py [-o results.json] [-b baseline.json] [--quick]
+"""
+
+import argparse
+import json
+import logging
+import os
+import platform
+import subprocess
+import sys
+import threading
+import time
+import types
+from datetime import datetime
+
+
+class FakeGPIO(types.ModuleType):
+    """RPi.GPIO with every call a no-op."""
+
+    BCM = 11
+    IN = 1
+    OUT = 0
+    BOTH = 33
+
+    def __init__(self):
+        super().__init__('RPi.GPIO')
+
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: None
+
+
+class FakeRFDevice:
+    """rpi_rf.RFDevice that counts transmitted codes instead of sending them."""
+
+    def __init__(self, gpio, tx_repeat=10, **kwargs):
+        self.gpio = gpio
+        self.tx_repeat = tx_repeat
+        self.sent = 0
+        self.rx_code = None
+        self.rx_code_timestamp = None
+        self.rx_pulselength = None
+        self.rx_proto = None
+        self.next_code = None
+
+    def enable_tx(self):
+        return True
+
+    def disable_tx(self):
+        return True
+
+    def enable_rx(self):
+        return True
+
+    def disable_rx(self):
+        return True
+
+    def tx_code(self, code, tx_proto=None, tx_pulselength=None, tx_length=None):
+        self.sent += 1
+        return True
+
+    def rx_callback(self, gpio):
+        if self.next_code is not None:
+            self.rx_code = self.next_code
+            self.rx_code_timestamp = int(time.perf_counter() * 1000000)
+            self.rx_pulselength = 350
+            self.rx_proto = 1
+            self.next_code = None
+
+    def emit(self, code):
+        """Decode code, as the last edge of a frame would."""
+        self.next_code = code
+        self.rx_callback(self.gpio)
+
+    def cleanup(self):
+        pass
+
+
+class FakeClient:
+    """paho Client that counts publishes."""
+
+    def __init__(self, *args, **kwargs):
+        self.published = 0
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        self.published += 1
+
+    def message_callback_add(self, sub, callback):
+        pass
+
+    def subscribe(self, topic, qos=0):
+        pass
+
+
+class FakeMessage:
+    """paho MQTTMessage."""
+
+    def __init__(self, topic, payload):
+        self.topic = topic
+        self.payload = payload.encode("utf-8")
+
+
+def install_fakes():
+    """Register the fake hardware and MQTT modules, unless real ones are loaded."""
+    rpi = types.ModuleType('RPi')
+    rpi.GPIO = FakeGPIO()
+    rpi_rf = types.ModuleType('rpi_rf')
+    rpi_rf.RFDevice = FakeRFDevice
+    paho = types.ModuleType('paho')
+    paho_mqtt = types.ModuleType('paho.mqtt')
+    paho_client = types.ModuleType('paho.mqtt.client')
+    paho_client.Client = FakeClient
+    paho.mqtt = paho_mqtt
+    paho_mqtt.client = paho_client
+    for name, module in (('RPi', rpi), ('RPi.GPIO', rpi.GPIO), ('rpi_rf', rpi_rf),
+                         ('paho', paho), ('paho.mqtt', paho_mqtt),
+                         ('paho.mqtt.client', paho_client)):
+        sys.modules.setdefault(name, module)
+
+
+def import_bridge():
+    install_fakes()
+    import lamp_control_mqtt as lcm
+    return lcm
+
+
+def best_time(func, repeat):
+    """Best wall time of repeat calls to func, in seconds."""
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def make_registry(lcm, count):
+    return lcm.LampRegistry((1000000 + 10 * i, f"LAMP_{i}") for i in range(count))
+
+
+def bench_rx(lcm, n, repeat):
+    """decode_rx and handle_rx throughput over codes for 4 lamps."""
+    client = FakeClient()
+    lcm.registry = lcm.LampRegistry(lcm.LAMPS2NAMES.items())
+    lcm.lamps.clear()
+    for info in lcm.registry:
+        lcm.find_or_create_lamp(lcm.lamps, info.lamp_id, client)
+    codes = list(lcm.registry.codes)
+    frames = (codes * (n // len(codes) + 1))[:n]
+
+    def decode():
+        for code in frames:
+            lcm.decode_rx(code, 0)
+
+    def handle():
+        for i, code in enumerate(frames):
+            lcm.handle_rx(code, i, lcm.MIN_GAP + 1)
+
+    return {
+        'decode_rx_fps': {'value': n / best_time(decode, repeat), 'unit': 'frames/s'},
+        'handle_rx_fps': {'value': n / best_time(handle, repeat), 'unit': 'frames/s'},
+    }
+
+
+def rx_thread_cpu(loop, device, codes, interval):
+    """CPU seconds used by loop on its own thread while device decodes codes."""
+    result = {}
+
+    def body():
+        start = time.thread_time()
+        loop()
+        result['cpu'] = time.thread_time() - start
+
+    thread = threading.Thread(target=body)
+    thread.start()
+    for code in codes:
+        time.sleep(interval)
+        device.emit(code)
+    time.sleep(interval)
+    return thread, result
+
+
+def bench_rx_modes(lcm, count, interval):
+    """CPU used by the polling and event-driven RX loops for the same frames."""
+    codes = (list(lcm.registry.codes) * (count // len(lcm.registry.codes) + 1))[:count]
+
+    def handler(code, timestamp, gap):
+        pass
+
+    device = FakeRFDevice(23)
+    stop = threading.Event()
+    thread, poll = rx_thread_cpu(lambda: lcm.poll_rx(device, handler, stop),
+                                 device, codes, interval)
+    stop.set()
+    thread.join()
+
+    device = FakeRFDevice(23)
+    receiver = lcm.RFReceiver(device)
+    thread, event = rx_thread_cpu(lambda: lcm.wait_rx(receiver, handler),
+                                  device, codes, interval)
+    receiver.close()
+    thread.join()
+    return {
+        'rx_poll_cpu_ms': {'value': poll['cpu'] * 1000, 'unit': 'ms'},
+        'rx_event_cpu_ms': {'value': event['cpu'] * 1000, 'unit': 'ms'},
+    }
+
+
+def bench_planner(lcm, repeat):
+    """Brightness planning cost and planned frames over every start/target pair."""
+    pairs = [(start, on, target)
+             for start in range(1, lcm.HK_BR_MAX + 1, 3)
+             for on in (True, False)
+             for target in range(1, lcm.HK_BR_MAX + 1, 3)]
+
+    def plan():
+        for start, on, target in pairs:
+            lcm.plan_brightness(start, on, target)
+
+    # Plain stepping only applies to a lamp that is on
+    lit = [(start, target) for start, on, target in pairs if on]
+    planned = 0
+    stepped = 0
+    for start, target in lit:
+        planned += len(lcm.plan_brightness(start, True, target).commands)
+        commands, _ = lcm.step_commands(start, target)
+        commands, _ = lcm.pad_boundary(commands, 0, target, True)
+        stepped += len(commands)
+    return {
+        'plan_brightness_us': {'value': best_time(plan, repeat) / len(pairs) * 1e6,
+                               'unit': 'us/plan'},
+        'planned_frames_mean': {'value': planned / len(lit), 'unit': 'frames'},
+        'stepped_frames_mean': {'value': stepped / len(lit), 'unit': 'frames'},
+    }
+
+
+def bench_dispatch(lcm, n, repeat):
+    """MQTT dispatch through TopicRouter into the TX queue, by lamp count."""
+    results = {}
+    for count in (4, 400):
+        lcm.registry = make_registry(lcm, count)
+        lcm.lamps.clear()
+        router = lcm.TopicRouter(lcm.registry)
+        worker = lcm.TxWorker()
+        lcm.tx_worker = worker
+        messages = [FakeMessage(f"{lcm.BASE_TOPIC}{info.lamp_id}/setBrightness", "50")
+                    for info in lcm.registry]
+        batch = (messages * (n // len(messages) + 1))[:n]
+        client = FakeClient()
+
+        def dispatch():
+            for message in batch:
+                router(client, None, message)
+            worker.pending.clear()
+            worker.traces.clear()
+
+        results[f'dispatch_{count}_lamps_us'] = {
+            'value': best_time(dispatch, repeat) / n * 1e6, 'unit': 'us/message'}
+    lcm.tx_worker = None
+    return results
+
+
+def bench_find_lamp(lcm, n, repeat):
+    """find_or_create_lamp lookups with large lamp counts."""
+    results = {}
+    client = FakeClient()
+    for count in (10, 1000, 10000):
+        lcm.registry = make_registry(lcm, count)
+        lcm.lamps.clear()
+        ids = [info.lamp_id for info in lcm.registry]
+        for lamp_id in ids:
+            lcm.find_or_create_lamp(lcm.lamps, lamp_id, client)
+        batch = (ids * (n // len(ids) + 1))[:n]
+
+        def find():
+            for lamp_id in batch:
+                lcm.find_or_create_lamp(lcm.lamps, lamp_id, client)
+
+        results[f'find_lamp_{count}_us'] = {
+            'value': best_time(find, repeat) / n * 1e6, 'unit': 'us/lookup'}
+    return results
+
+
+def bench_virtual_radio(lcm, count, changes, loss=0.05):
+    """Brightness changes for many lamps on a lossy virtual radio.
+
+    Runs on a simulated clock, so it measures the bridge's CPU cost per
+    frame and how many simulated lamps still match the bridge afterwards.
+    """
+    vr = lcm.virtual_radio
+    medium = vr.RadioMedium(loss=loss, clock=vr.SimClock(), seed=1)
+    lcm.registry = make_registry(lcm, count)
+    lcm.lamps.clear()
+    client = FakeClient()
+    simulated = {info.lamp_id: vr.SimulatedLamp(info.lamp_id, medium) for info in lcm.registry}
+    saved = lcm.radio_medium, lcm.transmitter, lcm.state_publisher, lcm.sleep
+    lcm.radio_medium, lcm.transmitter, lcm.state_publisher = medium, None, None
+    lcm.sleep = lambda seconds: medium.clock.advance(seconds * 1e6)
+    try:
+        bridge = [lcm.find_or_create_lamp(lcm.lamps, lamp_id, client) for lamp_id in simulated]
+        for lamp in bridge:
+            lamp.reset_lamp()
+        start = time.perf_counter()
+        for i in range(changes):
+            bridge[i % count].set_brightness_level((i * 37) % 100 + 1)
+        elapsed = time.perf_counter() - start
+    finally:
+        lcm.radio_medium, lcm.transmitter, lcm.state_publisher, lcm.sleep = saved
+    converged = sum(1 for lamp in bridge
+                    if simulated[lamp.lamp_id].on == lamp.on
+                    and abs(simulated[lamp.lamp_id].brightness - lamp.brightness) <= lcm.BR_INCREMENT)
+    return {
+        'virtual_tx_frames_per_s': {'value': medium.sent / elapsed, 'unit': 'frames/s'},
+        'virtual_converged_pct': {'value': converged / count * 100, 'unit': '%'},
+    }
+
+
+STARTUP_SCRIPT = """
+import time
+start = time.perf_counter()
+import lamp_control_mqtt
+print(time.perf_counter() - start)
+"""
+
+
+def bench_startup(repeat):
+    """Importing the bridge in a fresh interpreter, and the whole process start.
+
+    Nothing is faked here: the import must not need hardware, paho or the
+    command line.
+    """
+    here = os.path.dirname(os.path.abspath(__file__))
+    imports = []
+    processes = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        output = subprocess.run([sys.executable, '-c', STARTUP_SCRIPT], cwd=here, check=True,
+                                stdout=subprocess.PIPE, universal_newlines=True).stdout
+        processes.append(time.perf_counter() - start)
+        imports.append(float(output))
+    return {
+        'startup_import_ms': {'value': min(imports) * 1000, 'unit': 'ms'},
+        'startup_process_ms': {'value': min(processes) * 1000, 'unit': 'ms'},
+    }
+
+
+def run(quick=False):
+    lcm = import_bridge()
+    # Measure the code, not the log handlers
+    logging.disable(logging.CRITICAL)
+    n = 2000 if quick else 20000
+    repeat = 3 if quick else 5
+    results = {}
+    results.update(bench_startup(repeat))
+    results.update(bench_rx(lcm, n, repeat))
+    results.update(bench_rx_modes(lcm, 10 if quick else 30, 0.05 if quick else 0.1))
+    results.update(bench_planner(lcm, repeat))
+    results.update(bench_dispatch(lcm, n, repeat))
+    results.update(bench_find_lamp(lcm, n, repeat))
+    results.update(bench_virtual_radio(lcm, 20 if quick else 100, n // 10))
+    logging.disable(logging.NOTSET)
+    return {
+        'timestamp': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'results': results,
+    }
+
+
+def report(run_results, baseline=None):
+    """Print results, with the change against baseline when given."""
+    for name, result in run_results['results'].items():
+        line = f"{name:<28} {result['value']:>14.3f} {result['unit']}"
+        if baseline is not None and name in baseline['results']:
+            before = baseline['results'][name]['value']
+            if before:
+                line += f"  ({(result['value'] - before) / before * 100:+.1f}%)"
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the MQTT/RF bridge hot paths')
+    parser.add_argument('-o', dest='output', default=None,
+                        help="Save results as JSON to this file")
+    parser.add_argument('-b', dest='baseline', default=None,
+                        help="Compare against results saved by an earlier run")
+    parser.add_argument('--quick', action='store_true',
+                        help="Fewer iterations, for a fast sanity check")
+    args = parser.parse_args()
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    results = run(args.quick)
+    report(results, baseline)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f"Saved results to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,247 @@
+"""
+Bridge cluster - several bridge nodes sharing one MQTT broker
+
+Each node publishes the frames its receiver decodes, so a remote press heard
+by any node reaches the lamp's state, and a press heard by several nodes is
+counted once: frames with the same code from different nodes within a short
+window are the same frame on the air. Nodes announce themselves with
+retained heartbeats (and an offline last will), and every lamp is owned by
+exactly one live node, picked by rendezvous hashing. Only the owner
+transmits, handles frames and publishes state for a lamp; when a node goes
+away its lamps move to the survivors and nothing else is reassigned.
+
+Nodes need synchronized wall clocks (NTP is plenty): frames are compared by
+the wall clock time they were received at.
+
+This module does not import the bridge; it is handed the frame handler and
+a function from RF code to lamp ID.
+"""
+
+import hashlib
+import json
+import logging
+import threading
+import time
+
+from rf_journal import WALL_RESYNC, wall_offset
+
+CLUSTER_TOPIC = "joofo30w2400lm_cluster/"
+HEARTBEAT_INTERVAL = 2.0  # Seconds between heartbeats
+MISSED_HEARTBEATS = 3  # A node is gone after this many intervals without a heartbeat
+# Frames with the same code from different nodes closer than this (microseconds)
+# are one frame; well under the ~90ms between frames a held remote button decodes
+DEDUPE_WINDOW = 50000
+# Accepted frames are remembered this long (microseconds), to catch copies
+# that arrive late over the broker
+DEDUPE_HISTORY = 1000000
+# Same as the bridge's MIN_GAP: the gap reported for a lamp's first frame must
+# not look like a repeat
+MIN_GAP = 200000
+
+
+def rendezvous_owner(lamp_id, nodes):
+    """The node that owns a lamp: the one with the highest hash of (node, lamp).
+
+    Every node computes the same answer from the same membership, and
+    removing a node only moves the lamps it owned.
+    """
+    def score(node):
+        digest = hashlib.sha1(f"{node}:{lamp_id}".encode()).digest()
+        return int.from_bytes(digest[:8], 'big'), node
+    return max(nodes, key=score) if nodes else None
+
+
+class FrameDeduplicator:
+    """Merges the frame streams of several receivers.
+
+    A frame is a duplicate if a frame with the same code from another node
+    was accepted within window microseconds. Each accepted frame absorbs at
+    most one frame per other node, so a held button's successive frames are
+    never merged together.
+    """
+
+    def __init__(self, window=DEDUPE_WINDOW, history=DEDUPE_HISTORY):
+        self.window = window
+        self.history = history
+        # [timestamp, code, nodes that reported it], oldest first
+        self.recent = []
+        self.latest = 0
+        self.duplicates = 0
+
+    def accept(self, node, code, timestamp):
+        """True if the frame is new, False if another node already reported it."""
+        self.latest = max(self.latest, timestamp)
+        horizon = self.latest - self.history
+        drop = 0
+        while drop < len(self.recent) and self.recent[drop][0] < horizon:
+            drop += 1
+        del self.recent[:drop]
+        for entry in self.recent:
+            if entry[1] == code and node not in entry[2] and abs(entry[0] - timestamp) <= self.window:
+                entry[2].add(node)
+                self.duplicates += 1
+                return False
+        self.recent.append([timestamp, code, {node}])
+        return True
+
+
+class ClusterNode:
+    """This bridge's membership in the cluster.
+
+    Args:
+        client: MQTT client shared with the bridge
+        name: Unique node name
+        handler: Called as handler(code, timestamp, gap) for every frame this
+            node should act on; timestamps are wall clock microseconds
+        lamp_of: Returns the lamp ID for an RF code, or None
+        window: Deduplication window in microseconds
+        clock: Wall clock in seconds
+        own_frame: Returns True for a code this node just transmitted; other
+            nodes hear our transmissions too, and their copies must not look
+            like remote presses
+    """
+
+    def __init__(self, client, name, handler, lamp_of, window=DEDUPE_WINDOW,
+                 heartbeat=HEARTBEAT_INTERVAL, clock=time.time, own_frame=None):
+        self.client = client
+        self.name = name
+        self.handler = handler
+        self.lamp_of = lamp_of
+        self.own_frame = own_frame
+        self.heartbeat = heartbeat
+        self.timeout = MISSED_HEARTBEATS * heartbeat
+        self.clock = clock
+        self.lock = threading.Lock()
+        # Serializes frame handling between the RX thread and the MQTT thread
+        self.handle_lock = threading.Lock()
+        # node -> our clock when its last heartbeat arrived; the time in the
+        # heartbeat is the sender's clock, which may be skewed from ours
+        self.members = {}
+        self.deduplicator = FrameDeduplicator(window)
+        # lamp_id -> timestamp of the last frame handled for it
+        self.last_frame = {}
+        self.published = 0
+        self.remote = 0
+        # Frames other nodes heard of our own transmissions
+        self.echoes = 0
+        # Perf counter microseconds (as frames are timestamped) to wall
+        # clock, re-read every WALL_RESYNC seconds
+        self.wall_offset = wall_offset()
+        self.synced = time.perf_counter()
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def topic(self, kind, node=None):
+        return f"{CLUSTER_TOPIC}{kind}/{node or self.name}"
+
+    def will(self):
+        """(topic, payload) to register as the MQTT last will before connecting."""
+        return self.topic("nodes"), json.dumps({'node': self.name, 'state': "offline"})
+
+    def subscribe(self, client):
+        client.message_callback_add(f"{CLUSTER_TOPIC}#", self.on_message)
+        client.subscribe(f"{CLUSTER_TOPIC}#", qos=0)
+
+    def start(self):
+        self.send_heartbeat()
+        self.thread = threading.Thread(target=self._heartbeats, name="cluster-heartbeat",
+                                       daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join(timeout=1)
+        self.client.publish(*self.will(), qos=1, retain=True)
+
+    def _heartbeats(self):
+        while not self.stopped.wait(self.heartbeat):
+            self.send_heartbeat()
+
+    def send_heartbeat(self):
+        now = self.clock()
+        with self.lock:
+            self.members[self.name] = now
+        self.client.publish(self.topic("nodes"),
+                            json.dumps({'node': self.name, 'state': "online", 'time': now}),
+                            qos=1, retain=True)
+
+    def nodes(self):
+        """Names of the live nodes, this one included."""
+        now = self.clock()
+        with self.lock:
+            alive = {node for node, seen in self.members.items() if now - seen < self.timeout}
+        alive.add(self.name)
+        return sorted(alive)
+
+    def owner(self, lamp_id):
+        return rendezvous_owner(lamp_id, self.nodes())
+
+    def owns(self, lamp_id):
+        return self.owner(lamp_id) == self.name
+
+    def on_message(self, client, userdata, message):
+        try:
+            data = json.loads(message.payload.decode("utf-8"))
+        except ValueError:
+            logging.warning("Bad cluster message on %s", message.topic)
+            return
+        if data.get('node') == self.name:
+            return
+        if message.topic.startswith(f"{CLUSTER_TOPIC}nodes/"):
+            self.on_heartbeat(data)
+        elif message.topic.startswith(f"{CLUSTER_TOPIC}frames/"):
+            self.remote += 1
+            self.receive(data['node'], data['code'], data['timestamp'])
+
+    def on_heartbeat(self, data):
+        with self.lock:
+            joined = data['node'] not in self.members
+            if data.get('state') == "online":
+                self.members[data['node']] = self.clock()
+            else:
+                self.members.pop(data['node'], None)
+        if data.get('state') == "online" and joined:
+            logging.info("Cluster node %s joined", data['node'])
+        elif data.get('state') != "online" and not joined:
+            logging.info("Cluster node %s left", data['node'])
+
+    def local_frame(self, code, timestamp, gap):
+        """Handler for this node's receiver: share the frame, then act on it if ours."""
+        if time.perf_counter() - self.synced >= WALL_RESYNC:
+            self.wall_offset = wall_offset()
+            self.synced = time.perf_counter()
+        timestamp = int(timestamp) + self.wall_offset
+        self.client.publish(self.topic("frames"),
+                            json.dumps({'node': self.name, 'code': int(code),
+                                        'timestamp': timestamp}),
+                            qos=0, retain=False)
+        self.published += 1
+        if self.lamp_of(code) is None:
+            # Not a lamp; still let the bridge log it
+            self.handler(code, timestamp, gap)
+            return
+        self.receive(self.name, code, timestamp)
+
+    def receive(self, node, code, timestamp):
+        """Act on a frame from any node if this node owns its lamp and it is new."""
+        lamp_id = self.lamp_of(code)
+        if lamp_id is None or not self.owns(lamp_id):
+            return
+        if node != self.name and self.own_frame is not None and self.own_frame(code):
+            # Our receiver's copy was dropped before it got here
+            logging.debug("Frame %s from %s is our own transmission", code, node)
+            self.echoes += 1
+            return
+        with self.handle_lock:
+            if not self.deduplicator.accept(node, code, timestamp):
+                logging.debug("Frame %s from %s already heard", code, node)
+                return
+            last = self.last_frame.get(lamp_id)
+            gap = MIN_GAP + 1 if last is None else timestamp - last
+            self.last_frame[lamp_id] = max(timestamp, last or timestamp)
+            self.handler(code, timestamp, gap)
+
+    def stats(self):
+        return {'nodes': self.nodes(), 'published': self.published, 'remote': self.remote,
+                'duplicates': self.deduplicator.duplicates, 'echoes': self.echoes}
@@ -0,0 +1,339 @@
+#!/usr/bin/env python3
+"""
+Lamp Calibration - Measure a lamp's brightness steps
+
+The bridge can't see the lamps. It tracks brightness by counting BRUP and
+BRDOWN frames. It assumes BR_LEVELS steps for its own frames and the
+estimated REMOTE_BRUP_LEVELS/REMOTE_BRDOWN_LEVELS for the remote's. Every
+ramp to a boundary is padded with BOUNDARY_PADDING blind extra frames.
+
+This measures those numbers for one lamp and saves them as the lamp's
+"steps" in the lamps file. The bridge then plans and tracks with them.
+
+1. With a light sensor next to the lamp, the bridge resets the lamp to the
+   low anchor. It steps the lamp up one frame at a time until the light
+   stops rising, then back down until it stops falling. The frames that
+   changed the light give up/down. Frames that didn't, before the end of a
+   ramp, were lost, and that loss rate sets the padding.
+2. The remote is then held up across the whole range and back down. The
+   receiver counts the frames it decodes, giving remote_up/remote_down.
+
+The light level comes from an MQTT topic or from a file holding the latest
+reading. Either source can give a plain number or a JSON object holding one
+under --light-key. Without a light source, only the remote steps are
+measured. On the virtual radio the simulated lamp is the sensor, and there
+is no remote.
+
+Stop the bridge first: this uses its radio. The other options are
+lamp_control_mqtt.py's (-l, -g, -r, --rx-mode, --radio, ...).
+
+Usage:
+    python3 lamp_calibration.py LAMP_ID [--light-topic TOPIC | --light-file FILE] [--skip-remote]
+"""
+
+import argparse
+import json
+import logging
+import math
+import os
+import sys
+import time
+from collections import namedtuple
+
+import lamp_control_mqtt as lcm
+import virtual_radio
+
+PLATEAU_FRAMES = 5  # Frames in a row that leave the light unchanged end a ramp
+MAX_RAMP_FRAMES = 3 * lcm.BR_LEVELS  # Give up on a ramp that never levels off
+PADDING_MARGIN = 1  # Boundary frames added on top of the expected loss
+LIGHT_TIMEOUT = 10  # Seconds to wait for the first light reading
+REMOTE_TIMEOUT = 60  # Seconds to wait for the remote to be pressed
+REMOTE_IDLE = 2  # Seconds without a remote frame that mean the button was released
+
+# A ramp of frames from the bridge
+# frames: frames sent; steps: those that changed the light; lost: those
+# that didn't, before the last that did
+Ramp = namedtuple('Ramp', ['frames', 'steps', 'lost'])
+
+
+def parse_light(payload, key=None):
+    """A light level from a sensor payload, or None if it holds none.
+
+    Args:
+        payload: A number, or a JSON object with the number under key
+    """
+    try:
+        value = json.loads(payload)
+        if isinstance(value, dict):
+            value = value[key]
+        return float(value)
+    except (ValueError, KeyError, TypeError):
+        return None
+
+
+class LightSensor:
+    """The latest light level published on an MQTT topic."""
+
+    def __init__(self, key=None):
+        self.key = key
+        self.value = None
+
+    def on_message(self, client, userdata, message):
+        value = parse_light(message.payload, self.key)
+        if value is not None:
+            self.value = value
+
+    def read(self):
+        return self.value
+
+
+class FileLightSensor:
+    """The light level in a file that something else keeps up to date."""
+
+    def __init__(self, path, key=None):
+        self.path = path
+        self.key = key
+
+    def read(self):
+        try:
+            with open(self.path) as f:
+                return parse_light(f.read(), self.key)
+        except OSError:
+            return None
+
+
+class SimulatedLightSensor:
+    """The light from a SimulatedLamp on the virtual radio."""
+
+    def __init__(self, lamp):
+        self.lamp = lamp
+
+    def read(self):
+        return self.lamp.light
+
+
+def changed(before, after, tolerance):
+    """Whether the light moved by more than tolerance (a fraction of the brighter reading)."""
+    return abs(after - before) > tolerance * max(abs(before), abs(after))
+
+
+def fit_ramp(changes):
+    """Fit a ramp from whether each frame changed the light.
+
+    The frames after the last change are the plateau, so the lamp was
+    already at its end. Any unchanged frames before that were lost.
+
+    Returns:
+        A Ramp
+    """
+    last = max((i for i, change in enumerate(changes) if change), default=-1)
+    steps = sum(1 for change in changes if change)
+    return Ramp(len(changes), steps, last + 1 - steps)
+
+
+def fit_padding(loss, levels):
+    """Boundary padding for a lamp that loses a loss fraction of frames.
+
+    A ramp across all of the lamp's levels can be expected to lose
+    loss * levels frames.
+    """
+    return math.ceil(loss * levels) + PADDING_MARGIN
+
+
+def read_light(sensor):
+    value = sensor.read()
+    if value is None:
+        raise RuntimeError("No light level reading")
+    return value
+
+
+def ramp(code, sensor, settle, tolerance):
+    """Send code until PLATEAU_FRAMES frames in a row leave the light where it was.
+
+    Returns:
+        A Ramp
+    """
+    changes = []
+    light = read_light(sensor)
+    while len(changes) < MAX_RAMP_FRAMES:
+        if len(changes) >= PLATEAU_FRAMES and not any(changes[-PLATEAU_FRAMES:]):
+            break
+        lcm.send_rf(code)
+        time.sleep(settle)
+        reading = read_light(sensor)
+        changes.append(changed(light, reading, tolerance))
+        light = reading
+        logging.debug("Frame %s: light %s", len(changes), light)
+    if len(changes) >= MAX_RAMP_FRAMES and any(changes[-PLATEAU_FRAMES:]):
+        logging.warning("The light was still changing after %s frames", len(changes))
+    return fit_ramp(changes)
+
+
+def reset(lamp_id):
+    """BRUP, ON_OFF, BRUP: leaves the lamp on at the low anchor, as reset_lamp does."""
+    for offset in (lcm.BRIGHTNESS_UP_OFFSET, lcm.ON_OFF_OFFSET, lcm.BRIGHTNESS_UP_OFFSET):
+        lcm.send_rf(lamp_id + offset)
+
+
+def calibrate_bridge(lamp_id, sensor, settle, tolerance):
+    """Measure the lamp's steps for frames from the bridge.
+
+    Returns:
+        (up, down, padding) for the StepTable
+    """
+    reset(lamp_id)
+    time.sleep(settle)
+    up = ramp(lamp_id + lcm.BRIGHTNESS_UP_OFFSET, sensor, settle, tolerance)
+    down = ramp(lamp_id + lcm.BRIGHTNESS_DOWN_OFFSET, sensor, settle, tolerance)
+    logging.info("Bridge BRUP: %s, BRDOWN: %s", up, down)
+    # The up ramp starts one step above the minimum; the down ramp at the maximum
+    levels_up = up.steps + 2
+    levels_down = down.steps + 1
+    sent = up.steps + up.lost + down.steps + down.lost
+    loss = (up.lost + down.lost) / sent if sent else 0
+    return levels_up, levels_down, fit_padding(loss, max(levels_up, levels_down))
+
+
+def drain(receiver):
+    """Drop the frames the receiver has already decoded."""
+    while receiver.get(0) is not None:
+        pass
+
+
+def count_remote(receiver, code, timeout=REMOTE_TIMEOUT, idle=REMOTE_IDLE):
+    """Count the frames of code decoded from the first until none for idle seconds.
+
+    Returns:
+        The number of frames, 0 if none arrived within timeout
+    """
+    frames = 0
+    end = time.monotonic() + timeout
+    while True:
+        wait = end - time.monotonic()
+        if wait <= 0:
+            return frames
+        frame = receiver.get(wait)
+        if frame is not None and frame.code == code:
+            frames += 1
+            end = time.monotonic() + idle
+
+
+def calibrate_remote(lamp_id, receiver, timeout=REMOTE_TIMEOUT, idle=REMOTE_IDLE):
+    """Measure the lamp's steps for remote frames the receiver decodes.
+
+    Returns:
+        (remote_up, remote_down) for the StepTable; either is None if the
+        remote wasn't heard
+    """
+    name = lcm.registry.name(lamp_id)
+    reset(lamp_id)
+    drain(receiver)
+    logging.info("Hold BRUP on the remote for %s until it stops getting brighter, then release", name)
+    up = count_remote(receiver, lamp_id + lcm.BRIGHTNESS_UP_OFFSET, timeout, idle)
+    logging.info("Now hold BRDOWN until it stops getting dimmer, then release")
+    down = count_remote(receiver, lamp_id + lcm.BRIGHTNESS_DOWN_OFFSET, timeout, idle)
+    logging.info("Remote BRUP: %s frames, BRDOWN: %s frames", up, down)
+    # As for the bridge, the hold up starts one step above the minimum
+    return (up + 2 if up else None), (down + 1 if down else None)
+
+
+def save_steps(path, lamp_id, steps):
+    """Write a lamp's StepTable into the lamps file as its "steps"."""
+    with open(path) as f:
+        config = json.load(f)
+    for lamp in config['lamps']:
+        if int(lamp['id']) == lamp_id:
+            lamp['steps'] = dict(steps._asdict())
+            break
+    else:
+        raise ValueError(f"Lamp {lamp_id} is not in {path}")
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(config, f, indent=4)
+        f.write('\n')
+    os.replace(tmp, path)
+
+
+def open_light_sensor(options, lamp_id):
+    """The light sensor for --light-topic, --light-file or the virtual radio, or None."""
+    if options.light_topic:
+        sensor = LightSensor(options.light_key)
+        client = lcm.mqtt.Client("homebridge_mqtt_rfcalibration")
+        client.on_message = sensor.on_message
+        client.on_connect = lambda client, userdata, flags, rc: client.subscribe(options.light_topic)
+        client.connect("localhost")
+        client.loop_start()
+    elif options.light_file:
+        sensor = FileLightSensor(options.light_file, options.light_key)
+    elif lcm.radio_medium is not None:
+        lamp = next(receiver for receiver in lcm.radio_medium.receivers
+                    if isinstance(receiver, virtual_radio.SimulatedLamp) and receiver.lamp_id == lamp_id)
+        return SimulatedLightSensor(lamp)
+    else:
+        return None
+    deadline = time.monotonic() + LIGHT_TIMEOUT
+    while sensor.read() is None:
+        if time.monotonic() > deadline:
+            sys.exit("No light level reading; check --light-topic/--light-file and --light-key")
+        time.sleep(0.1)
+    return sensor
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure a lamp's brightness steps")
+    parser.add_argument('lamp_id', type=int, help="Base RF code of the lamp")
+    parser.add_argument('--light-topic', dest='light_topic', default=None,
+                        help="MQTT topic a light sensor next to the lamp publishes on")
+    parser.add_argument('--light-file', dest='light_file', default=None,
+                        help="File holding the latest light sensor reading")
+    parser.add_argument('--light-key', dest='light_key', default='illuminance',
+                        help="Field of a JSON light reading (Default: illuminance)")
+    parser.add_argument('--light-settle', dest='light_settle', type=float, default=0.5,
+                        help="Seconds between a frame and reading the light (Default: 0.5)")
+    parser.add_argument('--light-tolerance', dest='light_tolerance', type=float, default=0.01,
+                        help="Smallest change in the light that counts as a step, "
+                             "as a fraction of the reading (Default: 0.01)")
+    parser.add_argument('--skip-remote', dest='skip_remote', action='store_true',
+                        help="Only measure the bridge's own frames")
+    options, rest = parser.parse_known_args()
+    args = lcm.init(rest)
+    lcm.setup_bridge()
+    lamp_id = options.lamp_id
+    if lamp_id not in lcm.registry:
+        sys.exit(f"Lamp {lamp_id} is not in {args.lamps}")
+    if lcm.registry.lamps[lamp_id].members:
+        sys.exit("Calibrate the members of a group, not the group")
+
+    if args.rx_mode == 'poll' and not options.skip_remote:
+        sys.exit("The remote is counted with --rx-mode event or pigpio")
+
+    steps = lcm.step_table(lamp_id)
+    rxdevice = receiver = None
+    try:
+        sensor = open_light_sensor(options, lamp_id)
+        if sensor is not None:
+            up, down, padding = calibrate_bridge(lamp_id, sensor, options.light_settle,
+                                                 options.light_tolerance)
+            steps = steps._replace(up=up, down=down, padding=padding)
+        else:
+            logging.info("No light sensor; keeping the bridge steps and padding")
+
+        if options.skip_remote or lcm.radio_medium is not None:
+            logging.info("Skipping the remote")
+        else:
+            rxdevice, receiver = lcm.open_receiver()
+            remote_up, remote_down = calibrate_remote(lamp_id, receiver)
+            if remote_up is None or remote_down is None:
+                logging.warning("The remote wasn't heard in both directions; keeping its steps")
+            else:
+                steps = steps._replace(remote_up=remote_up, remote_down=remote_down)
+    finally:
+        lcm.shutdown(rxdevice=rxdevice, receiver=receiver)
+
+    logging.info("%s: %s -> %s", lcm.registry.name(lamp_id), lcm.step_table(lamp_id), steps)
+    save_steps(args.lamps, lamp_id, steps)
+    logging.info("Saved to %s", args.lamps)
+
+
+if __name__ == "__main__":
+    main()
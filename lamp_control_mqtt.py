@@ -2,40 +2,104 @@
 # Copyright (c) 2016 Suat Özgür, Micha LaQua
 
 import argparse
+import json
 import logging
+import logging.handlers
+import os
+import queue
+import signal
+import socket
+import threading
 import time
-import paho.mqtt.client as mqtt
+from collections import OrderedDict, deque, namedtuple
 import math
 from math import ceil
 from time import sleep
 
-from RPi import GPIO
-from rpi_rf import RFDevice
-
-logging.basicConfig(level=logging.INFO, datefmt='%Y-%m-%d %H:%M:%S',
-                    format='%(asctime)-15s - [%(levelname)s] %(module)s: %(message)s',)
-
-parser = argparse.ArgumentParser(description='Sends a decimal code via a 433/315MHz GPIO device')
-parser.add_argument('-c', dest='code', type=int,
-                    help="Decimal code to send")
-parser.add_argument('-g', dest='gpio_tx', type=int, default=4,
-                    help="GPIO transmit pin (Default: 4)")
-parser.add_argument('-r', dest='gpio_rx', type=int, default=23,
-                    help="GPIO receive pin (Default: 23)")
-parser.add_argument('-p', dest='pulselength', type=int, default=None,
-                    help="Pulselength (Default: 350)")
-parser.add_argument('-t', dest='protocol', type=int, default=None,
-                    help="Protocol (Default: 1)")
-args = parser.parse_args()
-
-if args.protocol:
-    protocol = args.protocol
-else:
-    protocol = "default"
-if args.pulselength:
-    pulselength = args.pulselength
-else:
-    pulselength = "default"
+# Startup is timed from here to the bridge listening (see main); systemd
+# restarts a crashed bridge after a second, and the lamps are unresponsive
+# for all of that and this
+IMPORTED = time.perf_counter()
+
+import bridge_cluster
+import rf_journal
+import virtual_radio
+
+# Hardware and MQTT modules are imported when first needed (see load_gpio and
+# init), so importing this module for its constants, codec and lamp model
+# touches no hardware and no command line
+GPIO = None
+RFDevice = None
+mqtt = None
+
+DEFAULT_LAMPS = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'lamps.json')
+DEFAULT_STATE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'lamp_state.json')
+LOG_FORMAT = '%(asctime)-15s - [%(levelname)s] %(module)s: %(message)s'
+VERIFY_WINDOW = 0.05  # Seconds after a transmission to listen for it (--verify-tx)
+VERIFY_RETRIES = 2  # Resends of a transmission that wasn't heard (--verify-tx)
+ECHO_WINDOW = 0.2  # Seconds after sending a code that hearing it is taken to be our own echo
+
+def build_parser():
+    """The bridge's command line options."""
+    parser = argparse.ArgumentParser(description='Sends a decimal code via a 433/315MHz GPIO device')
+    parser.add_argument('-c', dest='code', type=int,
+                        help="Decimal code to send")
+    parser.add_argument('-g', dest='gpio_tx', type=int, default=4,
+                        help="GPIO transmit pin (Default: 4)")
+    parser.add_argument('-r', dest='gpio_rx', type=int, default=23,
+                        help="GPIO receive pin (Default: 23)")
+    parser.add_argument('-p', dest='pulselength', type=int, default=None,
+                        help="Pulselength (Default: 350)")
+    parser.add_argument('-t', dest='protocol', type=int, default=None,
+                        help="Protocol (Default: 1)")
+    parser.add_argument('-l', dest='lamps', default=DEFAULT_LAMPS,
+                        help="Lamp registry file (Default: lamps.json next to this script)")
+    parser.add_argument('--state-file', dest='state_file', default=DEFAULT_STATE_FILE,
+                        help="Keep lamp state here across restarts; empty to disable "
+                             "(Default: lamp_state.json next to this script)")
+    parser.add_argument('--publish-window', dest='publish_window', type=float, default=0.1,
+                        help="Seconds to batch lamp state changes before publishing (Default: 0.1)")
+    parser.add_argument('--burst-updates', dest='burst_updates', type=float, default=0,
+                        help="Seconds between state updates while a remote button is held (Default: 0, only on release)")
+    parser.add_argument('--stats-file', dest='stats_file', default=None,
+                        help="Write latency stats to this file on SIGUSR1")
+    parser.add_argument('--rx-mode', dest='rx_mode', choices=['event', 'poll', 'pigpio'], default='event',
+                        help="Wake on each decoded code, poll for it, or decode pigpio edge batches (Default: event)")
+    parser.add_argument('--rx-glitch', dest='rx_glitch', type=int, default=100,
+                        help="pigpio RX mode: ignore level changes shorter than this many microseconds (Default: 100)")
+    parser.add_argument('--journal', dest='journal', default=None,
+                        help="Append every received frame to this binary journal (see rf_journal.py)")
+    parser.add_argument('--journal-size', dest='journal_size', type=float, default=4,
+                        help="Rotate the journal at this many megabytes (Default: 4)")
+    parser.add_argument('--radio', dest='radio', choices=['gpio', 'virtual'], default='gpio',
+                        help="Radio backend; virtual simulates the lamps in-process (Default: gpio)")
+    parser.add_argument('--sim-loss', dest='sim_loss', type=float, default=0.0,
+                        help="Virtual radio: probability a decode is lost (Default: 0)")
+    parser.add_argument('--sim-duplication', dest='sim_duplication', type=float, default=0.0,
+                        help="Virtual radio: probability a code is decoded twice (Default: 0)")
+    parser.add_argument('--sim-jitter', dest='sim_jitter', type=int, default=0,
+                        help="Virtual radio: maximum timestamp jitter in microseconds (Default: 0)")
+    parser.add_argument('--verify-tx', dest='verify_tx', action='store_true',
+                        help="Listen for each transmitted frame on the RX pin and resend it if it wasn't heard")
+    parser.add_argument('--verify-window', dest='verify_window', type=float, default=VERIFY_WINDOW * 1000,
+                        help=f"Verified sending: milliseconds to wait for our own frame (Default: {VERIFY_WINDOW * 1000:g})")
+    parser.add_argument('--verify-retries', dest='verify_retries', type=int, default=VERIFY_RETRIES,
+                        help=f"Verified sending: resends of a frame that wasn't heard (Default: {VERIFY_RETRIES})")
+    parser.add_argument('--echo-window', dest='echo_window', type=float, default=ECHO_WINDOW * 1000,
+                        help="Drop received codes we sent ourselves this many milliseconds before; "
+                             f"0 to handle them as remote presses (Default: {ECHO_WINDOW * 1000:g})")
+    parser.add_argument('--cluster', dest='cluster', action='store_true',
+                        help="Share received frames and lamp ownership with other bridges on the broker")
+    parser.add_argument('--node', dest='node', default=socket.gethostname(),
+                        help="Cluster node name, unique per bridge (Default: the host name)")
+    parser.add_argument('--dedupe-window', dest='dedupe_window', type=float,
+                        default=bridge_cluster.DEDUPE_WINDOW / 1000,
+                        help="Cluster: frames from different nodes this close (ms) are one frame "
+                             f"(Default: {bridge_cluster.DEDUPE_WINDOW / 1000:g})")
+    return parser
+
+# The defaults until init() parses the command line
+args = build_parser().parse_args([])
 
 # RF Command offsets - these are added to the lamp base ID to form RF codes
 ON_OFF_OFFSET = 0
@@ -58,13 +122,73 @@ HK_BR_MAX = 100  # HomeKit brightness scale (0-100)
 BR_INCREMENT = HK_BR_MAX / BR_LEVELS
 REMOTE_BRUP_INCREMENT = HK_BR_MAX / REMOTE_BRUP_LEVELS
 REMOTE_BRDOWN_INCREMENT = HK_BR_MAX / REMOTE_BRDOWN_LEVELS
+BR_LOW_BOUNDARY = 3  # Targets at or below this are treated as "minimum"
+BOUNDARY_PADDING = 5  # Extra commands sent at a boundary to absorb RF loss
+# Turning the lamp on with BRUP lands one step above the minimum (see reset_lamp)
+LOW_ANCHOR_BRIGHTNESS = 1 + BR_INCREMENT
+
+class StepTable(namedtuple('StepTable', ['up', 'down', 'remote_up', 'remote_down', 'padding'])):
+    """How a lamp's brightness moves, as measured by lamp_calibration.py.
+
+    up/down: levels the lamp steps through on BRUP/BRDOWN frames from the
+        bridge (BR_LEVELS for a lamp that hasn't been calibrated)
+    remote_up/remote_down: the same for remote frames the receiver decodes
+    padding: extra frames sent at a boundary to absorb RF loss
+    """
+
+    __slots__ = ()
+
+    @classmethod
+    def from_config(cls, config):
+        """A table from a lamps file "steps" object; missing entries keep the defaults.
+
+        Raises:
+            ValueError: On an unknown entry or a count below 1 (padding below 0)
+        """
+        steps = DEFAULT_STEPS._replace(**{name: int(value) for name, value in config.items()})
+        if min(steps[:4]) < 1 or steps.padding < 0:
+            raise ValueError(f"Invalid brightness steps: {config}")
+        return steps
+
+    @property
+    def up_increment(self):
+        return HK_BR_MAX / self.up
+
+    @property
+    def down_increment(self):
+        return HK_BR_MAX / self.down
+
+    @property
+    def remote_up_increment(self):
+        return HK_BR_MAX / self.remote_up
+
+    @property
+    def remote_down_increment(self):
+        return HK_BR_MAX / self.remote_down
+
+    @property
+    def low_anchor(self):
+        """Where turning the lamp on with BRUP lands, as LOW_ANCHOR_BRIGHTNESS."""
+        return 1 + self.up_increment
+
+DEFAULT_STEPS = StepTable(BR_LEVELS, BR_LEVELS, REMOTE_BRUP_LEVELS, REMOTE_BRDOWN_LEVELS,
+                          BOUNDARY_PADDING)
 
 # RF timing constants
 # Minimum gap (in microseconds) between RF messages to be considered separate button presses
 # Messages closer than this are treated as duplicates from the same button press
 MIN_GAP = 200000  # 200ms in microseconds
 RF_DELAY = 0.05  # Delay after sending RF command (seconds)
+TX_REPEAT = 2  # Number of times each code is repeated on air
+DEFAULT_PULSELENGTH = 350  # rpi_rf protocol 1 default (microseconds)
+# Protocol 1 frame: 24 bits of 4 pulses each, plus a 1+31 pulse sync
+FRAME_PULSES = 24 * 4 + 32
 RF_POLL_INTERVAL = 0.0001  # How often to check for new RF messages (seconds)
+RX_QUEUE_LEN = 64  # Decoded codes buffered between the GPIO thread and the RX loop
+RADIO_NODE = "bridge"  # Our devices on the virtual radio; they don't hear each other
+LOG_RATE_LIMIT = 10  # Seconds between repeats of a rate-limited log line
+# Pass as extra= to rate-limit a log line that can repeat on every frame
+RATE_LIMITED = {'rate_limit': True}
 
 # MQTT topics
 BASE_TOPIC = "cmnd/joofo30w2400lm_control/"
@@ -78,15 +202,301 @@ STUDY_LAMPS = 13470497
 STUDY_DESK_LAMP = 9513633
 STUDY_TABLE_LAMP = 4513633
 LAMPS2NAMES={LIVING_ROOM_LAMP : "LIVING_ROOM_LAMP", STUDY_LAMPS : "STUDY_LAMPS", STUDY_DESK_LAMP : "STUDY_DESK_LAMP", STUDY_TABLE_LAMP : "STUDY_TABLE_LAMP"}
+# Group codes -> the lamps that act on them
+LAMP_GROUPS = {STUDY_LAMPS: (STUDY_DESK_LAMP, STUDY_TABLE_LAMP)}
+SCENE_TOPIC = "Scene"
+
+# A lamp known to the bridge
+# tx: GPIO pins to transmit on, in order of preference; empty for the -g pin
+# members: for a group code, the IDs of the lamps that act on it
+# steps: the lamp's StepTable
+LampInfo = namedtuple('LampInfo', ['lamp_id', 'name', 'tx', 'members', 'steps'])
+LampInfo.__new__.__defaults__ = ((), (), DEFAULT_STEPS)
+
+class LampRegistry:
+    """The known lamps, plus a table from every valid RF code to its lamp and command.
+
+    Decoding a received code is a single dict lookup however many lamps there
+    are, and rf_sniffer shares the same table so the two can't disagree.
+    """
+
+    def __init__(self, lamps):
+        """
+        Args:
+            lamps: Iterable of (lamp_id, name), (lamp_id, name, tx pins),
+                (lamp_id, name, tx pins, member lamp IDs) or (lamp_id, name,
+                tx pins, member lamp IDs, StepTable) tuples
+
+        Raises:
+            ValueError: If two lamps would share an RF code, or a group has
+                members that aren't plain lamps in the registry
+        """
+        self.lamps = {}
+        self.codes = {}
+        for lamp_id, name, *extra in lamps:
+            tx = tuple(extra[0]) if extra else ()
+            members = tuple(int(member) for member in extra[1]) if len(extra) > 1 else ()
+            steps = extra[2] if len(extra) > 2 else DEFAULT_STEPS
+            info = LampInfo(int(lamp_id), name, tx, members, steps)
+            for offset in CMDS2NAMES:
+                code = info.lamp_id + offset
+                if code in self.codes:
+                    other = self.codes[code][0]
+                    raise ValueError(f"RF code {code} of {name} clashes with {other.name}")
+                self.codes[code] = (info, offset)
+            self.lamps[info.lamp_id] = info
+        # member lamp_id -> IDs of the groups it belongs to
+        self.groups = {}
+        for info in self.lamps.values():
+            for member in info.members:
+                if member not in self.lamps or self.lamps[member].members:
+                    raise ValueError(f"Group {info.name} member {member} is not a lamp")
+                self.groups[member] = self.groups.get(member, ()) + (info.lamp_id,)
 
-lamp_list = []
+    @classmethod
+    def load(cls, path):
+        """Load a registry from a JSON file with a "lamps" list of {id, name}.
+
+        A lamp may also have "tx": a GPIO pin, or a list of pins to fall back
+        through, for the transmitter that reaches it. A group code has
+        "members": the IDs of the lamps that act on it. A calibrated lamp has
+        "steps": its StepTable entries.
+        """
+        with open(path) as f:
+            config = json.load(f)
+        lamps = []
+        for lamp in config['lamps']:
+            tx = lamp.get('tx', [])
+            lamps.append((lamp['id'], lamp['name'], [tx] if isinstance(tx, int) else tx,
+                          lamp.get('members', []), StepTable.from_config(lamp.get('steps', {}))))
+        return cls(lamps)
+
+    def decode(self, code):
+        """Return (LampInfo, command offset) for an RF code, or None if unknown."""
+        return self.codes.get(code)
+
+    def groups_of(self, lamp_id):
+        """IDs of the group codes a lamp acts on."""
+        return self.groups.get(lamp_id, ())
+
+    def name(self, lamp_id):
+        info = self.lamps.get(lamp_id)
+        if info is None:
+            return f"UNKNOWN_{lamp_id}"
+        return info.name
+
+    def __contains__(self, lamp_id):
+        return lamp_id in self.lamps
+
+    def __iter__(self):
+        return iter(self.lamps.values())
+
+    def __len__(self):
+        return len(self.lamps)
+
+# Built-in lamps, replaced by the lamps file in main()
+registry = LampRegistry((lamp_id, name, (), LAMP_GROUPS.get(lamp_id, ()))
+                        for lamp_id, name in LAMPS2NAMES.items())
+
+# lamp_id -> joofo_lamp
+lamps = {}
+# Long-lived transmitter on the -g pin, opened on first use and closed on shutdown
+transmitter = None
+# gpio -> RFTransmitter for the other pins lamps are assigned to
+transmitters = {}
+transmitters_lock = threading.Lock()
+# Background TX worker; when None, commands run on the caller's thread
+tx_worker = None
+# Batches get* state updates; when None, each update is published at once
+state_publisher = None
+# Groups held remote buttons; when None, every received frame is handled alone
+burst_aggregator = None
+# Shared virtual medium when running with --radio virtual
+radio_medium = None
+# Binary history of received frames when running with --journal
+rx_journal = None
+# Writes log records on a background thread; when None, they're written by the caller
+log_listener = None
+# This bridge's place in a multi-node cluster; when None, it owns every lamp
+cluster = None
+# Saves lamp state for a warm start; when None, lamps start off after a restart
+state_store = None
+# Listens for our own transmissions with --verify-tx; when None, each code is sent once
+tx_verifier = None
+# Recently sent codes; when None, the receiver hearing our transmitter looks like a remote
+echo_filter = None
+
+class RateLimitFilter(logging.Filter):
+    """Drops repeats of a rate-limited log line within interval seconds.
+
+    Only records logged with extra=RATE_LIMITED are limited, keyed by their
+    unformatted message, so "Lamp not found!  Code: %s" is limited across
+    every unknown code. The next line let through says how many were dropped.
+    """
+
+    def __init__(self, interval=LOG_RATE_LIMIT, clock=time.monotonic):
+        super().__init__()
+        self.interval = interval
+        self.clock = clock
+        self.lock = threading.Lock()
+        # (level, message) -> [time last let through, repeats dropped since]
+        self.seen = {}
+
+    def filter(self, record):
+        if not getattr(record, 'rate_limit', False):
+            return True
+        key = (record.levelno, record.msg)
+        now = self.clock()
+        with self.lock:
+            entry = self.seen.get(key)
+            if entry is not None and now - entry[0] < self.interval:
+                entry[1] += 1
+                return False
+            dropped = entry[1] if entry is not None else 0
+            self.seen[key] = [now, 0]
+        if dropped:
+            record.msg = f"{record.msg} (%d similar suppressed)"
+            record.args = tuple(record.args or ()) + (dropped,)
+        return True
+
+class LogQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler that leaves formatting to the listener thread.
+
+    The stock handler formats every record before queueing it; records stay
+    in this process, so that work can happen off the RF threads instead.
+    """
+
+    def prepare(self, record):
+        return record
+
+def start_log_listener():
+    """Move the root logger's handlers behind a queue served by a background thread.
+
+    Returns:
+        The started QueueListener; stop() it to flush the queue
+    """
+    root = logging.getLogger()
+    handlers = root.handlers[:]
+    log_queue = queue.Queue(-1)
+    for handler in handlers:
+        root.removeHandler(handler)
+    root.addHandler(LogQueueHandler(log_queue))
+    listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+    listener.start()
+    return listener
+
+def stop_log_listener(listener):
+    """Write out queued records and give the root logger its handlers back."""
+    listener.stop()
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        if isinstance(handler, LogQueueHandler):
+            root.removeHandler(handler)
+    for handler in listener.handlers:
+        root.addHandler(handler)
+
+# Latency tracing
+LATENCY_SAMPLES = 1000  # Samples kept per command type and measurement
+STATS_TOPIC = "Stats"
+
+class CommandTrace:
+    """Timestamps for one MQTT command on its way to the lamp (time.monotonic)."""
+
+    def __init__(self, command_type, lamp_id):
+        self.command_type = command_type
+        self.lamp_id = lamp_id
+        self.received = time.monotonic()
+        self.queued = None
+        self.started = None
+        # (start, end) of every send_rf made for this command
+        self.tx = []
+        self.published = None
+        self.done = None
+
+    def latencies(self):
+        """Seconds spent in each stage, for the stages this command went through."""
+        result = {'total': self.done - self.received}
+        if self.started is not None:
+            result['queue'] = self.started - self.received
+        if self.tx:
+            result['first_tx'] = self.tx[0][1] - self.received
+            result['tx'] = sum(end - start for start, end in self.tx)
+        if self.published is not None:
+            result['publish'] = self.published - self.received
+        return result
+
+class LatencyStats:
+    """Recent command latencies with p50/p95/p99 per command type."""
+
+    def __init__(self, maxlen=LATENCY_SAMPLES):
+        self.maxlen = maxlen
+        self.lock = threading.Lock()
+        # command_type -> measurement -> deque of seconds
+        self.samples = {}
+
+    def record(self, trace):
+        with self.lock:
+            measurements = self.samples.setdefault(trace.command_type, {})
+            for name, seconds in trace.latencies().items():
+                measurements.setdefault(name, deque(maxlen=self.maxlen)).append(seconds)
+
+    def summary(self):
+        """{command_type: {measurement: {count, p50, p95, p99}}}, in milliseconds."""
+        with self.lock:
+            snapshot = {command_type: {name: sorted(values) for name, values in measurements.items()}
+                        for command_type, measurements in self.samples.items()}
+        summary = {}
+        for command_type, measurements in snapshot.items():
+            summary[command_type] = {}
+            for name, values in measurements.items():
+                summary[command_type][name] = {
+                    'count': len(values),
+                    'p50': round(percentile(values, 50) * 1000, 2),
+                    'p95': round(percentile(values, 95) * 1000, 2),
+                    'p99': round(percentile(values, 99) * 1000, 2),
+                }
+        return summary
+
+    def dump(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.summary(), f, indent=2, sort_keys=True)
+        logging.info("Wrote latency stats to %s", path)
+
+def percentile(values, pct):
+    """Nearest-rank percentile of an already sorted list."""
+    index = max(0, math.ceil(pct / 100 * len(values)) - 1)
+    return values[index]
+
+# Trace of the command the current thread is executing, if any
+trace_context = threading.local()
+latency_stats = LatencyStats()
+
+def current_trace():
+    return getattr(trace_context, 'trace', None)
+
+def publish_stats(client, userdata, message):
+    """Publish the latency summary on getStats when anything is sent to setStats.
+
+    With --verify-tx, the per-lamp delivery counters are added as "delivery",
+    and the number of our own frames dropped by the echo filter as "echoes".
+    """
+    summary = latency_stats.summary()
+    if tx_verifier is not None:
+        summary['delivery'] = tx_verifier.summary()
+    if echo_filter is not None:
+        summary['echoes'] = echo_filter.suppressed
+    client.publish(f"{BASE_TOPIC}get{STATS_TOPIC}", payload=json.dumps(summary), qos=0, retain=False)
 
 def reset_lamp(client, userdata, message):
     payload=str(message.payload.decode("utf-8"))
-    logging.info(f"received message = {payload}")
-    logging.debug(f"on reset lamp {payload}")
-    lamp = find_or_create_lamp(lamp_list, int(payload), client)
-    lamp.reset_lamp()
+    logging.info("received message = %s", payload)
+    logging.debug("on reset lamp %s", payload)
+    lamp_id = int(payload) if payload.isdigit() else None
+    if lamp_id not in registry:
+        logging.warning("Reset for unknown lamp: %s", payload, extra=RATE_LIMITED)
+        return
+    lamp = find_or_create_lamp(lamps, lamp_id, client)
+    submit_command(lamp, 'reset', payload, CommandTrace('reset', lamp_id))
 
 def create_lamp_callback(lamp_id, lamp_name, command_type):
     """Factory function to create MQTT callbacks for lamp commands.
@@ -100,20 +510,670 @@ def create_lamp_callback(lamp_id, lamp_name, command_type):
         A callback function for MQTT message handling
     """
     def callback(client, userdata, message):
+        trace = CommandTrace(command_type, lamp_id)
         payload = str(message.payload.decode("utf-8"))
-        logging.info(f"received message = {payload}")
-        logging.debug(f"{lamp_name} {command_type} lamp")
+        logging.info("received message = %s", payload)
+        logging.debug("%s %s lamp", lamp_name, command_type)
+
+        lamp = find_or_create_lamp(lamps, lamp_id, client)
+        submit_command(lamp, command_type, payload, trace)
+
+    return callback
+
+def run_command(lamp, command_type, payload, preempt=None, trace=None):
+    """Execute one MQTT command against a lamp.
 
-        lamp = find_or_create_lamp(lamp_list, lamp_id, client)
+    Args:
+        lamp: The joofo_lamp to act on
+        command_type: 'reset', 'on_off', 'brightness', or 'cct'
+        payload: The MQTT payload for the command
+        preempt: Optional callable, checked between brightness frames
+        trace: Optional CommandTrace, recorded in latency_stats once done
 
-        if command_type == 'on_off':
+    Returns:
+        False if a brightness change was interrupted by preempt, else True
+    """
+    if trace is not None and trace.started is None:
+        trace.started = time.monotonic()
+    trace_context.trace = trace
+    try:
+        completed = True
+        if command_type == 'reset':
+            lamp.reset_lamp()
+        elif command_type == 'on_off':
             lamp.on_off(payload, True)
         elif command_type == 'brightness':
-            lamp.set_brightness_level(int(payload))
+            completed = lamp.set_brightness_level(int(payload), preempt)
         elif command_type == 'cct':
             lamp.cct(True)
+    finally:
+        trace_context.trace = None
+    if trace is not None and completed:
+        trace.done = time.monotonic()
+        latency_stats.record(trace)
+    return completed
 
-    return callback
+def submit_command(lamp, command_type, payload, trace=None):
+    """Hand a command to the TX worker, or run it inline if there is none."""
+    if cluster is not None and not cluster.owns(lamp.lamp_id):
+        logging.debug("%s for %s left to node %s", command_type, lamp.lamp_id,
+                      cluster.owner(lamp.lamp_id))
+        return
+    if tx_worker is None:
+        run_command(lamp, command_type, payload, trace=trace)
+    else:
+        tx_worker.submit(lamp, command_type, payload, trace)
+
+def plan_scene(targets):
+    """The fewest frames that put a set of lamps into a scene.
+
+    Where every member of a group has the same target, the group code is
+    used instead if that sends fewer frames than setting each member: one
+    ramp for the group rather than one per lamp.
+
+    Args:
+        targets: {lamp_id: (on, level)} for plain lamps; level is None to
+            keep the brightness
+
+    Returns:
+        ([(lamp, command_type, payload)], total frames)
+    """
+    remaining = dict(targets)
+    commands = []
+    frames = 0
+    groups = [lamps[info.lamp_id] for info in registry if info.members and info.lamp_id in lamps]
+    for group in sorted(groups, key=lambda group: len(group.members), reverse=True):
+        wanted = {remaining.get(member.lamp_id) for member in group.members}
+        if len(wanted) != 1 or None in wanted:
+            continue
+        target = wanted.pop()
+        group_commands, group_frames = group.plan_scene(*target)
+        separate = sum(member.plan_scene(*target)[1] for member in group.members)
+        if group_frames < separate:
+            commands += [(group, command_type, payload) for command_type, payload in group_commands]
+            frames += group_frames
+            for member in group.members:
+                del remaining[member.lamp_id]
+    for lamp_id, target in remaining.items():
+        lamp_commands, lamp_frames = lamps[lamp_id].plan_scene(*target)
+        commands += [(lamps[lamp_id], command_type, payload) for command_type, payload in lamp_commands]
+        frames += lamp_frames
+    return commands, frames
+
+def set_scene(client, userdata, message):
+    """Set several lamps from one message on setScene.
+
+    The payload is a JSON object from lamp ID to {"on": bool, "brightness":
+    0-100}; a brightness alone turns the lamp on, or off if it is 0. A
+    group's setting applies to every member not given a setting of its own.
+    """
+    try:
+        scene = json.loads(message.payload.decode("utf-8"))
+        settings = {}
+        for lamp_id, setting in scene.items():
+            level = setting.get('brightness')
+            settings[int(lamp_id)] = (bool(setting.get('on', bool(level))),
+                                      None if level is None else int(level))
+    except (ValueError, TypeError, AttributeError) as e:
+        logging.warning("Bad scene: %s", e, extra=RATE_LIMITED)
+        return
+    targets = {}
+    for lamp_id, target in settings.items():
+        info = registry.lamps.get(lamp_id)
+        if info is None:
+            logging.warning("Scene for unknown lamp: %s", lamp_id, extra=RATE_LIMITED)
+        elif info.members:
+            for member in info.members:
+                targets.setdefault(member, target)
+        else:
+            targets[lamp_id] = target
+    for lamp_id in targets:
+        for group_id in registry.groups_of(lamp_id):
+            find_or_create_lamp(lamps, group_id, client)
+        find_or_create_lamp(lamps, lamp_id, client)
+    commands, frames = plan_scene(targets)
+    logging.info("Scene for %s lamps: %s commands, %s frames", len(targets), len(commands), frames)
+    for lamp, command_type, payload in commands:
+        submit_command(lamp, command_type, payload, CommandTrace(command_type, lamp.lamp_id))
+
+# set<suffix> topic -> command type
+TOPIC_COMMANDS = {
+    ON_OFF_TOPIC: 'on_off',
+    BRIGHTNESS_TOPIC: 'brightness',
+    CCT_TOPIC: 'cct'
+}
+
+class TopicRouter:
+    """Single on_message handler for everything under BASE_TOPIC.
+
+    Every set topic the bridge accepts is precomputed from the registry, so
+    dispatching a message is one dict lookup whatever the lamp count, and
+    topics for unknown lamps are dropped without creating a lamp.
+    """
+
+    def __init__(self, registry):
+        self.routes = {
+            f"{BASE_TOPIC}set{RESET_TOPIC}": reset_lamp,
+            f"{BASE_TOPIC}set{STATS_TOPIC}": publish_stats,
+            f"{BASE_TOPIC}set{SCENE_TOPIC}": set_scene,
+        }
+        for info in registry:
+            for topic_suffix, command_type in TOPIC_COMMANDS.items():
+                topic_string = f"{BASE_TOPIC}{info.lamp_id}/set{topic_suffix}"
+                self.routes[topic_string] = create_lamp_callback(info.lamp_id, info.name,
+                                                                 command_type)
+            if cluster is not None:
+                for topic_suffix in MIRRORED_TOPICS:
+                    self.routes[f"{BASE_TOPIC}{info.lamp_id}/get{topic_suffix}"] = mirror_state
+        logging.info("Routing %s topics for %s lamps", len(self.routes), len(registry))
+        # Number of set topics dropped because no lamp or command matched
+        self.rejected = 0
+
+    def __call__(self, client, userdata, message):
+        handler = self.routes.get(message.topic)
+        if handler is not None:
+            handler(client, userdata, message)
+        elif "/set" in message.topic:
+            # Our own get* state topics come back through the # subscription too
+            self.rejected += 1
+            logging.debug("No route for %s", message.topic)
+
+# get<suffix> topics a cluster node follows for the lamps other nodes own
+MIRRORED_TOPICS = (ON_OFF_TOPIC, BRIGHTNESS_TOPIC)
+
+def mirror_state(client, userdata, message):
+    """Follow the state another cluster node publishes for a lamp it owns.
+
+    Keeps this node's lamp model current so it can take the lamp over if
+    the owner goes away. Our own get* values come back here too, and are
+    ignored for lamps we own.
+    """
+    lamp_part, topic_suffix = message.topic[len(BASE_TOPIC):].split("/get", 1)
+    lamp_id = int(lamp_part)
+    if cluster is None or cluster.owns(lamp_id) or registry.lamps[lamp_id].members:
+        # A group's state comes from its members' own topics
+        return
+    payload = message.payload.decode("utf-8")
+    lamp = find_or_create_lamp(lamps, lamp_id, client)
+    if topic_suffix == ON_OFF_TOPIC:
+        lamp.on = payload == "true"
+    elif topic_suffix == BRIGHTNESS_TOPIC:
+        lamp.brightness = float(payload)
+    lamp.reset = False
+    if state_publisher is not None:
+        state_publisher.seen(message.topic, payload)
+    if state_store is not None:
+        state_store.changed()
+
+# Pending commands for a lamp run in this order
+COMMAND_ORDER = ('reset', 'on_off', 'brightness', 'cct')
+# Commands that jump ahead of (and interrupt) brightness ramps
+URGENT_COMMANDS = ('reset', 'on_off')
+
+class CommandQueue:
+    """Per-lamp queues of MQTT commands waiting for the radio.
+
+    Only the newest unsent brightness target is kept for each lamp, and a
+    pending on/off or reset jumps ahead of (and interrupts) brightness ramps.
+    """
+
+    def __init__(self):
+        self.cond = threading.Condition()
+        # lamp -> {command_type: payload}, lamps in arrival order
+        self.pending = OrderedDict()
+        # (lamp, command_type) -> CommandTrace of the pending command
+        self.traces = {}
+        self.running = True
+        self.busy = False
+        # Number of commands replaced before they were sent
+        self.coalesced = 0
+
+    def submit(self, lamp, command_type, payload, trace=None):
+        with self.cond:
+            commands = self.pending.setdefault(lamp, {})
+            if command_type == 'cct':
+                # Every press advances the cycle, so count them instead
+                commands['cct'] = commands.get('cct', 0) + 1
+                if trace is not None:
+                    self.traces.setdefault((lamp, 'cct'), trace)
+            else:
+                if command_type == 'reset' or (command_type == 'on_off' and payload == "false"):
+                    # Supersedes anything still waiting for this lamp
+                    for superseded in ('brightness', 'on_off'):
+                        if commands.pop(superseded, None) is not None:
+                            self.traces.pop((lamp, superseded), None)
+                            self.coalesced += 1
+                elif command_type in commands:
+                    self.coalesced += 1
+                commands[command_type] = payload
+                if trace is not None:
+                    self.traces[(lamp, command_type)] = trace
+            if trace is not None:
+                trace.queued = time.monotonic()
+            logging.debug("Queued %s %s for %s", command_type, payload, lamp.lamp_id)
+            self.cond.notify_all()
+
+    def preempted(self, lamp):
+        """True if a ramp on lamp should stop for newer or more urgent work."""
+        with self.cond:
+            if 'brightness' in self.pending.get(lamp, {}):
+                return True
+            return any(c in commands for commands in self.pending.values()
+                       for c in URGENT_COMMANDS)
+
+    def next_lamp(self):
+        for lamp, commands in self.pending.items():
+            if any(c in commands for c in URGENT_COMMANDS):
+                return lamp
+        return next(iter(self.pending))
+
+    def take(self):
+        """Remove the next lamp's commands from the queue.
+
+        Returns:
+            (lamp, {command_type: payload}, {command_type: CommandTrace})
+        """
+        with self.cond:
+            lamp = self.next_lamp()
+            commands = self.pending.pop(lamp)
+            traces = {c: self.traces.pop((lamp, c), None) for c in commands}
+            return lamp, commands, traces
+
+    def requeue(self, lamp, level, trace=None):
+        """Put an interrupted brightness target back unless it was superseded."""
+        with self.cond:
+            commands = self.pending.setdefault(lamp, {})
+            if ('brightness' not in commands and 'reset' not in commands
+                    and commands.get('on_off') != "false"):
+                commands['brightness'] = level
+                if trace is not None:
+                    self.traces[(lamp, 'brightness')] = trace
+
+class TxWorker(CommandQueue, threading.Thread):
+    """Background thread that drains a CommandQueue onto the radio.
+
+    Keeps the MQTT network thread from blocking on RF timing.
+    """
+
+    def __init__(self, name="rf-tx"):
+        threading.Thread.__init__(self, name=name, daemon=True)
+        CommandQueue.__init__(self)
+
+    def run(self):
+        while True:
+            with self.cond:
+                while self.running and not self.pending:
+                    self.busy = False
+                    self.cond.notify_all()
+                    self.cond.wait()
+                if not self.running:
+                    return
+                self.busy = True
+                lamp, commands, traces = self.take()
+            for command_type in COMMAND_ORDER:
+                if command_type in commands:
+                    self.execute(lamp, command_type, commands[command_type],
+                                 traces[command_type])
+
+    def execute(self, lamp, command_type, payload, trace=None):
+        try:
+            if command_type == 'cct':
+                for i in range(payload):
+                    run_command(lamp, command_type, None,
+                                trace=trace if i == payload - 1 else None)
+            elif not run_command(lamp, command_type, payload,
+                                 lambda: self.preempted(lamp), trace):
+                self.requeue(lamp, payload, trace)
+        except Exception as e:
+            logging.error("%s for %s failed: %s", command_type, lamp.lamp_id, e)
+
+    def wait_idle(self, timeout=None):
+        """Wait until every queued command has been sent."""
+        with self.cond:
+            return self.cond.wait_for(lambda: not self.pending and not self.busy, timeout)
+
+    def stop(self, timeout=None):
+        with self.cond:
+            self.running = False
+            self.cond.notify_all()
+        if self.is_alive():
+            self.join(timeout)
+
+class TxPool:
+    """A TxWorker per transmitter, so lamps on different radios are driven in parallel.
+
+    A lamp's commands go to the worker for the first pin in its TX list;
+    lamps sharing a transmitter are still serialized on its worker.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # gpio -> TxWorker
+        self.workers = {}
+
+    def worker(self, lamp_id):
+        gpio = tx_pins(lamp_id)[0]
+        with self.lock:
+            worker = self.workers.get(gpio)
+            if worker is None:
+                worker = TxWorker(name=f"rf-tx-{gpio}")
+                worker.start()
+                self.workers[gpio] = worker
+            return worker
+
+    def start(self):
+        for info in registry:
+            self.worker(info.lamp_id)
+
+    def submit(self, lamp, command_type, payload, trace=None):
+        self.worker(lamp.lamp_id).submit(lamp, command_type, payload, trace)
+
+    @property
+    def coalesced(self):
+        with self.lock:
+            return sum(worker.coalesced for worker in self.workers.values())
+
+    def wait_idle(self, timeout=None):
+        """Wait until every worker has sent everything queued on it."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self.lock:
+            workers = list(self.workers.values())
+        for worker in workers:
+            remaining = None if deadline is None else max(0, deadline - time.monotonic())
+            if not worker.wait_idle(remaining):
+                return False
+        return True
+
+    def stop(self, timeout=None):
+        with self.lock:
+            workers = list(self.workers.values())
+        for worker in workers:
+            with worker.cond:
+                worker.running = False
+                worker.cond.notify_all()
+        for worker in workers:
+            worker.stop(timeout)
+
+class StatePublisher:
+    """Batches lamp state updates and publishes only the final values.
+
+    Updates to the same get* topic within the window replace each other, and
+    a value equal to the one last published isn't sent again. Everything is
+    published retained so Homebridge gets the current state when it restarts.
+    """
+
+    def __init__(self, client, window):
+        self.client = client
+        self.window = window
+        self.lock = threading.Lock()
+        # topic -> payload waiting for the window to close
+        self.pending = {}
+        # topic -> payload last published
+        self.published = {}
+        self.timer = None
+        self.sent = 0
+        self.suppressed = 0
+
+    def publish(self, topic, payload):
+        payload = str(payload)
+        with self.lock:
+            if topic in self.pending:
+                self.suppressed += 1
+            self.pending[topic] = payload
+            if self.timer is None and self.window > 0:
+                self.timer = self._schedule(self.window, self.flush)
+        if self.window <= 0:
+            self.flush()
+
+    def _schedule(self, delay, callback):
+        timer = threading.Timer(delay, callback)
+        timer.daemon = True
+        timer.start()
+        return timer
+
+    def flush(self):
+        with self.lock:
+            pending, self.pending = self.pending, {}
+            self.timer = None
+            updates = []
+            for topic, payload in pending.items():
+                if self.published.get(topic) == payload:
+                    self.suppressed += 1
+                    continue
+                self.published[topic] = payload
+                updates.append((topic, payload))
+            self.sent += len(updates)
+        for topic, payload in updates:
+            self.client.publish(topic, payload=payload, qos=0, retain=True)
+        if updates:
+            logging.debug("Published %s state updates (%s sent, %s suppressed)",
+                          len(updates), self.sent, self.suppressed)
+
+    def seen(self, topic, payload):
+        """Note a value another node published, so it isn't published again."""
+        with self.lock:
+            self.published[topic] = str(payload)
+
+    def close(self):
+        with self.lock:
+            if self.timer is not None:
+                self.timer.cancel()
+        self.flush()
+        logging.info("State updates: %s sent, %s suppressed", self.sent, self.suppressed)
+
+STATE_SAVE_DELAY = 1.0  # Seconds after a change before lamp state is saved
+
+class LampStateStore:
+    """Lamp state kept in a small JSON file, so a restart picks up where it left off.
+
+    State is saved STATE_SAVE_DELAY seconds after it changes, so a brightness
+    ramp is one write, and again on shutdown. The file is replaced atomically
+    (written to a temporary file, synced, then renamed over the old one), so a
+    crash or power cut leaves the previous state rather than a torn file.
+    """
+
+    def __init__(self, path, delay=STATE_SAVE_DELAY):
+        self.path = path
+        self.delay = delay
+        self.lock = threading.Lock()
+        # Held for a whole save: the timer thread and close() both write the
+        # same temporary file
+        self.save_lock = threading.Lock()
+        self.timer = None
+        # Lamp IDs whose state came from the file
+        self.restored = []
+        self.last_saved = None
+        self.saves = 0
+
+    def load(self):
+        """Saved state by lamp ID; empty if there is no usable file."""
+        try:
+            with open(self.path) as f:
+                saved = json.load(f)['lamps']
+            return {int(lamp_id): state for lamp_id, state in saved.items()}
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            logging.warning("Ignoring lamp state in %s: %s", self.path, e)
+            return {}
+
+    def changed(self):
+        with self.lock:
+            if self.timer is None:
+                self.timer = self._schedule(self.delay, self.save)
+
+    def _schedule(self, delay, callback):
+        timer = threading.Timer(delay, callback)
+        timer.daemon = True
+        timer.start()
+        return timer
+
+    def snapshot(self):
+        # A group's state is its members'
+        return {str(lamp.lamp_id): {'on': lamp.on, 'brightness': lamp.brightness,
+                                    'color_temp': lamp.color_temp, 'reset': lamp.reset}
+                for lamp in list(lamps.values()) if not isinstance(lamp, joofo_group)}
+
+    def save(self):
+        with self.lock:
+            self.timer = None
+        with self.save_lock:
+            data = json.dumps({'lamps': self.snapshot()}, indent=1, sort_keys=True)
+            if data == self.last_saved:
+                return
+            temp = f"{self.path}.tmp"
+            try:
+                with open(temp, 'w') as f:
+                    f.write(data)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(temp, self.path)
+                # Make the rename itself durable
+                directory = os.open(os.path.dirname(os.path.abspath(self.path)), os.O_RDONLY)
+                try:
+                    os.fsync(directory)
+                finally:
+                    os.close(directory)
+            except OSError as e:
+                logging.warning("Couldn't save lamp state to %s: %s", self.path, e,
+                                extra=RATE_LIMITED)
+                return
+            self.last_saved = data
+            self.saves += 1
+
+    def close(self):
+        with self.lock:
+            if self.timer is not None:
+                self.timer.cancel()
+        self.save()
+
+def warm_start(client, store):
+    """Restore lamp state saved by the last run, without sending anything.
+
+    The restored state is published retained on connect (see on_connect).
+    """
+    global state_store
+    state_store = store
+    saved = store.load()
+    for info in registry:
+        state = saved.get(info.lamp_id)
+        if state is None or info.members:
+            continue
+        lamp = find_or_create_lamp(lamps, info.lamp_id, client)
+        lamp.on = bool(state.get('on', False))
+        lamp.brightness = float(state.get('brightness', 0))
+        lamp.color_temp = int(state.get('color_temp', 0))
+        lamp.reset = bool(state.get('reset', False))
+        store.restored.append(info.lamp_id)
+    # A group's state is its members'
+    store.restored += [info.lamp_id for info in registry
+                       if set(info.members) & set(store.restored)]
+    store.last_saved = json.dumps({'lamps': store.snapshot()}, indent=1, sort_keys=True)
+    logging.info("Restored %s lamps from %s", len(store.restored), store.path)
+
+def publish_lamp_state(lamp):
+    """Publish all of a lamp's get* topics."""
+    publish_state(lamp.client, f"{BASE_TOPIC}{lamp.lamp_id}/get{ON_OFF_TOPIC}",
+                  "true" if lamp.on else "false")
+    lamp.publish_brightness()
+    publish_state(lamp.client, f"{BASE_TOPIC}{lamp.lamp_id}/get{CCT_TOPIC}", lamp.color_temp)
+
+def publish_state(client, topic, payload):
+    """Publish a get* state topic, through the StatePublisher when there is one."""
+    trace = current_trace()
+    if trace is not None and trace.published is None:
+        trace.published = time.monotonic()
+    if state_store is not None:
+        state_store.changed()
+    if state_publisher is None:
+        client.publish(topic, payload=payload, qos=0, retain=True)
+    else:
+        state_publisher.publish(topic, payload)
+
+# Brightness planning
+# A plan is the list of RF command offsets to send and the tracked brightness
+# the lamp ends up at.
+BrightnessPlan = namedtuple('BrightnessPlan', ['strategy', 'commands', 'brightness'])
+
+def brightness_up(brightness, increment):
+    """Tracked brightness after one BRUP step (saturates at HK_BR_MAX)."""
+    if brightness < HK_BR_MAX:
+        brightness += increment
+    if brightness > HK_BR_MAX:
+        brightness = HK_BR_MAX
+    return brightness
+
+def brightness_down(brightness, increment):
+    """Tracked brightness after one BRDOWN step (saturates at 1)."""
+    if brightness > 1:
+        brightness -= increment
+    if brightness <= 0:
+        brightness = 1
+    return brightness
+
+def step_table(lamp_id):
+    """The StepTable a lamp's brightness is tracked and planned with."""
+    info = registry.lamps.get(lamp_id)
+    return info.steps if info is not None else DEFAULT_STEPS
+
+def step_commands(brightness, level, steps=DEFAULT_STEPS):
+    """Step one increment of the lamp's StepTable at a time from brightness towards level."""
+    commands = []
+    if brightness < level:
+        while brightness < level:
+            brightness = brightness_up(brightness, steps.up_increment)
+            commands.append(BRIGHTNESS_UP_OFFSET)
+    else:
+        while brightness > level:
+            brightness = brightness_down(brightness, steps.down_increment)
+            commands.append(BRIGHTNESS_DOWN_OFFSET)
+    return commands, brightness
+
+def pad_boundary(commands, brightness, level, relative, steps=DEFAULT_STEPS):
+    """Add the boundary padding that makes sure the lamp saturates.
+
+    Plans that start from a known level (relative=False) don't need the low
+    padding, since they can't have drifted on the way down.
+    """
+    commands = list(commands)
+    if level >= HK_BR_MAX:
+        commands += [BRIGHTNESS_UP_OFFSET] * steps.padding
+    elif level <= BR_LOW_BOUNDARY and relative:
+        for _ in range(steps.padding):
+            brightness = brightness_down(brightness, steps.down_increment)
+            commands.append(BRIGHTNESS_DOWN_OFFSET)
+    return commands, brightness
+
+def plan_brightness(brightness, on, level, steps=DEFAULT_STEPS):
+    """Work out the cheapest RF command sequence to reach level.
+
+    Candidates are stepping from the current estimate, and the off-then-BRUP
+    trick from reset_lamp which lands at LOW_ANCHOR_BRIGHTNESS no matter what
+    the lamp was at. A lamp that is off is turned on by BRUP at that same low
+    level, so stepping from the current estimate only applies when it is on.
+    steps is the lamp's StepTable.
+
+    Returns:
+        The BrightnessPlan with the fewest frames, preferring plain stepping
+        on a tie
+    """
+    plans = []
+    if on:
+        commands, result = step_commands(brightness, level, steps)
+        commands, result = pad_boundary(commands, result, level, True, steps)
+        plans.append(BrightnessPlan('step', commands, result))
+        prefix = [ON_OFF_OFFSET, BRIGHTNESS_UP_OFFSET]
+    else:
+        prefix = [BRIGHTNESS_UP_OFFSET]
+    commands, result = step_commands(steps.low_anchor, level, steps)
+    commands, result = pad_boundary(prefix + commands, result, level, False, steps)
+    plans.append(BrightnessPlan('low_anchor', commands, result))
+    return min(plans, key=lambda plan: len(plan.commands))
+
+def estimate_airtime(frames, pulselength=None):
+    """Estimated seconds needed to send frames codes, including RF_DELAY."""
+    frame_time = FRAME_PULSES * (pulselength or DEFAULT_PULSELENGTH) * TX_REPEAT / 1e6
+    return frames * (frame_time + RF_DELAY)
 
 class joofo_lamp:
     def __init__(self, lamp_id, client):
@@ -130,26 +1190,11 @@ class joofo_lamp:
         # Can't determine this, but let's just put it in
         self.color_temp = 0
 
-        # Get lamp name for logging
-        lamp_name = LAMPS2NAMES.get(lamp_id, f"UNKNOWN_{lamp_id}")
-
-        # Subscribe to reset topic (shared by all lamps)
-        topic_string = f"{BASE_TOPIC}set{RESET_TOPIC}"
-        logging.info(f"RESET TOPIC SUB: {topic_string}")
-        client.message_callback_add(topic_string, reset_lamp)
+        # MQTT commands reach the lamp through TopicRouter
 
-        # Subscribe to lamp-specific topics using factory function
-        commands = [
-            ('on_off', ON_OFF_TOPIC),
-            ('brightness', BRIGHTNESS_TOPIC),
-            ('cct', CCT_TOPIC)
-        ]
-
-        for command_type, topic_suffix in commands:
-            topic_string = f"{BASE_TOPIC}{lamp_id}/set{topic_suffix}"
-            logging.info(f"{topic_suffix.upper()} TOPIC SUB: {topic_string}")
-            callback = create_lamp_callback(lamp_id, lamp_name, command_type)
-            client.message_callback_add(topic_string, callback)
+    @property
+    def steps(self):
+        return step_table(self.lamp_id)
 
     def on_off(self, setting, send):
         topic_string = f"{BASE_TOPIC}{self.lamp_id}/get{ON_OFF_TOPIC}"
@@ -167,49 +1212,45 @@ class joofo_lamp:
                 status = "true"
             else:
                 status = "false"
-            logging.debug(f"Status: {status}")
-            logging.debug(f"Publishing to: {topic_string}")
-            self.client.publish(topic_string, payload=status, qos=0, retain=False)
+            logging.debug("Status: %s", status)
+            logging.debug("Publishing to: %s", topic_string)
+            publish_state(self.client, topic_string, status)
             if send:
                 send_rf(self.lamp_id + ON_OFF_OFFSET)
 
-    def brup(self, received, publish):
+    def publish_brightness(self):
         topic_string = f"{BASE_TOPIC}{self.lamp_id}/get{BRIGHTNESS_TOPIC}"
+        publish_state(self.client, topic_string, math.ceil(self.brightness))
+
+    def brup(self, received, publish, send=True):
         self.reset = False
         self.on_off("true", False)
-        if self.brightness < HK_BR_MAX:
-            if not received:
-                self.brightness += BR_INCREMENT
-            else:
-                self.brightness += REMOTE_BRUP_INCREMENT
-        if self.brightness > HK_BR_MAX:
-            self.brightness = HK_BR_MAX
-        logging.debug(f"brup {self.brightness}")
+        if not received:
+            self.brightness = brightness_up(self.brightness, self.steps.up_increment)
+        else:
+            self.brightness = brightness_up(self.brightness, self.steps.remote_up_increment)
+        logging.debug("brup %s", self.brightness)
         status=math.ceil(self.brightness)
-        logging.debug(f"Brightness status: {status}")
+        logging.debug("Brightness status: %s", status)
         if publish:
-            logging.debug(f"PUBLISHING (brup) {topic_string}")
-            self.client.publish(topic_string, payload=status, qos=0, retain=False)
-        if not received:
+            logging.debug("PUBLISHING (brup) %s", self.lamp_id)
+            self.publish_brightness()
+        if not received and send:
             send_rf(self.lamp_id + BRIGHTNESS_UP_OFFSET)
 
-    def brdown(self, received, publish):
-        topic_string = f"{BASE_TOPIC}{self.lamp_id}/get{BRIGHTNESS_TOPIC}"
+    def brdown(self, received, publish, send=True):
         self.reset = False
-        if self.brightness > 1:
-            if not received:
-                self.brightness -= BR_INCREMENT
-            else:
-                self.brightness -= REMOTE_BRDOWN_INCREMENT
-        if self.brightness <= 0:
-            self.brightness = 1
-        logging.debug(f"brdown {self.brightness}")
+        if not received:
+            self.brightness = brightness_down(self.brightness, self.steps.down_increment)
+        else:
+            self.brightness = brightness_down(self.brightness, self.steps.remote_down_increment)
+        logging.debug("brdown %s", self.brightness)
         status=math.ceil(self.brightness)
-        logging.debug(f"Brightness status: {status}")
+        logging.debug("Brightness status: %s", status)
         if publish:
-            logging.debug(f"PUBLISHING (brdown) {topic_string}")
-            self.client.publish(topic_string, payload=status, qos=0, retain=False)
-        if not received:
+            logging.debug("PUBLISHING (brdown) %s", self.lamp_id)
+            self.publish_brightness()
+        if not received and send:
             send_rf(self.lamp_id + BRIGHTNESS_DOWN_OFFSET)
 
     def cct(self, send):
@@ -220,53 +1261,98 @@ class joofo_lamp:
         # Trivial 0-1-2 cycle
         if self.color_temp == 3:
             self.color_temp = 0
+        publish_state(self.client, f"{BASE_TOPIC}{self.lamp_id}/get{CCT_TOPIC}", self.color_temp)
+
+    def set_brightness_level(self, level, preempt=None):
+        """Take the lamp to level using the cheapest planned command sequence.
+
+        Args:
+            level: HomeKit brightness (0-HK_BR_MAX)
+            preempt: Optional callable checked before each frame; when it
+                returns True the change stops where it is
 
-    def set_brightness_level(self, level):
-        logging.debug(f"Setting brightness, requested: {level}")
+        Returns:
+            False if preempt interrupted the change, else True
+        """
+        for _ in self.brightness_steps(level):
+            if preempt is not None and preempt():
+                logging.debug("Brightness change to %s interrupted at %s", level, self.brightness)
+                return False
+        return True
+
+    def brightness_steps(self, level):
+        """Generator behind set_brightness_level.
+
+        Yields before each planned frame; resuming it sends the frame and
+        updates the tracked state. Stopping early leaves the lamp part way.
+        """
+        logging.debug("Setting brightness, requested: %s", level)
         # Lamp has BR_LEVELS brightness levels (plus off)
         # but HomeKit has 100 brightness levels
         # We store HomeKit brightness internally & convert in tx/rx with lamp
 
         # Turning brightness to zero is handled by turning the lamp off from
         # homekit
-        if level == 0:
-            level = 1
+        level = min(max(level, 1), HK_BR_MAX)
 
+        plan = self.plan_level(level)
         # No need to change it
-        if level == math.ceil(self.brightness):
+        if plan is None:
             return
 
-        logging.debug(f"Rounded: {level}")
-
-        # Take the brightness to the required level
-        if self.brightness < level:
-            while self.brightness < level:
-                # Only publish the last time
-                if self.brightness + BR_INCREMENT >= level:
-                    logging.debug(f"PUBLISHING, level: {level} br: {self.brightness}")
-                    self.brup(False, True)
-                else:
-                    self.brup(False, False)
-                logging.debug(f"Level: {level}")
-        elif self.brightness > level:
-            while self.brightness > level:
-                if self.brightness - BR_INCREMENT <= level:
-                    logging.debug(f"PUBLISHING, level: {level} br: {self.brightness}")
-                    self.brdown(False, True)
-                else:
-                    self.brdown(False, False)
-                logging.debug(f"Level: {level}")
-
-        # Send extra commands at boundaries to ensure we reach the target
-        # despite potential RF signal loss
-        if level == 100:
-            logging.debug("At max brightness, sending 5 extra BRUP commands")
-            for _ in range(5):
-                self.brup(False, False)
-        if level <= 3:
-            logging.debug("At min brightness, sending 5 extra BRDOWN commands")
-            for _ in range(5):
-                self.brdown(False, False)
+        logging.debug("Rounded: %s", level)
+
+        stepping, _ = step_commands(self.brightness, level, self.steps)
+        stepping, _ = pad_boundary(stepping, 0, level, True, self.steps)
+        logging.info("Brightness plan (%s): %s frames, ~%.2fs (stepping: %s frames)",
+                     plan.strategy, len(plan.commands),
+                     estimate_airtime(len(plan.commands), args.pulselength), len(stepping))
+
+        last = len(plan.commands) - 1
+        for i, command in enumerate(plan.commands):
+            yield
+            # Only publish the last time
+            self.send_frame(command, i == last)
+        logging.debug("Level: %s br: %s", level, self.brightness)
+
+    def plan_level(self, level):
+        """The BrightnessPlan to take the lamp to level, or None if it's there."""
+        if level == math.ceil(self.brightness):
+            return None
+        return plan_brightness(self.brightness, self.on, level, self.steps)
+
+    def send_frame(self, command, publish, send=True):
+        """Send one planned frame and track what it does to the lamp.
+
+        With send=False the frame is only tracked: it went out on a group
+        code the lamp acts on.
+        """
+        if command == ON_OFF_OFFSET:
+            self.on_off("false" if self.on else "true", send)
+        elif command == BRIGHTNESS_UP_OFFSET:
+            if not self.on:
+                # BRUP turns the lamp on one step above the minimum
+                self.brightness = 1
+            self.brup(False, publish, send)
+        elif command == BRIGHTNESS_DOWN_OFFSET:
+            self.brdown(False, publish, send)
+
+    def plan_scene(self, on, level):
+        """The commands that take the lamp to a scene's setting.
+
+        Args:
+            on: Whether the lamp should be on
+            level: HomeKit brightness, or None to keep the current one
+
+        Returns:
+            ([(command_type, payload)], number of frames they send)
+        """
+        if not on:
+            return ([('on_off', "false")], 1) if self.on else ([], 0)
+        plan = None if level is None else self.plan_level(min(max(level, 1), HK_BR_MAX))
+        if plan is None:
+            return ([('on_off', "true")], 1) if not self.on else ([], 0)
+        return [('brightness', str(level))], len(plan.commands)
 
     def reset_lamp(self):
         # After this, lamp is known "on", brightness indeterminate
@@ -285,15 +1371,165 @@ class joofo_lamp:
         # Can't actually change the temp, but eh
         self.color_temperature = 0
 
-def find_or_create_lamp(lamp_list, lamp_id, client):
-    for item in lamp_list:
-        if item.lamp_id == lamp_id:
-            return item
+class joofo_group(joofo_lamp):
+    """A group code, such as STUDY_LAMPS, that every member lamp acts on.
+
+    A group has no on/off or brightness of its own: it is on if any member
+    is on, at the brightest member's level. Every frame sent to the group
+    code, or heard from the remote on it, is applied to each member, so one
+    transmission updates all of them.
+    """
+
+    def __init__(self, lamp_id, client, members):
+        self.lamp_id = lamp_id
+        self.client = client
+        # The member joofo_lamps
+        self.members = members
+        self.reset = False
+        self.color_temp = 0
+
+    @property
+    def on(self):
+        return any(member.on for member in self.members)
+
+    @property
+    def brightness(self):
+        return max((member.brightness for member in self.members if member.on), default=0)
+
+    @property
+    def steps(self):
+        """The finest of the members' steps and the most padding any of them needs."""
+        return StepTable(*map(max, zip(*(member.steps for member in self.members))))
+
+    def states(self):
+        """The members' distinct (on, brightness) states."""
+        return {(member.on, member.brightness) for member in self.members}
+
+    def publish_on_off(self):
+        publish_state(self.client, f"{BASE_TOPIC}{self.lamp_id}/get{ON_OFF_TOPIC}",
+                      "true" if self.on else "false")
+
+    def publish_brightness(self):
+        for member in self.members:
+            member.publish_brightness()
+        super().publish_brightness()
+
+    def on_off(self, setting, send):
+        if setting is None:
+            # The remote's toggle reached every member
+            for member in self.members:
+                member.on_off(None, False)
+            self.publish_on_off()
+            return
+        on = setting == "true"
+        switching = [member for member in self.members if member.on != on]
+        if not switching:
+            return
+        self.reset = False
+        if send and len(switching) == len(self.members):
+            # ON_OFF toggles, so the group code only works when all members agree
+            send_rf(self.lamp_id + ON_OFF_OFFSET)
+            for member in switching:
+                member.on_off(setting, False)
+        else:
+            for member in switching:
+                member.on_off(setting, send)
+        self.publish_on_off()
+
+    def brup(self, received, publish, send=True):
+        if not received:
+            self.send_frame(BRIGHTNESS_UP_OFFSET, publish, send)
+            return
+        self.reset = False
+        for member in self.members:
+            member.brup(True, False)
+        if publish:
+            self.publish_brightness()
+
+    def brdown(self, received, publish, send=True):
+        if not received:
+            self.send_frame(BRIGHTNESS_DOWN_OFFSET, publish, send)
+            return
+        self.reset = False
+        for member in self.members:
+            member.brdown(True, False)
+        if publish:
+            self.publish_brightness()
+
+    def cct(self, send):
+        for member in self.members:
+            member.cct(send)
+        super().cct(send)
+
+    def send_frame(self, command, publish, send=True):
+        """Send one frame on the group code; each member steps as if sent to it."""
+        self.reset = False
+        if send:
+            send_rf(self.lamp_id + command)
+        for member in self.members:
+            member.send_frame(command, False, send=False)
+        if command == ON_OFF_OFFSET or publish:
+            self.publish_on_off()
+        if publish:
+            self.publish_brightness()
+
+    def plan_level(self, level):
+        """Plan a brightness change for every member at once.
+
+        Members in the same state ramp together like one lamp. Otherwise they
+        are first brought together at the low anchor: BRUP turns on the
+        members that are off, and off-then-BRUP lands them all there.
+        """
+        steps = self.steps
+        states = self.states()
+        if len(states) == 1:
+            on, brightness = states.pop()
+            if level == math.ceil(brightness):
+                return None
+            return plan_brightness(brightness, on, level, steps)
+        if all(on for on, _ in states):
+            prefix = [ON_OFF_OFFSET, BRIGHTNESS_UP_OFFSET]
+        elif any(on for on, _ in states):
+            prefix = [BRIGHTNESS_UP_OFFSET, ON_OFF_OFFSET, BRIGHTNESS_UP_OFFSET]
+        else:
+            prefix = [BRIGHTNESS_UP_OFFSET]
+        commands, result = step_commands(steps.low_anchor, level, steps)
+        commands, result = pad_boundary(prefix + commands, result, level, False, steps)
+        return BrightnessPlan('group_anchor', commands, result)
+
+    def plan_scene(self, on, level):
+        switching = sum(1 for member in self.members if member.on != on)
+        if level is None or not on:
+            if switching == 0:
+                return [], 0
+            frames = 1 if switching == len(self.members) else switching
+            return [('on_off', "true" if on else "false")], frames
+        return super().plan_scene(on, level)
 
-    new_lamp = joofo_lamp(lamp_id, client)
-    lamp_list.append(new_lamp)
+    def reset_lamp(self):
+        # BRUP turns every member on, ON_OFF turns them all off, and BRUP
+        # lands them all one step above the minimum
+        self.send_frame(BRIGHTNESS_UP_OFFSET, False)
+        self.send_frame(ON_OFF_OFFSET, False)
+        self.send_frame(BRIGHTNESS_UP_OFFSET, True)
+        for member in self.members:
+            member.reset = True
+        self.reset = True
+
+def find_or_create_lamp(lamps, lamp_id, client):
+    lamp = lamps.get(lamp_id)
+    if lamp is not None:
+        return lamp
+
+    info = registry.lamps.get(lamp_id)
+    if info is not None and info.members:
+        members = [find_or_create_lamp(lamps, member, client) for member in info.members]
+        new_lamp = joofo_group(lamp_id, client, members)
+    else:
+        new_lamp = joofo_lamp(lamp_id, client)
+    lamps[lamp_id] = new_lamp
 
-    logging.info(f"Created lamp: {LAMPS2NAMES[lamp_id]} ({lamp_id})")
+    logging.info("Created lamp: %s (%s)", registry.name(lamp_id), lamp_id)
     return new_lamp
 
 def handle_rx(code, timestamp, gap):
@@ -307,6 +1543,11 @@ def handle_rx(code, timestamp, gap):
         logging.debug("Skipping duplicate command")
         return
 
+    if command in (BRIGHTNESS_UP_OFFSET, BRIGHTNESS_DOWN_OFFSET) and burst_aggregator is not None:
+        burst_aggregator.add(lamp, command)
+        return
+
+    logging.info("Remote: %s %s", registry.name(lamp.lamp_id), CMDS2NAMES[command])
     if command == ON_OFF_OFFSET:
         lamp.on_off(None, False)
     elif command == CCT_OFFSET:
@@ -316,89 +1557,715 @@ def handle_rx(code, timestamp, gap):
     elif command == BRIGHTNESS_DOWN_OFFSET:
         lamp.brdown(True, True)
 
+class RemoteBurst:
+    """Frames from one held brightness button on the remote."""
+
+    def __init__(self, lamp, command, now):
+        self.lamp = lamp
+        self.command = command
+        self.frames = 0
+        self.start_brightness = lamp.brightness
+        self.last_frame = now
+        self.last_publish = now
+        self.timer = None
+
+class BurstAggregator:
+    """Groups repeated BRUP/BRDOWN frames from a held remote button.
+
+    Every frame still moves the tracked brightness by the remote increment,
+    but the lamp's state is published once when the button is released (no
+    frame for gap seconds), plus every update_interval seconds while it is
+    held if that is set.
+    """
+
+    def __init__(self, gap=MIN_GAP / 1000000, update_interval=0):
+        self.gap = gap
+        self.update_interval = update_interval
+        self.lock = threading.Lock()
+        # lamp_id -> RemoteBurst in progress
+        self.bursts = {}
+
+    def add(self, lamp, command):
+        now = time.monotonic()
+        with self.lock:
+            burst = self.bursts.get(lamp.lamp_id)
+            if burst is not None and burst.command != command:
+                # Switching direction ends the previous press
+                self._finish(burst)
+                burst = None
+            if burst is None:
+                burst = RemoteBurst(lamp, command, now)
+                self.bursts[lamp.lamp_id] = burst
+                self._schedule(burst, self.gap)
+                logging.info("Remote: %s %s pressed", registry.name(lamp.lamp_id), CMDS2NAMES[command])
+            burst.frames += 1
+            burst.last_frame = now
+            if command == BRIGHTNESS_UP_OFFSET:
+                lamp.brup(True, False)
+            else:
+                lamp.brdown(True, False)
+            if self.update_interval and now - burst.last_publish >= self.update_interval:
+                burst.last_publish = now
+                lamp.publish_brightness()
+
+    def _schedule(self, burst, delay):
+        burst.timer = threading.Timer(delay, self._expire, (burst,))
+        burst.timer.daemon = True
+        burst.timer.start()
+
+    def _expire(self, burst):
+        with self.lock:
+            if self.bursts.get(burst.lamp.lamp_id) is not burst:
+                return
+            remaining = burst.last_frame + self.gap - time.monotonic()
+            if remaining > 0:
+                # Still held; check again when the gap could have elapsed
+                self._schedule(burst, remaining)
+            else:
+                self._finish(burst)
+
+    def _finish(self, burst):
+        burst.timer.cancel()
+        del self.bursts[burst.lamp.lamp_id]
+        burst.lamp.publish_brightness()
+        logging.info("Remote: %s %s x%s, brightness %s -> %s",
+                     registry.name(burst.lamp.lamp_id), CMDS2NAMES[burst.command], burst.frames,
+                     math.ceil(burst.start_brightness), math.ceil(burst.lamp.brightness))
+
+    def flush(self):
+        """End every burst in progress."""
+        with self.lock:
+            for burst in list(self.bursts.values()):
+                self._finish(burst)
+
+def lamp_of(code):
+    """The lamp an RF code addresses, or None."""
+    decoded = registry.decode(int(code))
+    return decoded[0].lamp_id if decoded is not None else None
+
 # Decode a message off the wire
 def decode_rx(code, timestamp):
-    target_lamp=None
-    for lamp in lamp_list:
-        if abs(int(code) - int(lamp.lamp_id)) <= MAX_OFFSET:
-            target_lamp=lamp
+    decoded = registry.decode(int(code))
+    target_lamp = None
+    if decoded is not None:
+        info, command = decoded
+        target_lamp = lamps.get(info.lamp_id)
 
     if target_lamp is None:
-        logging.warning(f"Lamp not found!  Code: {code}")
+        logging.warning("Lamp not found!  Code: %s", code, extra=RATE_LIMITED)
         return (None,None)
-    command = int(code) - int(target_lamp.lamp_id)
-    if command not in CMDS2NAMES.keys():
-        logging.warning(f"Command not found!  Code: {code}")
-        return (None, None)
-    logging.info(f"Code: {code} TS: {timestamp}")
-    logging.info(f"Lamp: {LAMPS2NAMES[target_lamp.lamp_id]}")
-    logging.info(f"Command: {CMDS2NAMES[command]}")
+    logging.debug("Code: %s TS: %s Lamp: %s Command: %s", code, timestamp, info.name, CMDS2NAMES[command])
     return (target_lamp,command)
 
+def load_gpio():
+    """Import RPi.GPIO and rpi_rf for the GPIO radio backend, once.
+
+    Returns:
+        True if they are available
+    """
+    global GPIO, RFDevice
+    if RFDevice is None:
+        try:
+            from RPi import GPIO as gpio_module
+            from rpi_rf import RFDevice as device_class
+        except ImportError:
+            return False
+        GPIO, RFDevice = gpio_module, device_class
+    return True
+
+def make_rf_device(gpio, node=RADIO_NODE, **kwargs):
+    """An RFDevice on gpio, or a virtual one when running on the virtual radio.
+
+    On the virtual radio, devices with the same node don't hear each other.
+    """
+    if radio_medium is not None:
+        return virtual_radio.VirtualRFDevice(gpio, radio_medium, node=node, **kwargs)
+    if not load_gpio():
+        raise RuntimeError("rpi_rf is not installed; use --radio virtual to run without hardware")
+    return RFDevice(gpio, **kwargs)
+
+def release_gpio(gpio):
+    """Hand a pin back to the OS; nothing to do on the virtual radio."""
+    if radio_medium is None and GPIO is not None:
+        GPIO.cleanup(gpio)
+
+class RFTransmitter:
+    """Transmitter that keeps the TX pin configured for the process lifetime.
+
+    Setting up an RFDevice and tearing it down again costs far more than the
+    frame itself, so the device is created once and reused for every code.
+    """
+
+    def __init__(self, gpio, protocol=None, pulselength=None, tx_repeat=TX_REPEAT):
+        self.gpio = gpio
+        self.protocol = protocol
+        self.pulselength = pulselength
+        self.tx_repeat = tx_repeat
+        self.device = None
+        # Serializes access to the pin between callers
+        self.lock = threading.Lock()
+
+    def open(self):
+        if self.device is None:
+            self.device = make_rf_device(self.gpio, tx_repeat=self.tx_repeat)
+            self.device.enable_tx()
+            logging.info("Transmitter enabled on GPIO %s", self.gpio)
+
+    def send(self, code):
+        with self.lock:
+            start = time.perf_counter()
+            self.open()
+            tx_start = time.perf_counter()
+            self.device.tx_code(int(code), self.protocol, self.pulselength)
+            end = time.perf_counter()
+        logging.debug("Sent: %s (setup %.2fms, tx %.2fms)",
+                      code, (tx_start - start) * 1000, (end - tx_start) * 1000)
+
+    def close(self):
+        with self.lock:
+            if self.device is None:
+                return
+            self.device.disable_tx()
+            # Only release our own pin; the receiver may still be using its pin
+            release_gpio(self.gpio)
+            self.device = None
+            logging.info("Transmitter on GPIO %s released", self.gpio)
+
+def tx_pins(lamp_id):
+    """GPIO pins that reach a lamp, in the order to try them."""
+    info = registry.lamps.get(lamp_id)
+    if info is not None and info.tx:
+        return info.tx
+    return (args.gpio_tx,)
+
+def get_transmitter(gpio):
+    """The shared transmitter for a TX pin, created on first use."""
+    global transmitter
+    with transmitters_lock:
+        if gpio == args.gpio_tx:
+            if transmitter is None:
+                transmitter = RFTransmitter(args.gpio_tx, args.protocol, args.pulselength)
+            return transmitter
+        if gpio not in transmitters:
+            transmitters[gpio] = RFTransmitter(gpio, args.protocol, args.pulselength)
+        return transmitters[gpio]
+
+# When tx_capture.codes is a list, send_rf appends to it instead of sending;
+# the asyncio engine uses this to update lamp state on its loop and send elsewhere
+tx_capture = threading.local()
+
 def send_rf(message):
-    logging.debug(f"Sending: {message}")
-    txdevice = RFDevice(args.gpio_tx, tx_repeat=2)
-    txdevice.enable_tx()
-    txdevice.tx_code(int(message), args.protocol, args.pulselength)
-    txdevice.disable_tx()
-    GPIO.cleanup(args.gpio_tx)
+    if state_store is not None:
+        # Interrupted ramps change state without publishing it
+        state_store.changed()
+    codes = getattr(tx_capture, 'codes', None)
+    if codes is not None:
+        codes.append(message)
+        return
+    transmit(message)
     sleep(RF_DELAY)
 
+def transmit(message):
+    """Send a code on the lamp's transmitter, until heard when verifying."""
+    logging.debug("Sending: %s", message)
+    start = time.monotonic()
+    if tx_verifier is None:
+        send_code(message)
+    else:
+        tx_verifier.send(int(message), send_code)
+    trace = current_trace()
+    if trace is not None:
+        trace.tx.append((start, time.monotonic()))
+
+def send_code(message):
+    """Send a code once on the lamp's transmitter, falling back through its pins."""
+    if echo_filter is not None:
+        echo_filter.sent(int(message))
+    decoded = registry.decode(int(message))
+    pins = tx_pins(decoded[0].lamp_id) if decoded is not None else (args.gpio_tx,)
+    for i, gpio in enumerate(pins):
+        try:
+            get_transmitter(gpio).send(message)
+            break
+        except Exception as e:
+            if i == len(pins) - 1:
+                raise
+            logging.warning("Transmitter on GPIO %s failed (%s), falling back to GPIO %s",
+                            gpio, e, pins[i + 1], extra=RATE_LIMITED)
+
+class DeliveryStats:
+    """Verified transmissions to one lamp."""
+
+    def __init__(self):
+        self.codes = 0
+        self.first_try = 0
+        self.retries = 0
+        self.lost = 0
+
+    def summary(self):
+        heard = self.codes - self.lost
+        return {
+            'codes': self.codes,
+            'first_try': self.first_try,
+            'retries': self.retries,
+            'lost': self.lost,
+            'success': round(heard / self.codes * 100, 1) if self.codes else None,
+        }
+
+class TxVerifier:
+    """Sends codes until the bridge's own receiver hears them (--verify-tx).
+
+    The receiver on the RX pin picks up our transmitter as well as the
+    remotes. A code is sent once; the RX path hands every received code to
+    heard(), and the code is only sent again if it wasn't heard within the
+    window. A frame that was waited for is ours, not a remote press, so the
+    RX path drops it.
+    """
+
+    def __init__(self, window=VERIFY_WINDOW, retries=VERIFY_RETRIES):
+        self.window = window
+        self.retries = retries
+        self.cond = threading.Condition()
+        # code being sent -> whether it has been heard
+        self.pending = {}
+        # lamp_id -> DeliveryStats
+        self.stats = {}
+
+    def send(self, code, send_code):
+        """Send code with send_code until heard, at most retries more times.
+
+        Returns:
+            True if the code was heard
+        """
+        with self.cond:
+            # Waiting before sending, so an echo that beats us back isn't missed
+            self.pending[code] = False
+        try:
+            for attempt in range(1 + self.retries):
+                send_code(code)
+                with self.cond:
+                    if self.cond.wait_for(lambda: self.pending[code], self.window):
+                        self._record(code, attempt, True)
+                        return True
+            self._record(code, self.retries, False)
+            logging.warning("%s wasn't heard after %s sends", code, 1 + self.retries, extra=RATE_LIMITED)
+            return False
+        finally:
+            with self.cond:
+                del self.pending[code]
+
+    def heard(self, code):
+        """Note a received code.
+
+        Returns:
+            True if it is a transmission being waited for
+        """
+        with self.cond:
+            if code not in self.pending:
+                return False
+            self.pending[code] = True
+            self.cond.notify_all()
+            return True
+
+    def _record(self, code, retries, heard):
+        lamp_id = lamp_of(code)
+        with self.cond:
+            stats = self.stats.setdefault(lamp_id, DeliveryStats())
+            stats.codes += 1
+            stats.retries += retries
+            if not heard:
+                stats.lost += 1
+            elif retries == 0:
+                stats.first_try += 1
+
+    def summary(self):
+        """{lamp name: delivery counters and success percentage}."""
+        with self.cond:
+            return {registry.name(lamp_id): stats.summary() for lamp_id, stats in self.stats.items()}
+
+def rx_clock():
+    """Microseconds on the perf_counter clock."""
+    return int(time.perf_counter() * 1000000)
+
+class EchoFilter:
+    """Recently sent codes, so the receiver hearing our own transmitter isn't a remote press.
+
+    A BRUP we sent and then heard would otherwise add the remote's increment
+    on top of the step already counted. Codes are recorded on rx_clock as they
+    are sent, and a received code is checked against the same clock when the
+    RX path takes it. Frame timestamps aren't used: in pigpio mode they are
+    the daemon's ticks, which drift away from this clock. The table is a
+    deque in send order, so expiring old entries on each send only looks at
+    its head, plus the latest send of each code. Only about a window's worth
+    of codes is kept.
+    """
+
+    def __init__(self, window=ECHO_WINDOW * 1000000, clock=rx_clock):
+        """
+        Args:
+            window: Microseconds after sending a code that hearing it is an echo
+            clock: Callable returning microseconds
+        """
+        self.window = window
+        self.clock = clock
+        self.lock = threading.Lock()
+        # (sent at, code), oldest first
+        self.recent = deque()
+        # code -> when it was last sent
+        self.last_sent = {}
+        self.suppressed = 0
+
+    def sent(self, code):
+        now = self.clock()
+        with self.lock:
+            self._expire(now)
+            self.recent.append((now, code))
+            self.last_sent[code] = now
+
+    def echo(self, code, now=None):
+        """Whether a received code is one we sent within the window before now.
+
+        Args:
+            now: When the code was taken off the receiver (Default: clock())
+
+        Echoes are counted in suppressed.
+        """
+        if now is None:
+            now = self.clock()
+        with self.lock:
+            sent_at = self.last_sent.get(code)
+            if sent_at is None or not 0 <= now - sent_at <= self.window:
+                return False
+            self.suppressed += 1
+            return True
+
+    def _expire(self, now):
+        while self.recent and now - self.recent[0][0] > self.window:
+            sent_at, code = self.recent.popleft()
+            if self.last_sent.get(code) == sent_at:
+                del self.last_sent[code]
+
+def own_frame(code):
+    """Whether a received code is our own transmission, rather than a remote's.
+
+    The verifier sees every frame first, so one it is waiting for counts as
+    heard. The echo filter then drops the rest of what we sent. In cluster
+    mode this also checks the frames other nodes report, since they hear
+    our transmitter too.
+    """
+    if tx_verifier is not None and tx_verifier.heard(int(code)):
+        return True
+    if echo_filter is not None and echo_filter.echo(int(code)):
+        logging.debug("Dropping echo of our own %s", code)
+        return True
+    return False
+
+# A code decoded by rpi_rf
+RxFrame = namedtuple('RxFrame', ['code', 'timestamp', 'pulselength', 'protocol'])
+
+class RFReceiver:
+    """Hands codes decoded by rpi_rf's edge callback to a waiting thread.
+
+    rpi_rf only exposes the last decoded code, which is why the RX loop used
+    to poll rx_code_timestamp. This wraps the device's rx_callback so the
+    loop sleeps until a complete code has been decoded. Create it before
+    calling enable_rx() so the wrapped callback is the one registered.
+    """
+
+    def __init__(self, rxdevice, maxlen=RX_QUEUE_LEN):
+        self.device = rxdevice
+        self.frames = deque(maxlen=maxlen)
+        self.cond = threading.Condition()
+        self.closed = False
+        self._edge_callback = rxdevice.rx_callback
+        rxdevice.rx_callback = self._rx_callback
+
+    def _rx_callback(self, gpio):
+        # Runs on every edge, so only take the lock once a code is complete
+        last = self.device.rx_code_timestamp
+        self._edge_callback(gpio)
+        timestamp = self.device.rx_code_timestamp
+        if timestamp != last:
+            frame = RxFrame(self.device.rx_code, timestamp,
+                            self.device.rx_pulselength, self.device.rx_proto)
+            with self.cond:
+                self.frames.append(frame)
+                self.cond.notify()
+
+    def get(self, timeout=None):
+        """Wait for the next decoded frame.
+
+        Returns:
+            An RxFrame, or None on timeout or once the receiver is closed
+        """
+        with self.cond:
+            self.cond.wait_for(lambda: self.frames or self.closed, timeout)
+            if self.frames:
+                return self.frames.popleft()
+            return None
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+def journal_frame(frame):
+    """Append a received frame to the RF journal, if there is one."""
+    if rx_journal is None:
+        return
+    decoded = registry.decode(int(frame.code))
+    rx_journal.append(frame, decoded[1] if decoded is not None else None)
+
+def rx_gap(timestamp, last_timestamp):
+    """Microseconds since the previous code."""
+    # Don't ignore the first command
+    if last_timestamp is None:
+        return MIN_GAP + 1
+    return timestamp - last_timestamp
+
+def poll_rx(rxdevice, handler, stop):
+    """Poll rxdevice for new codes until stop is set."""
+    timestamp = None
+    # Timestamp of the last code handed to handler; our own frames don't count
+    last = None
+    while not stop.is_set():
+        if rxdevice.rx_code_timestamp != timestamp:
+            timestamp = rxdevice.rx_code_timestamp
+            journal_frame(RxFrame(rxdevice.rx_code, timestamp, rxdevice.rx_pulselength, rxdevice.rx_proto))
+            if not own_frame(rxdevice.rx_code):
+                gap = rx_gap(timestamp, last)
+                logging.debug("Gap: %s", gap)
+                last = timestamp
+                handler(rxdevice.rx_code, timestamp, gap)
+        # Poll for new RF messages
+        sleep(RF_POLL_INTERVAL)
+
+def wait_rx(receiver, handler):
+    """Deliver codes from an RFReceiver or PigpioReceiver as they are decoded, until it is closed."""
+    timestamp = None
+    while True:
+        frame = receiver.get()
+        if frame is None:
+            return
+        journal_frame(frame)
+        if own_frame(frame.code):
+            continue
+        gap = rx_gap(frame.timestamp, timestamp)
+        logging.debug("Gap: %s", gap)
+        timestamp = frame.timestamp
+        handler(frame.code, timestamp, gap)
+
 def on_disconnect(mqttc, userdata, rc):
     if rc != 0:
-        logging.warning(f"Unexpected disconnect (rc={rc}). Reconnecting...")
+        logging.warning("Unexpected disconnect (rc=%s). Reconnecting...", rc)
         try:
             mqttc.reconnect()
         except Exception as e:
-            logging.error(f"Reconnection failed: {e}")
+            logging.error("Reconnection failed: %s", e)
     else:
         logging.info("Clean disconnect.")
 
 def on_connect(mqttc, obj, flags, rc):
     logging.info("Connected.")
     topic_string = f"{BASE_TOPIC}#"
-    logging.info(f"Subscribing to: {topic_string}")
+    logging.info("Subscribing to: %s", topic_string)
     mqttc.subscribe(topic_string, qos=0)
+    if cluster is not None:
+        cluster.subscribe(mqttc)
+
+    for info in registry:
+        find_or_create_lamp(lamps, info.lamp_id, mqttc)
+    if state_store is not None:
+        for lamp_id in state_store.restored:
+            publish_lamp_state(lamps[lamp_id])
+
+def shutdown(client=None, rxdevice=None, receiver=None):
+    """Release the radio and MQTT resources owned by the bridge."""
+    if receiver is not None:
+        receiver.close()
+    if tx_worker is not None:
+        tx_worker.stop(timeout=1)
+    if burst_aggregator is not None:
+        burst_aggregator.flush()
+    if state_store is not None:
+        state_store.close()
+    if state_publisher is not None:
+        state_publisher.close()
+    if cluster is not None:
+        cluster.stop()
+        logging.info("Cluster: %s", cluster.stats())
+    if tx_verifier is not None:
+        logging.info("Delivery: %s", tx_verifier.summary())
+    if echo_filter is not None:
+        logging.info("Suppressed %s echoes of our own frames", echo_filter.suppressed)
+    if client is not None:
+        client.loop_stop()
+        client.disconnect()
+    if transmitter is not None:
+        transmitter.close()
+    for other in transmitters.values():
+        other.close()
+    if rxdevice is not None:
+        rxdevice.disable_rx()
+        release_gpio(args.gpio_rx)
+    if rx_journal is not None:
+        rx_journal.close()
+    if radio_medium is not None:
+        log_simulation(radio_medium)
+    if log_listener is not None:
+        stop_log_listener(log_listener)
+
+def log_simulation(medium):
+    """Log the virtual medium's counters and how each simulated lamp compares to the bridge."""
+    logging.info("Virtual radio: %s", medium.stats())
+    for receiver in medium.receivers:
+        if not isinstance(receiver, virtual_radio.SimulatedLamp):
+            continue
+        lamp = lamps.get(receiver.lamp_id)
+        bridge = f"on={lamp.on} brightness={math.ceil(lamp.brightness)}" if lamp else "unknown"
+        logging.info("Simulated %s: on=%s brightness=%s (bridge: %s)", registry.name(receiver.lamp_id),
+                     receiver.on, math.ceil(receiver.brightness), bridge)
+
+def init(argv=None):
+    """Parse the command line, set up logging and import paho.
+
+    Nothing here happens on import, so the constants, codec and lamp model
+    can be used without a command line, hardware or a broker.
 
-    find_or_create_lamp(lamp_list, LIVING_ROOM_LAMP, mqttc)
-    find_or_create_lamp(lamp_list, STUDY_LAMPS, mqttc)
-    find_or_create_lamp(lamp_list, STUDY_DESK_LAMP, mqttc)
-    find_or_create_lamp(lamp_list, STUDY_TABLE_LAMP, mqttc)
+    Returns:
+        The parsed options, also left in args
+    """
+    global args, mqtt
+    args = build_parser().parse_args(argv)
+    logging.basicConfig(level=logging.INFO, datefmt='%Y-%m-%d %H:%M:%S', format=LOG_FORMAT)
+    import paho.mqtt.client as mqtt
+    return args
+
+def log_startup():
+    """Log how long the bridge took to start listening."""
+    logging.info("Started in %.0f ms", (time.perf_counter() - IMPORTED) * 1000)
+
+def setup_bridge():
+    """Start logging, load the lamps and set up the radio backend."""
+    global registry, radio_medium, log_listener
+    # Keep log writes off the RF threads
+    logging.getLogger().addFilter(RateLimitFilter())
+    log_listener = start_log_listener()
+    registry = LampRegistry.load(args.lamps)
+    logging.info("Loaded %s lamps from %s", len(registry), args.lamps)
+    if args.radio == 'virtual':
+        radio_medium = virtual_radio.RadioMedium(args.sim_loss, args.sim_duplication, args.sim_jitter)
+        simulated = [virtual_radio.SimulatedLamp(info.lamp_id, radio_medium,
+                                                 registry.groups_of(info.lamp_id))
+                     for info in registry if not info.members]
+        logging.info("Running on the virtual radio with %s simulated lamps", len(simulated))
+
+def open_receiver():
+    """Set up the RX pin for --rx-mode.
+
+    Returns:
+        (rxdevice, receiver); rxdevice is None in pigpio mode and receiver
+        is None in poll mode
+    """
+    rxdevice = None
+    receiver = None
+    if args.rx_mode == 'pigpio':
+        # pigpiod captures and filters the edges; no RFDevice needed
+        import rf_edges
+        receiver = rf_edges.PigpioReceiver(args.gpio_rx, glitch=args.rx_glitch)
+    else:
+        # Verifying needs the receiver to hear our own transmitter, as it does on real hardware
+        rxdevice = make_rf_device(args.gpio_rx, node=None if args.verify_tx else RADIO_NODE)
+        if args.rx_mode == 'event':
+            receiver = RFReceiver(rxdevice)
+        rxdevice.enable_rx()
+    return rxdevice, receiver
+
+def open_journal():
+    """Open the RF journal if --journal is set."""
+    global rx_journal
+    if args.journal:
+        rx_journal = rf_journal.JournalWriter(args.journal, int(args.journal_size * 1024 * 1024))
+        logging.info("Journaling received frames to %s", args.journal)
 
 def main():
     """Main entry point for the application."""
-    client = mqtt.Client("homebridge_mqtt_rfclient")
+    global tx_worker, state_publisher, burst_aggregator, cluster, tx_verifier, echo_filter
+    init()
+    setup_bridge()
+    if args.cluster and not args.code:
+        # The broker drops a connection when another uses the same client ID
+        client = mqtt.Client(f"homebridge_mqtt_rfclient_{args.node}")
+        cluster = bridge_cluster.ClusterNode(client, args.node, handle_rx, lamp_of,
+                                             int(args.dedupe_window * 1000),
+                                             own_frame=own_frame)
+        client.will_set(*cluster.will(), qos=1, retain=True)
+        logging.info("Joining the bridge cluster as %s", args.node)
+    else:
+        client = mqtt.Client("homebridge_mqtt_rfclient")
     client.on_connect = on_connect
+    client.on_message = TopicRouter(registry)
+    state_publisher = StatePublisher(client, args.publish_window)
     client.on_disconnect = on_disconnect
+    if args.state_file and not args.code:
+        warm_start(client, LampStateStore(args.state_file))
     client.connect("localhost")
 
     if args.code:
         logging.info("Sending one message.")
-        logging.info(f"{args.code} [protocol: {protocol}, pulselength: {pulselength}]")
-        txdevice = RFDevice(args.gpio_tx, tx_repeat=2)
+        logging.info("%s [protocol: %s, pulselength: %s]", args.code,
+                     args.protocol or "default", args.pulselength or "default")
+        txdevice = make_rf_device(args.gpio_tx, tx_repeat=TX_REPEAT)
         txdevice.enable_tx()
         txdevice.tx_code(args.code, args.protocol, args.pulselength)
         txdevice.cleanup()
         sleep(RF_DELAY)
+        stop_log_listener(log_listener)
     else:
         logging.info("Waiting for mqtt messages.")
-        rxdevice = RFDevice(args.gpio_rx)
-        rxdevice.enable_rx()
-        timestamp = None
-        client.loop_start()
-        while True:
-            if rxdevice.rx_code_timestamp != timestamp:
-                # Don't ignore the first command
-                gap = MIN_GAP + 1
-                if timestamp is not None:
-                    gap = rxdevice.rx_code_timestamp - timestamp
-                logging.debug(f"Gap: {gap}")
-                timestamp = rxdevice.rx_code_timestamp
-                code = rxdevice.rx_code
-                handle_rx(code, timestamp, gap)
-            # Poll for new RF messages
-            sleep(RF_POLL_INTERVAL)
+        rxdevice, receiver = open_receiver()
+        stop = threading.Event()
+        signals = []
+
+        # pylint: disable=unused-argument
+        def exithandler(signum, frame):
+            # Only end the RX loop; the code this interrupted may hold locks
+            # that shutdown() takes, so it runs once the loop has returned
+            signals.append(signum)
+            stop.set()
+            if receiver is not None:
+                receiver.close()
+
+        signal.signal(signal.SIGTERM, exithandler)
+        signal.signal(signal.SIGINT, exithandler)
+        if args.stats_file:
+            signal.signal(signal.SIGUSR1, lambda signum, frame: latency_stats.dump(args.stats_file))
 
+        open_journal()
+        if args.verify_tx:
+            tx_verifier = TxVerifier(args.verify_window / 1000, args.verify_retries)
+        if args.echo_window:
+            echo_filter = EchoFilter(args.echo_window * 1000)
+
+        tx_worker = TxPool()
+        tx_worker.start()
+        burst_aggregator = BurstAggregator(update_interval=args.burst_updates)
+
+        client.loop_start()
+        handler = handle_rx
+        if cluster is not None:
+            cluster.start()
+            handler = cluster.local_frame
+        log_startup()
+        try:
+            if receiver is not None:
+                wait_rx(receiver, handler)
+            else:
+                poll_rx(rxdevice, handler, stop)
+        finally:
+            if signals:
+                logging.info("Received signal %s, shutting down.", signals[0])
+            shutdown(client, rxdevice, receiver)
 
 if __name__ == "__main__":
     main()
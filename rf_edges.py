@@ -0,0 +1,397 @@
+"""
+433 MHz code decoding from captured edge timestamps
+
+rpi_rf decodes codes in a Python callback that runs on every GPIO edge.
+EdgeDecoder runs the same decoder over batches of edge timestamps instead,
+so codes can be decoded from an edge stream that something else captured.
+PigpioReceiver is such a stream: the pigpio daemon timestamps the edges
+(with its glitch filter dropping noise spikes), and Python reads them in
+batches from the notification pipe rather than waking for each edge.
+decode_edges() decodes a whole recorded trace at once with NumPy.
+"""
+
+import logging
+import os
+import struct
+import threading
+import time
+from collections import deque, namedtuple
+
+# Only needed for PigpioReceiver
+try:
+    import pigpio
+except ImportError:
+    pigpio = None
+
+# Only needed for decode_edges
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# rpi_rf's protocol table and decoder limits
+Protocol = namedtuple('Protocol',
+                      ['pulselength',
+                       'sync_high', 'sync_low',
+                       'zero_high', 'zero_low',
+                       'one_high', 'one_low'])
+PROTOCOLS = (None,
+             Protocol(350, 1, 31, 1, 3, 3, 1),
+             Protocol(650, 1, 10, 1, 2, 2, 1),
+             Protocol(100, 30, 71, 4, 11, 9, 6),
+             Protocol(380, 1, 6, 1, 3, 3, 1),
+             Protocol(500, 6, 14, 1, 2, 2, 1),
+             Protocol(200, 1, 10, 1, 5, 1, 1))
+MAX_CHANGES = 67
+SYNC_GAP = 5000  # Edges further apart than this (microseconds) end a frame
+SYNC_MATCH = 200  # Maximum difference between matching syncs (microseconds)
+RX_TOLERANCE = 80  # Percent
+# Seconds between re-reading pigpio's tick clock against perf_counter; the
+# two drift apart by tens of ppm
+TICK_RESYNC = 60.0
+
+# A decoded code, as rpi_rf reports it
+Frame = namedtuple('Frame', ['code', 'timestamp', 'pulselength', 'protocol'])
+
+
+class EdgeDecoder:
+    """rpi_rf's receive decoder, fed edge timestamps in batches.
+
+    Produces exactly the codes rpi_rf would for the same edges: a code is
+    decoded when two consecutive frames end in matching syncs.
+    """
+
+    def __init__(self, rx_tolerance=RX_TOLERANCE):
+        self.rx_tolerance = rx_tolerance
+        self.timings = [0] * (MAX_CHANGES + 1)
+        self.last_timestamp = 0
+        self.change_count = 0
+        self.repeat_count = 0
+
+    def feed(self, timestamps):
+        """Decode a batch of edge timestamps (microseconds).
+
+        Returns:
+            List of Frames decoded from the batch
+        """
+        frames = []
+        timings = self.timings
+        last = self.last_timestamp
+        change_count = self.change_count
+        repeat_count = self.repeat_count
+        for timestamp in timestamps:
+            duration = timestamp - last
+            if duration > SYNC_GAP:
+                if duration - timings[0] < SYNC_MATCH:
+                    repeat_count += 1
+                    change_count -= 1
+                    if repeat_count == 2:
+                        frame = self.waveform(change_count, timestamp)
+                        if frame is not None:
+                            frames.append(frame)
+                        repeat_count = 0
+                change_count = 0
+            if change_count >= MAX_CHANGES:
+                change_count = 0
+                repeat_count = 0
+            timings[change_count] = duration
+            change_count += 1
+            last = timestamp
+        self.last_timestamp = last
+        self.change_count = change_count
+        self.repeat_count = repeat_count
+        return frames
+
+    def waveform(self, change_count, timestamp):
+        """Match the buffered timings against each protocol in turn."""
+        timings = self.timings
+        for pnum in range(1, len(PROTOCOLS)):
+            protocol = PROTOCOLS[pnum]
+            code = 0
+            delay = int(timings[0] / protocol.sync_low)
+            delay_tolerance = delay * self.rx_tolerance / 100
+            for i in range(1, change_count, 2):
+                if (timings[i] - delay * protocol.zero_high < delay_tolerance and
+                        timings[i + 1] - delay * protocol.zero_low < delay_tolerance):
+                    code <<= 1
+                elif (timings[i] - delay * protocol.one_high < delay_tolerance and
+                      timings[i + 1] - delay * protocol.one_low < delay_tolerance):
+                    code <<= 1
+                    code |= 1
+                else:
+                    break
+            else:
+                if change_count > 6 and code != 0:
+                    return Frame(code, timestamp, delay, pnum)
+        return None
+
+
+def decode_edges(timestamps, levels=None, rx_tolerance=RX_TOLERANCE):
+    """Decode a recorded edge trace with vectorized NumPy operations.
+
+    Gives the same Frames as feeding the whole trace to a new EdgeDecoder,
+    including rpi_rf's quirks: a frame longer than MAX_CHANGES edges
+    restarts the timing buffer, and only every second matching sync decodes.
+
+    Args:
+        timestamps: Edge timestamps in microseconds
+        levels: Optional pin level after each edge; reports that don't
+            change the level are dropped
+        rx_tolerance: Percent of a pulse a timing may be off by
+
+    Returns:
+        List of Frames
+    """
+    if np is None:
+        raise RuntimeError("numpy is not installed")
+    timestamps = np.asarray(timestamps, dtype=np.int64)
+    if levels is not None:
+        levels = np.asarray(levels)
+        changed = np.ones(len(levels), dtype=bool)
+        changed[1:] = levels[1:] != levels[:-1]
+        timestamps = timestamps[changed]
+    if len(timestamps) == 0:
+        return []
+    index = np.arange(len(timestamps))
+    durations = np.diff(timestamps, prepend=0)
+
+    # Every sync gap restarts the timing buffer, and so does every
+    # MAX_CHANGES edges without one
+    sync = durations > SYNC_GAP
+    sync[0] = True
+    segment = np.maximum.accumulate(np.where(sync, index, 0))
+    offset = index - segment
+    restart = sync | ((offset > 0) & (offset % MAX_CHANGES == 0))
+    start = np.maximum.accumulate(np.where(restart, index, 0))
+
+    # State at each sync after the first edge, from the buffer that precedes it
+    syncs = index[sync][1:]
+    if len(syncs) == 0:
+        return []
+    buffer_start = start[syncs - 1]
+    matched = durations[syncs] - durations[buffer_start] < SYNC_MATCH
+    # Overflowing the buffer also resets the repeat count
+    overflowed = buffer_start != segment[syncs - 1]
+    overflowed[0] = True
+    matches = np.cumsum(matched)
+    group = np.maximum.accumulate(np.where(overflowed, np.arange(len(syncs)), 0))
+    repeats = matches - (matches - matched)[group]
+    decode = matched & (repeats % 2 == 0)
+
+    ends = syncs[decode]
+    first = buffer_start[decode]
+    # The sync's high pulse is dropped from the change count
+    change_counts = ends - first - 1
+    window = np.arange(MAX_CHANGES + 1)
+    cells = np.minimum(first[:, None] + window, len(durations) - 1)
+    timings = durations[cells]
+    bits = (MAX_CHANGES + 1) // 2
+    odd = 2 * np.arange(bits) + 1
+    active = odd[None, :] < change_counts[:, None]
+    bit_counts = active.sum(axis=1)
+    weights = np.where(active, bit_counts[:, None] - 1 - np.arange(bits)[None, :], 0)
+    high = timings[:, odd]
+    low = timings[:, np.minimum(odd + 1, MAX_CHANGES)]
+
+    codes = np.zeros(len(ends), dtype=np.int64)
+    delays = np.zeros(len(ends), dtype=np.int64)
+    protocols = np.zeros(len(ends), dtype=np.int64)
+    pending = np.ones(len(ends), dtype=bool)
+    for pnum in range(1, len(PROTOCOLS)):
+        protocol = PROTOCOLS[pnum]
+        delay = timings[:, 0] // protocol.sync_low
+        tolerance = (delay * rx_tolerance / 100)[:, None]
+        delay = delay[:, None]
+        zero = ((high - delay * protocol.zero_high < tolerance) &
+                (low - delay * protocol.zero_low < tolerance))
+        one = (~zero & (high - delay * protocol.one_high < tolerance) &
+               (low - delay * protocol.one_low < tolerance))
+        valid = np.all(zero | one | ~active, axis=1)
+        code = np.sum(np.where(active & one, np.left_shift(1, weights), 0), axis=1)
+        found = pending & valid & (change_counts > 6) & (code != 0)
+        codes[found] = code[found]
+        delays[found] = delay[found, 0]
+        protocols[found] = pnum
+        pending &= ~found
+
+    decoded = protocols > 0
+    return [Frame(int(code), int(timestamp), int(delay), int(pnum))
+            for code, timestamp, delay, pnum in zip(codes[decoded], timestamps[ends][decoded],
+                                                    delays[decoded], protocols[decoded])]
+
+
+def code_edges(code, protocol=1, pulselength=None, repeat=10, length=24, start=0):
+    """Edge timestamps of code as rpi_rf's tx_code would send it.
+
+    Returns:
+        List of edge timestamps (microseconds), starting at start
+    """
+    proto = PROTOCOLS[protocol]
+    pulselength = pulselength or proto.pulselength
+    bits = format(code, f'0{length}b')
+    if protocol == 6:
+        bits = ''.join('01' if bit == '0' else '10' for bit in bits)
+    pulses = []
+    for _ in range(repeat):
+        if protocol == 6:
+            pulses.append((proto.sync_high, proto.sync_low))
+        for bit in bits:
+            if bit == '0':
+                pulses.append((proto.zero_high, proto.zero_low))
+            else:
+                pulses.append((proto.one_high, proto.one_low))
+        pulses.append((proto.sync_high, proto.sync_low))
+    edges = []
+    now = start
+    for high, low in pulses:
+        edges.append(now)
+        now += high * pulselength
+        edges.append(now)
+        now += low * pulselength
+    return edges
+
+
+class PigpioReceiver:
+    """Decodes codes from the pigpio daemon's timestamped edge stream.
+
+    pigpiod samples the pin, applies the glitch filter and writes each
+    level change to a notification pipe. A reader thread drains the pipe
+    in batches and runs EdgeDecoder over them, so the RX loop is woken
+    once per decoded code. Has the same get()/close() interface as
+    RFReceiver.
+    """
+
+    NOTIFY_PIPE = "/dev/pigpio{}"
+    # pigpio notification report: seqno, flags, tick, level
+    REPORT = struct.Struct('HHII')
+    # Reports with any of these flags set are not level changes
+    NOTIFY_FLAGS = 0xE0
+    TICK_WRAP = 1 << 32
+
+    def __init__(self, gpio, glitch=100, pi=None, maxlen=64, batch_interval=0.02,
+                 rx_tolerance=RX_TOLERANCE):
+        """
+        Args:
+            gpio: GPIO receive pin
+            glitch: Level changes shorter than this many microseconds are
+                dropped by the daemon (0 disables the filter)
+            pi: Connected pigpio.pi (Default: connect to the local daemon)
+            maxlen: Decoded codes buffered for get()
+            batch_interval: Seconds to let edges accumulate between reads
+        """
+        if pi is None:
+            if pigpio is None:
+                raise RuntimeError("pigpio is not installed; use another RX mode")
+            pi = pigpio.pi()
+            self.own_pi = True
+        else:
+            self.own_pi = False
+        if not pi.connected:
+            raise RuntimeError("Can't connect to pigpiod; is the daemon running?")
+        self.pi = pi
+        self.gpio = gpio
+        self.glitch = glitch
+        self.batch_interval = batch_interval
+        self.decoder = EdgeDecoder(rx_tolerance)
+        self.frames = deque(maxlen=maxlen)
+        self.cond = threading.Condition()
+        self.closed = False
+        self.edges = 0
+        self.batches = 0
+
+        pi.set_mode(gpio, 0)  # pigpio.INPUT
+        pi.set_glitch_filter(gpio, glitch)
+        self.anchor()
+        self.level = (pi.read(gpio) or 0) << gpio
+        self.handle = pi.notify_open()
+        self.pipe = os.open(self.NOTIFY_PIPE.format(self.handle), os.O_RDONLY)
+        pi.notify_begin(self.handle, 1 << gpio)
+        self.thread = threading.Thread(target=self._read, name="pigpio-rx", daemon=True)
+        self.thread.start()
+        logging.info("pigpio receiver on GPIO %s (glitch filter %sus)", gpio, glitch)
+
+    def anchor(self):
+        """Pair the daemon's current tick with the perf_counter clock.
+
+        Ticks are the daemon's 32-bit microsecond clock; timestamps are
+        reported on the perf_counter clock rpi_rf uses, counted from the
+        last anchor so drift between the two clocks doesn't build up.
+        """
+        self.anchor_tick = self.pi.get_current_tick()
+        self.anchored = time.perf_counter()
+        self.anchor_timestamp = int(self.anchored * 1000000)
+
+    def edge_timestamps(self, data):
+        """Timestamps of the level changes on our pin in a block of reports."""
+        mask = 1 << self.gpio
+        timestamps = []
+        for _, flags, tick, level in self.REPORT.iter_unpack(data):
+            if flags & self.NOTIFY_FLAGS:
+                continue
+            level &= mask
+            if level == self.level:
+                continue
+            self.level = level
+            # Edges read after anchoring may have happened before it
+            delta = (tick - self.anchor_tick) % self.TICK_WRAP
+            if delta >= self.TICK_WRAP // 2:
+                delta -= self.TICK_WRAP
+            timestamps.append(self.anchor_timestamp + delta)
+        return timestamps
+
+    def _read(self):
+        pending = b''
+        size = self.REPORT.size
+        while not self.closed:
+            try:
+                data = os.read(self.pipe, size * 4096)
+            except OSError:
+                break
+            if not data:
+                break
+            data = pending + data
+            whole = len(data) - len(data) % size
+            pending = data[whole:]
+            if time.perf_counter() - self.anchored >= TICK_RESYNC:
+                self.anchor()
+            timestamps = self.edge_timestamps(data[:whole])
+            self.edges += len(timestamps)
+            self.batches += 1
+            frames = self.decoder.feed(timestamps)
+            if frames:
+                with self.cond:
+                    self.frames.extend(frames)
+                    self.cond.notify()
+            if self.batch_interval:
+                time.sleep(self.batch_interval)
+        os.close(self.pipe)
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+    def get(self, timeout=None):
+        """Wait for the next decoded frame.
+
+        Returns:
+            A Frame, or None on timeout or once the receiver is closed
+        """
+        with self.cond:
+            self.cond.wait_for(lambda: self.frames or self.closed, timeout)
+            if self.frames:
+                return self.frames.popleft()
+            return None
+
+    def close(self):
+        with self.cond:
+            if self.closed and self.handle is None:
+                return
+            self.closed = True
+            self.cond.notify_all()
+        if self.handle is not None:
+            self.pi.notify_close(self.handle)
+            self.handle = None
+        self.pi.set_glitch_filter(self.gpio, 0)
+        if self.own_pi:
+            self.pi.stop()
+        logging.info("pigpio receiver on GPIO %s closed (%s edges in %s batches)",
+                     self.gpio, self.edges, self.batches)
@@ -0,0 +1,315 @@
+#!/usr/bin/env python3
+"""
+RF Journal - Compact binary history of received RF frames
+
+Every frame is a fixed-width 16 byte record: wall clock timestamp, code,
+pulselength, protocol and the decoded command offset (the lamp is the code
+minus the offset). JournalWriter appends records and rotates the file by
+size, like logging's RotatingFileHandler. Journal reads a file through mmap,
+so queries filter records and compute gap statistics without parsing text,
+and time ranges are found by binary search.
+
+Usage:
+    python3 rf_journal.py JOURNAL [--lamp ID] [--command NAME]
+                          [--since TIME] [--until TIME] [--gaps] [-q]
+"""
+
+import argparse
+import mmap
+import os
+import struct
+import time
+from collections import namedtuple
+from datetime import datetime
+
+MAGIC = b'RFJ1'
+# magic, header size, record size
+HEADER = struct.Struct('<4sHH8x')
+# timestamp (wall clock microseconds), code, pulselength, protocol, command
+RECORD = struct.Struct('<qIHBB')
+NO_COMMAND = 0xFF  # Code didn't decode to a known lamp
+DEFAULT_MAX_BYTES = 4 * 1024 * 1024
+DEFAULT_BACKUPS = 5
+DUPLICATE_GAP = 200000  # Frames closer than this (microseconds) repeat one press
+# Seconds between re-reading the wall clock offset; a Pi has no RTC and may
+# start logging before NTP has set its clock
+WALL_RESYNC = 60.0
+
+COMMAND_NAMES = {0: "ON_OFF", 1: "CCT", 3: "BRIGHTNESS_UP", 7: "BRIGHTNESS_DOWN"}
+
+# A journal record; command is None for codes that didn't decode
+Record = namedtuple('Record', ['timestamp', 'code', 'pulselength', 'protocol', 'command'])
+
+
+def lamp_of(record):
+    """Lamp ID a record was addressed to, or None."""
+    if record.command is None:
+        return None
+    return record.code - record.command
+
+
+def wall_offset():
+    """Microseconds to add to a perf_counter timestamp for wall clock time."""
+    return int(time.time() * 1e6 - time.perf_counter() * 1e6)
+
+
+def journal_files(path):
+    """The journal and its rotated backups, oldest first."""
+    backups = []
+    n = 1
+    while os.path.exists(f"{path}.{n}"):
+        backups.append(f"{path}.{n}")
+        n += 1
+    files = list(reversed(backups))
+    if os.path.exists(path):
+        files.append(path)
+    return files
+
+
+class JournalWriter:
+    """Appends frames to a journal, rotating it when it reaches max_bytes."""
+
+    def __init__(self, path, max_bytes=DEFAULT_MAX_BYTES, backups=DEFAULT_BACKUPS):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.file = None
+        self.size = 0
+        self.written = 0
+        # Newest timestamp in the file; records never go back past it, so
+        # the file stays sorted for Journal.bisect when the clock is set back
+        self.last_timestamp = None
+        # Frame timestamps are perf_counter microseconds (as rpi_rf makes
+        # them); records keep wall clock time so they survive a reboot
+        self.wall_offset = 0
+        self.synced = None
+        self.resync()
+        self._open()
+
+    def resync(self):
+        """Re-read the wall clock offset, picking up NTP setting the clock."""
+        self.wall_offset = wall_offset()
+        self.synced = time.perf_counter()
+
+    def _open(self):
+        self.file = open(self.path, 'ab')
+        self.size = self.file.seek(0, os.SEEK_END)
+        if self.size == 0:
+            self.file.write(HEADER.pack(MAGIC, HEADER.size, RECORD.size))
+            self.size = HEADER.size
+        elif (self.size - HEADER.size) % RECORD.size:
+            # Drop a record cut short by a crash so the rest stay aligned
+            self.file.truncate(self.size - (self.size - HEADER.size) % RECORD.size)
+            self.size = self.file.seek(0, os.SEEK_END)
+        self.last_timestamp = None
+        if self.size > HEADER.size:
+            with open(self.path, 'rb') as f:
+                f.seek(self.size - RECORD.size)
+                self.last_timestamp = RECORD.unpack(f.read(RECORD.size))[0]
+
+    def rotate(self):
+        self.file.close()
+        for n in range(self.backups - 1, 0, -1):
+            if os.path.exists(f"{self.path}.{n}"):
+                os.replace(f"{self.path}.{n}", f"{self.path}.{n + 1}")
+        if self.backups:
+            os.replace(self.path, f"{self.path}.1")
+        else:
+            os.remove(self.path)
+        self._open()
+
+    def append(self, frame, command=None):
+        """Record a received frame.
+
+        Args:
+            frame: Anything with code, timestamp, pulselength and protocol
+            command: Decoded command offset, or None if the code is unknown
+        """
+        if self.size + RECORD.size > self.max_bytes:
+            self.rotate()
+        if time.perf_counter() - self.synced >= WALL_RESYNC:
+            self.resync()
+        timestamp = int(frame.timestamp) + self.wall_offset
+        if self.last_timestamp is not None and timestamp < self.last_timestamp:
+            timestamp = self.last_timestamp
+        self.last_timestamp = timestamp
+        self.file.write(RECORD.pack(timestamp, int(frame.code),
+                                    min(int(frame.pulselength or 0), 0xFFFF),
+                                    int(frame.protocol or 0),
+                                    NO_COMMAND if command is None else command))
+        self.file.flush()
+        self.size += RECORD.size
+        self.written += 1
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+class Journal:
+    """Read-only, memory-mapped view of one journal file."""
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            magic, header_size, record_size = HEADER.unpack(f.read(HEADER.size))
+            if magic != MAGIC or record_size != RECORD.size:
+                raise ValueError(f"{path} is not an RF journal")
+            self.offset = header_size
+            size = f.seek(0, os.SEEK_END)
+            self.count = (size - header_size) // RECORD.size
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def __len__(self):
+        return self.count
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.map.close()
+
+    @staticmethod
+    def _record(values):
+        timestamp, code, pulselength, protocol, command = values
+        return Record(timestamp, code, pulselength, protocol,
+                      None if command == NO_COMMAND else command)
+
+    def record(self, index):
+        return self._record(RECORD.unpack_from(self.map, self.offset + index * RECORD.size))
+
+    def timestamp(self, index):
+        return struct.unpack_from('<q', self.map, self.offset + index * RECORD.size)[0]
+
+    def bisect(self, timestamp):
+        """Index of the first record at or after timestamp."""
+        low, high = 0, self.count
+        while low < high:
+            mid = (low + high) // 2
+            if self.timestamp(mid) < timestamp:
+                low = mid + 1
+            else:
+                high = mid
+        return low
+
+    def records(self, start=0, stop=None):
+        """Iterate over records start..stop without copying the file."""
+        stop = self.count if stop is None else min(stop, self.count)
+        if start >= stop:
+            return
+        view = memoryview(self.map)[self.offset + start * RECORD.size:
+                                    self.offset + stop * RECORD.size]
+        try:
+            for values in RECORD.iter_unpack(view):
+                yield self._record(values)
+        finally:
+            view.release()
+
+
+def query(path, lamp=None, command=None, since=None, until=None):
+    """Records from a journal and its backups matching every given filter.
+
+    Args:
+        lamp: Lamp ID
+        command: Command offset
+        since, until: Wall clock microseconds; until is exclusive
+    """
+    for name in journal_files(path):
+        with Journal(name) as journal:
+            start = 0 if since is None else journal.bisect(since)
+            stop = None if until is None else journal.bisect(until)
+            for record in journal.records(start, stop):
+                if command is not None and record.command != command:
+                    continue
+                if lamp is not None and lamp_of(record) != lamp:
+                    continue
+                yield record
+
+
+def gap_stats(records, duplicate_gap=DUPLICATE_GAP):
+    """Statistics of the gaps between consecutive records, in microseconds."""
+    gaps = []
+    last = None
+    for record in records:
+        if last is not None:
+            gaps.append(record.timestamp - last)
+        last = record.timestamp
+    if not gaps:
+        return {'count': 0}
+    gaps.sort()
+    return {
+        'count': len(gaps),
+        'min': gaps[0],
+        'median': gaps[len(gaps) // 2],
+        'p95': gaps[min(len(gaps) - 1, int(len(gaps) * 0.95))],
+        'max': gaps[-1],
+        'duplicates': sum(1 for gap in gaps if gap < duplicate_gap),
+    }
+
+
+def parse_time(value):
+    """Epoch seconds or an ISO date/time, as wall clock microseconds."""
+    try:
+        seconds = float(value)
+    except ValueError:
+        seconds = datetime.fromisoformat(value).timestamp()
+    return int(seconds * 1e6)
+
+
+def format_record(record):
+    when = datetime.fromtimestamp(record.timestamp / 1e6).strftime('%Y-%m-%d %H:%M:%S.%f')[:-3]
+    if record.command is None:
+        decoded = "UNKNOWN"
+    else:
+        decoded = f"{lamp_of(record)} {COMMAND_NAMES.get(record.command, record.command)}"
+    return (f"{when} Code: {record.code} Pulselength: {record.pulselength} "
+            f"Protocol: {record.protocol} {decoded}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Query an RF frame journal')
+    parser.add_argument('journal', help="Journal file (rotated backups are read too)")
+    parser.add_argument('--lamp', type=int, default=None,
+                        help="Only frames for this lamp ID")
+    parser.add_argument('--command', choices=sorted(COMMAND_NAMES.values()), default=None,
+                        help="Only frames with this command")
+    parser.add_argument('--since', type=parse_time, default=None,
+                        help="Only frames at or after this time (ISO or epoch seconds)")
+    parser.add_argument('--until', type=parse_time, default=None,
+                        help="Only frames before this time (ISO or epoch seconds)")
+    parser.add_argument('--gaps', action='store_true',
+                        help="Print statistics of the gaps between matching frames")
+    parser.add_argument('-q', dest='quiet', action='store_true',
+                        help="Don't print the matching frames")
+    args = parser.parse_args()
+
+    command = None
+    if args.command is not None:
+        command = next(offset for offset, name in COMMAND_NAMES.items() if name == args.command)
+    records = query(args.journal, args.lamp, command, args.since, args.until)
+
+    count = 0
+
+    def shown(records):
+        nonlocal count
+        for record in records:
+            count += 1
+            if not args.quiet:
+                print(format_record(record))
+            yield record
+
+    stats = gap_stats(shown(records))
+    print(f"{count} frames")
+    if args.gaps:
+        if stats['count']:
+            print(f"Gaps (ms): min {stats['min'] / 1000:.1f}  median {stats['median'] / 1000:.1f}  "
+                  f"p95 {stats['p95'] / 1000:.1f}  max {stats['max'] / 1000:.1f}  "
+                  f"duplicates (<{DUPLICATE_GAP / 1000:.0f}ms) {stats['duplicates']}")
+
+
+if __name__ == "__main__":
+    main()
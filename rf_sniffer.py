@@ -11,21 +11,26 @@ This tool listens for RF signals and shows:
 Run this while the main lamp_control_mqtt.py is running to see
 if lamps echo back commands or if there's any feedback mechanism.
 
+With --summary, frames are decoded on their own thread and the terminal
+shows a summary refreshed a few times a second instead of every frame, so
+the display never falls behind the radio. --output writes every frame to a
+file in either mode.
+
 Usage:
-    python3 rf_sniffer.py [-r GPIO_PIN]
+    python3 rf_sniffer.py [-r GPIO_PIN] [--journal FILE] [--summary] [--output FILE]
 """
 
 import argparse
 import logging
+import sys
+import threading
 import time
-from time import sleep
+from collections import Counter, deque
 from datetime import datetime
 
-from RPi import GPIO
-from rpi_rf import RFDevice
-
 # Import constants from main module
 import lamp_control_mqtt as lcm
+import rf_journal
 
 logging.basicConfig(
     level=logging.INFO,
@@ -45,27 +50,25 @@ class Colors:
     BOLD = '\033[1m'
     UNDERLINE = '\033[4m'
 
-def decode_rf_code(code):
+RECENT_FRAMES = 10  # Frames listed in the summary view
+RX_QUEUE_LEN = 1024  # Decoded frames buffered for the sniffer, enough for a noise burst
+# Gaps (milliseconds) at which a repeat of a command may be an echo or response
+ECHO_GAP_MIN = 50
+ECHO_GAP_MAX = 500
+
+def decode_rf_code(code, registry=None):
     """
     Decode an RF code into lamp ID and command.
     Returns (lamp_id, lamp_name, command_offset, command_name) or None if unknown.
     """
-    # Try to match against known lamps
-    known_lamps = {
-        lcm.LIVING_ROOM_LAMP: "Living Room",
-        lcm.STUDY_LAMPS: "Study",
-        lcm.STUDY_DESK_LAMP: "Study Desk",
-        lcm.STUDY_TABLE_LAMP: "Study Table",
-    }
-    
-    for lamp_id, lamp_name in known_lamps.items():
-        # Check if this code could be from this lamp
-        if lamp_id <= code <= lamp_id + lcm.MAX_OFFSET:
-            offset = code - lamp_id
-            if offset in lcm.CMDS2NAMES:
-                return lamp_id, lamp_name, offset, lcm.CMDS2NAMES[offset]
-    
-    return None
+    # Same lookup table the main program decodes with
+    if registry is None:
+        registry = lcm.registry
+    decoded = registry.decode(code)
+    if decoded is None:
+        return None
+    info, offset = decoded
+    return info.lamp_id, info.name, offset, lcm.CMDS2NAMES[offset]
 
 def format_decoded(decoded):
     """Format decoded information with colors."""
@@ -88,11 +91,216 @@ def format_decoded(decoded):
     
     return f"{color}{lamp_name}{Colors.ENDC} - {color}{cmd_name}{Colors.ENDC}"
 
+def classify(code, gap, last_code, decoded):
+    """Flag a frame as a duplicate and/or possible echo.
+
+    Args:
+        gap: Microseconds since the previous frame, or None for the first
+
+    Returns:
+        (is_duplicate, is_echo)
+    """
+    if gap is None:
+        return False, False
+    is_duplicate = last_code == code and gap < lcm.MIN_GAP
+    # If we see a command again in quick succession, it could be:
+    # 1) button held down, 2) echo from lamp, 3) our retry
+    is_echo = decoded is not None and ECHO_GAP_MIN < gap / 1000.0 < ECHO_GAP_MAX
+    return is_duplicate, is_echo
+
+def format_line(count, frame, decoded, gap, is_duplicate, is_echo):
+    """One plain text line per frame, for the file sink."""
+    time_str = datetime.now().strftime('%Y-%m-%d %H:%M:%S.%f')[:-3]
+    if decoded is None:
+        name = "UNKNOWN"
+    else:
+        name = f"{decoded[1]} {decoded[3]}"
+    line = (f"[{count:06d}] {time_str} Code: {frame.code} TS: {frame.timestamp} "
+            f"Pulselength: {frame.pulselength} Protocol: {frame.protocol} Decoded: {name}")
+    if gap is not None:
+        line += f" Gap: {gap / 1000.0:.1f}ms"
+    if is_duplicate:
+        line += " DUPLICATE"
+    if is_echo:
+        line += " ECHO?"
+    return line + "\n"
+
+class SnifferStats:
+    """Counters behind the summary view, updated from the decode thread."""
+
+    def __init__(self, recent=RECENT_FRAMES):
+        self.lock = threading.Lock()
+        self.started = time.monotonic()
+        self.total = 0
+        self.unknown = 0
+        self.duplicates = 0
+        self.echoes = 0
+        # (lamp name, command name) -> frames
+        self.commands = Counter()
+        self.recent = deque(maxlen=recent)
+
+    def add(self, frame, decoded, gap, is_duplicate, is_echo):
+        with self.lock:
+            self.total += 1
+            if decoded is None:
+                self.unknown += 1
+            else:
+                self.commands[(decoded[1], decoded[3])] += 1
+            self.duplicates += is_duplicate
+            self.echoes += is_echo
+            self.recent.append((frame, decoded, gap, is_duplicate, is_echo))
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                'total': self.total,
+                'unknown': self.unknown,
+                'duplicates': self.duplicates,
+                'echoes': self.echoes,
+                'commands': dict(self.commands),
+                'recent': list(self.recent),
+            }
+
+def render_summary(snapshot, fps, elapsed):
+    """The summary view as one string, so the terminal is written once per refresh."""
+    lines = [
+        f"{Colors.BOLD}RF Signal Sniffer{Colors.ENDC}  up {elapsed:.0f}s  "
+        f"{Colors.BOLD}{fps:.1f}{Colors.ENDC} frames/s  total {snapshot['total']}",
+        f"Unknown {snapshot['unknown']}  "
+        f"{Colors.FAIL}Duplicates {snapshot['duplicates']}{Colors.ENDC}  "
+        f"{Colors.WARNING}Possible echoes {snapshot['echoes']}{Colors.ENDC}",
+        "",
+        f"{Colors.BOLD}{'Lamp':<20} {'Command':<24} {'Frames':>8}{Colors.ENDC}",
+    ]
+    for (lamp_name, cmd_name), count in sorted(snapshot['commands'].items()):
+        lines.append(f"{lamp_name:<20} {cmd_name:<24} {count:>8}")
+    lines += ["", f"{Colors.BOLD}Recent frames{Colors.ENDC}"]
+    for frame, decoded, gap, is_duplicate, is_echo in reversed(snapshot['recent']):
+        gap_str = f"{gap / 1000.0:8.1f}ms" if gap is not None else " " * 10
+        flags = (" DUP" if is_duplicate else "") + (" ECHO?" if is_echo else "")
+        lines.append(f"  {frame.code:>10} {gap_str}  {format_decoded(decoded)}"
+                     f"{Colors.FAIL}{flags}{Colors.ENDC}")
+    # Home the cursor and clear the screen, then draw
+    return "\033[H\033[2J" + "\n".join(lines) + "\n"
+
+def decode_frames(receiver, registry, stats, journal=None, sink=None):
+    """Decode frames into stats until the receiver is closed."""
+    last_timestamp = None
+    last_code = None
+    while True:
+        frame = receiver.get()
+        if frame is None:
+            return
+        gap = None if last_timestamp is None else frame.timestamp - last_timestamp
+        decoded = decode_rf_code(frame.code, registry)
+        is_duplicate, is_echo = classify(frame.code, gap, last_code, decoded)
+        stats.add(frame, decoded, gap, is_duplicate, is_echo)
+        if journal is not None:
+            journal.append(frame, decoded[2] if decoded is not None else None)
+        if sink is not None:
+            sink.write(format_line(stats.total, frame, decoded, gap, is_duplicate, is_echo))
+        last_timestamp = frame.timestamp
+        last_code = frame.code
+
+def run_summary(receiver, registry, stats, refresh, journal=None, sink=None):
+    """Decode on a worker thread and redraw the summary refresh times a second."""
+    thread = threading.Thread(target=decode_frames, name="sniffer-decode",
+                              args=(receiver, registry, stats, journal, sink), daemon=True)
+    thread.start()
+    last_total = 0
+    last_time = time.monotonic()
+    try:
+        while thread.is_alive():
+            time.sleep(1.0 / refresh)
+            now = time.monotonic()
+            snapshot = stats.snapshot()
+            fps = (snapshot['total'] - last_total) / (now - last_time)
+            last_total, last_time = snapshot['total'], now
+            sys.stdout.write(render_summary(snapshot, fps, now - stats.started))
+            sys.stdout.flush()
+    finally:
+        receiver.close()
+        thread.join(timeout=1)
+
+def run_verbose(receiver, registry, stats, journal=None, sink=None):
+    """Print every frame as it arrives."""
+    last_timestamp = None
+    last_code = None
+    
+    while True:
+        frame = receiver.get()
+        timestamp = frame.timestamp
+        code = frame.code
+        
+        # Calculate gap from previous signal
+        gap = None
+        gap_ms = None
+        if last_timestamp is not None:
+            gap = timestamp - last_timestamp
+            gap_ms = gap / 1000.0  # Convert to milliseconds
+        
+        # Decode the signal
+        decoded = decode_rf_code(code, registry)
+        if journal is not None:
+            journal.append(frame, decoded[2] if decoded is not None else None)
+        
+        # Check if this looks like a duplicate/echo
+        is_duplicate, is_echo = classify(code, gap, last_code, decoded)
+        stats.add(frame, decoded, gap, is_duplicate, is_echo)
+        signal_count = stats.total
+        if sink is not None:
+            sink.write(format_line(signal_count, frame, decoded, gap, is_duplicate, is_echo))
+        
+        # Format output
+        time_str = datetime.now().strftime('%H:%M:%S.%f')[:-3]
+        
+        print(f"{Colors.BOLD}[{signal_count:04d}]{Colors.ENDC} {time_str}")
+        print(f"  Code: {Colors.BOLD}{code}{Colors.ENDC}")
+        # Same terms as rf_trace.py, so live and recorded captures compare
+        print(f"  TS: {timestamp} Pulselength: {frame.pulselength} Protocol: {frame.protocol}")
+        print(f"  Decoded: {format_decoded(decoded)}")
+        
+        if gap_ms is not None:
+            gap_color = Colors.FAIL if is_duplicate else Colors.ENDC
+            print(f"  Gap: {gap_color}{gap_ms:.1f}ms{Colors.ENDC}", end="")
+            if is_duplicate:
+                print(f" {Colors.FAIL}(DUPLICATE - gap < {lcm.MIN_GAP/1000:.0f}ms){Colors.ENDC}")
+            else:
+                print()
+        
+        if is_echo:
+            print(f"  {Colors.WARNING}⚠ Possible echo/response? (gap={gap_ms:.1f}ms){Colors.ENDC}")
+        
+        print()  # Blank line between signals
+        
+        last_timestamp = timestamp
+        last_code = code
+
 def main():
     parser = argparse.ArgumentParser(description='RF Signal Sniffer')
     parser.add_argument('-r', dest='gpio_rx', type=int, default=23,
                         help="GPIO receive pin (Default: 23)")
+    parser.add_argument('-l', dest='lamps', default=lcm.DEFAULT_LAMPS,
+                        help="Lamp registry file (Default: lamps.json next to lamp_control_mqtt.py)")
+    # Same flags as lamp_control_mqtt
+    parser.add_argument('--journal', dest='journal', default=None,
+                        help="Append every received frame to this binary journal (see rf_journal.py)")
+    parser.add_argument('--journal-size', dest='journal_size', type=float, default=4,
+                        help="Rotate the journal at this many megabytes (Default: 4)")
+    parser.add_argument('--summary', action='store_true',
+                        help="Show a periodically refreshed summary instead of every frame")
+    parser.add_argument('--refresh', type=float, default=4,
+                        help="Summary refreshes per second (Default: 4)")
+    parser.add_argument('--output', default=None,
+                        help="Write every frame to this file as a line of text")
     args = parser.parse_args()
+    registry = lcm.LampRegistry.load(args.lamps)
+    journal = None
+    if args.journal:
+        journal = rf_journal.JournalWriter(args.journal, int(args.journal_size * 1024 * 1024))
+    sink = None
+    if args.output:
+        sink = open(args.output, 'a')
     
     print(f"\n{Colors.BOLD}{'='*70}{Colors.ENDC}")
     print(f"{Colors.BOLD}RF Signal Sniffer{Colors.ENDC}")
@@ -100,79 +308,32 @@ def main():
     print(f"Listening on GPIO pin {args.gpio_rx}...")
     print(f"Press Ctrl+C to exit\n")
     print(f"{Colors.BOLD}Known Lamps:{Colors.ENDC}")
-    print(f"  Living Room:  {lcm.LIVING_ROOM_LAMP}")
-    print(f"  Study:        {lcm.STUDY_LAMPS}")
-    print(f"  Study Desk:   {lcm.STUDY_DESK_LAMP}")
-    print(f"  Study Table:  {lcm.STUDY_TABLE_LAMP}")
+    for info in registry:
+        print(f"  {info.name + ':':<20} {info.lamp_id}")
     print(f"\n{Colors.BOLD}Watching for signals...{Colors.ENDC}\n")
     
-    rxdevice = RFDevice(args.gpio_rx)
+    rxdevice = lcm.make_rf_device(args.gpio_rx)
+    # Wake only when a whole code has been decoded
+    receiver = lcm.RFReceiver(rxdevice, maxlen=RX_QUEUE_LEN)
     rxdevice.enable_rx()
     
-    last_timestamp = None
-    last_code = None
-    signal_count = 0
-    
+    stats = SnifferStats()
     try:
-        while True:
-            if rxdevice.rx_code_timestamp != last_timestamp:
-                signal_count += 1
-                timestamp = rxdevice.rx_code_timestamp
-                code = rxdevice.rx_code
-                
-                # Calculate gap from previous signal
-                gap = None
-                gap_ms = None
-                if last_timestamp is not None:
-                    gap = timestamp - last_timestamp
-                    gap_ms = gap / 1000.0  # Convert to milliseconds
-                
-                # Decode the signal
-                decoded = decode_rf_code(code)
-                
-                # Check if this looks like a duplicate/echo
-                is_duplicate = False
-                if last_code == code and gap is not None and gap < lcm.MIN_GAP:
-                    is_duplicate = True
-                
-                # Format output
-                time_str = datetime.now().strftime('%H:%M:%S.%f')[:-3]
-                
-                print(f"{Colors.BOLD}[{signal_count:04d}]{Colors.ENDC} {time_str}")
-                print(f"  Code: {Colors.BOLD}{code}{Colors.ENDC}")
-                print(f"  Decoded: {format_decoded(decoded)}")
-                
-                if gap_ms is not None:
-                    gap_color = Colors.FAIL if is_duplicate else Colors.ENDC
-                    print(f"  Gap: {gap_color}{gap_ms:.1f}ms{Colors.ENDC}", end="")
-                    if is_duplicate:
-                        print(f" {Colors.FAIL}(DUPLICATE - gap < {lcm.MIN_GAP/1000:.0f}ms){Colors.ENDC}")
-                    else:
-                        print()
-                
-                # Check if this could be an echo
-                if decoded is not None and gap_ms is not None:
-                    lamp_id, lamp_name, offset, cmd_name = decoded
-                    
-                    # If we see the same command twice in quick succession,
-                    # it could be: 1) button held down, 2) echo from lamp, 3) our retry
-                    if 50 < gap_ms < 500:  # Between 50ms and 500ms
-                        print(f"  {Colors.WARNING}⚠ Possible echo/response? (gap={gap_ms:.1f}ms){Colors.ENDC}")
-                
-                print()  # Blank line between signals
-                
-                last_timestamp = timestamp
-                last_code = code
-            
-            sleep(0.0001)  # Same polling rate as main program
-    
+        if args.summary:
+            run_summary(receiver, registry, stats, args.refresh, journal, sink)
+        else:
+            run_verbose(receiver, registry, stats, journal, sink)
     except KeyboardInterrupt:
         print(f"\n{Colors.BOLD}Shutting down...{Colors.ENDC}")
-        print(f"Total signals received: {signal_count}")
+        print(f"Total signals received: {stats.total}")
     finally:
+        receiver.close()
+        if journal is not None:
+            journal.close()
+        if sink is not None:
+            sink.close()
         rxdevice.cleanup()
-        GPIO.cleanup()
+        lcm.release_gpio(args.gpio_rx)
 
 if __name__ == "__main__":
     main()
-
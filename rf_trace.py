@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+"""
+RF Trace - Decode a recorded 433 MHz edge trace offline
+
+Decodes every code in a capture of edge timestamps (and optionally pin
+levels) with the same decoder rpi_rf uses, vectorized with NumPy so an
+hour-long capture takes seconds. Prints one line per code, in the same
+code/timestamp/pulselength/protocol terms rf_sniffer.py shows, followed by
+per-protocol pulselength statistics and a histogram of pulse widths, which
+help pick a pulselength and protocol for transmitting.
+
+Trace formats:
+    .npz       arrays 'timestamps' and optionally 'levels'
+    .npy       timestamps, or an (N, 2) array of timestamps and levels
+    otherwise  text with a timestamp and optionally a level on each line
+
+Usage:
+    python3 rf_trace.py TRACE [-q] [--pulselength 161] [--tolerance 80]
+"""
+
+import argparse
+import sys
+import time
+
+import numpy as np
+
+import rf_edges
+
+# Pulse widths longer than this many pulselengths go in the last histogram bin
+MAX_WIDTH = 40
+
+
+def load_trace(path):
+    """Read a trace file.
+
+    Returns:
+        (timestamps, levels); levels is None if the trace has none
+    """
+    if path.endswith('.npz'):
+        with np.load(path) as data:
+            levels = data['levels'] if 'levels' in data else None
+            return data['timestamps'], levels
+    if path.endswith('.npy'):
+        data = np.load(path)
+    else:
+        delimiter = ',' if path.endswith('.csv') else None
+        data = np.loadtxt(path, dtype=np.int64, delimiter=delimiter, ndmin=1)
+    if data.ndim == 2:
+        return data[:, 0], data[:, 1]
+    return data, None
+
+
+def pulse_widths(timestamps, levels=None, pulselength=350):
+    """Histogram of pulse widths in whole pulselengths.
+
+    Args:
+        levels: When given, high and low pulses are counted apart
+
+    Returns:
+        (high counts, low counts) indexed by width, or (all counts, None)
+    """
+    timestamps = np.asarray(timestamps, dtype=np.int64)
+    if levels is not None:
+        levels = np.asarray(levels)
+        changed = np.ones(len(levels), dtype=bool)
+        changed[1:] = levels[1:] != levels[:-1]
+        timestamps = timestamps[changed]
+        levels = levels[changed]
+    widths = np.rint(np.diff(timestamps) / pulselength).astype(np.int64)
+    widths = np.clip(widths, 0, MAX_WIDTH)
+    if levels is None:
+        return np.bincount(widths, minlength=MAX_WIDTH + 1), None
+    # The pulse before an edge has the level from the previous edge
+    high = levels[:-1] != 0
+    return (np.bincount(widths[high], minlength=MAX_WIDTH + 1),
+            np.bincount(widths[~high], minlength=MAX_WIDTH + 1))
+
+
+def protocol_stats(frames):
+    """Per protocol: (frames, median, min, max pulselength)."""
+    stats = {}
+    for pnum in sorted({frame.protocol for frame in frames}):
+        lengths = np.array([frame.pulselength for frame in frames if frame.protocol == pnum])
+        stats[pnum] = (len(lengths), int(np.median(lengths)), int(lengths.min()), int(lengths.max()))
+    return stats
+
+
+def format_frame(frame):
+    return f"Code: {frame.code} TS: {frame.timestamp} Pulselength: {frame.pulselength} Protocol: {frame.protocol}"
+
+
+def print_histogram(title, counts):
+    print(title)
+    peak = max(counts.max(), 1)
+    for width, count in enumerate(counts):
+        if count:
+            label = f">={width}" if width == MAX_WIDTH else f"{width}"
+            print(f"  {label:>4} x {count:>10}  {'#' * int(40 * count / peak)}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Decode a recorded RF edge trace')
+    parser.add_argument('trace', help="Trace file (.npz, .npy, or text)")
+    parser.add_argument('-q', dest='quiet', action='store_true',
+                        help="Only print the summary, not every code")
+    parser.add_argument('--pulselength', type=int, default=350,
+                        help="Pulselength for the pulse width histogram (Default: 350)")
+    parser.add_argument('--tolerance', type=int, default=rf_edges.RX_TOLERANCE,
+                        help=f"Decoder tolerance in percent (Default: {rf_edges.RX_TOLERANCE})")
+    args = parser.parse_args()
+
+    timestamps, levels = load_trace(args.trace)
+    start = time.perf_counter()
+    frames = rf_edges.decode_edges(timestamps, levels, args.tolerance)
+    elapsed = time.perf_counter() - start
+
+    if not args.quiet:
+        for frame in frames:
+            print(format_frame(frame))
+    print(f"\n{len(frames)} codes from {len(timestamps)} edges in {elapsed:.2f}s", file=sys.stderr)
+    print("\nProtocol  Frames  Pulselength (median/min/max)")
+    for pnum, (count, median, low, high) in protocol_stats(frames).items():
+        print(f"{pnum:>8}  {count:>6}  {median}/{low}/{high}")
+    high, low = pulse_widths(timestamps, levels, args.pulselength)
+    print()
+    if low is None:
+        print_histogram(f"Pulse widths (x {args.pulselength}us):", high)
+    else:
+        print_histogram(f"High pulse widths (x {args.pulselength}us):", high)
+        print_histogram(f"Low pulse widths (x {args.pulselength}us):", low)
+
+
+if __name__ == "__main__":
+    main()
@@ -4,7 +4,7 @@
 import argparse
 import signal
 import sys
-import time
+import threading
 import logging
 
 from rpi_rf import RFDevice
@@ -27,14 +27,29 @@ args = parser.parse_args()
 
 signal.signal(signal.SIGINT, exithandler)
 rfdevice = RFDevice(args.gpio)
+
+# Wake up once per decoded code instead of polling for one
+code_ready = threading.Event()
+edge_callback = rfdevice.rx_callback
+
+
+def rx_callback(gpio):
+    last = rfdevice.rx_code_timestamp
+    edge_callback(gpio)
+    if rfdevice.rx_code_timestamp != last:
+        code_ready.set()
+
+
+rfdevice.rx_callback = rx_callback
 rfdevice.enable_rx()
 timestamp = None
 logging.info("Listening for codes on GPIO " + str(args.gpio))
 while True:
+    code_ready.wait()
+    code_ready.clear()
     if rfdevice.rx_code_timestamp != timestamp:
         timestamp = rfdevice.rx_code_timestamp
         logging.info(str(rfdevice.rx_code) +
                      " [pulselength " + str(rfdevice.rx_pulselength) +
                      ", protocol " + str(rfdevice.rx_proto) + "]" + str(timestamp))
-    time.sleep(0.0001)
 rfdevice.cleanup()
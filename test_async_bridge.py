@@ -0,0 +1,316 @@
+"""
+Tests for async_bridge.py
+
+Run with: pytest test_async_bridge.py -v
+"""
+
+import asyncio
+import socket
+import threading
+import time
+from unittest.mock import Mock, patch
+
+import pytest
+
+import async_bridge
+import lamp_control_mqtt as lcm
+
+
+@pytest.fixture
+def loop():
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    yield loop
+    loop.close()
+    asyncio.set_event_loop(None)
+
+
+@pytest.fixture
+def radio():
+    """Lamps on two transmitters; transmit() records (code, thread) and takes 50ms."""
+    registry = lcm.LampRegistry([(lcm.LIVING_ROOM_LAMP, "LIVING_ROOM_LAMP", [17]),
+                                 (lcm.STUDY_DESK_LAMP, "STUDY_DESK_LAMP", [27]),
+                                 (lcm.STUDY_TABLE_LAMP, "STUDY_TABLE_LAMP", [27])])
+    sent = []
+
+    def transmit(code):
+        sent.append((code, threading.current_thread().name))
+        time.sleep(0.05)
+
+    with patch('lamp_control_mqtt.registry', registry), \
+            patch('lamp_control_mqtt.transmit', side_effect=transmit), \
+            patch('lamp_control_mqtt.RF_DELAY', 0), \
+            patch('lamp_control_mqtt.state_publisher', None):
+        yield sent
+
+
+def make_lamp(lamp_id, on=False, brightness=0):
+    lamp = lcm.joofo_lamp(lamp_id, Mock())
+    lamp.on = on
+    lamp.brightness = brightness
+    return lamp
+
+
+class TestAsyncTxScheduler:
+    """Test the coroutine TX scheduler."""
+
+    def scheduler(self, loop):
+        executor = async_bridge.ThreadPoolExecutor(max_workers=2, thread_name_prefix="rf-tx")
+        scheduler = async_bridge.AsyncTxScheduler(loop, executor)
+        scheduler.start()
+        return scheduler
+
+    def finish(self, loop, scheduler):
+        scheduler.stop()
+        loop.run_until_complete(asyncio.gather(*scheduler.tasks, return_exceptions=True))
+        scheduler.executor.shutdown()
+
+    def test_state_changes_on_loop(self, loop, radio):
+        """Test lamp state is published from the loop thread, codes sent from the executor."""
+        lamp = make_lamp(lcm.LIVING_ROOM_LAMP)
+        publishers = []
+        lamp.client.publish.side_effect = lambda *a, **k: publishers.append(threading.current_thread())
+        scheduler = self.scheduler(loop)
+
+        async def scenario():
+            scheduler.submit(lamp, 'on_off', "true")
+            scheduler.submit(lamp, 'cct', "")
+            await scheduler.wait_idle()
+
+        loop.run_until_complete(scenario())
+        self.finish(loop, scheduler)
+
+        assert lamp.on and lamp.color_temp == 1
+        assert publishers == [threading.current_thread()] * 2
+        assert [code for code, _ in radio] == [lcm.LIVING_ROOM_LAMP + lcm.ON_OFF_OFFSET]
+        assert radio[0][1].startswith("rf-tx")
+
+    def test_radios_in_parallel(self, loop, radio):
+        """Test frames on different transmitters are sent at the same time."""
+        lamps = [make_lamp(lcm.LIVING_ROOM_LAMP), make_lamp(lcm.STUDY_DESK_LAMP)]
+        traces = [lcm.CommandTrace('reset', lamp.lamp_id) for lamp in lamps]
+        scheduler = self.scheduler(loop)
+
+        async def scenario():
+            for lamp, trace in zip(lamps, traces):
+                for _ in range(3):
+                    scheduler.submit(lamp, 'cct', "")
+                scheduler.submit(lamp, 'reset', "", trace)
+            await scheduler.wait_idle()
+
+        loop.run_until_complete(scenario())
+        self.finish(loop, scheduler)
+
+        # A reset is three frames on each radio
+        assert len(radio) == 6
+        assert set(scheduler.queues) == {17, 27}
+        first, second = (trace.tx for trace in traces)
+        assert len(first) == len(second) == 3
+        assert any(start < other_end and other_start < end
+                   for start, end in first for other_start, other_end in second)
+
+    def test_brightness_ramp_preempted(self, loop, radio):
+        """Test turning off interrupts a ramp between frames, and the ramp isn't resumed."""
+        lamp = make_lamp(lcm.LIVING_ROOM_LAMP, on=True, brightness=10)
+        scheduler = self.scheduler(loop)
+
+        async def scenario():
+            scheduler.submit(lamp, 'brightness', "90")
+            await asyncio.sleep(0.12)
+            scheduler.submit(lamp, 'on_off', "false")
+            await scheduler.wait_idle()
+
+        loop.run_until_complete(scenario())
+        self.finish(loop, scheduler)
+
+        codes = [code for code, _ in radio]
+        assert codes[-1] == lcm.LIVING_ROOM_LAMP + lcm.ON_OFF_OFFSET
+        assert 1 < codes.count(lcm.LIVING_ROOM_LAMP + lcm.BRIGHTNESS_UP_OFFSET) < 10
+        assert not lamp.on
+
+    def test_same_frames_as_threaded_engine(self, loop, radio):
+        """Test a brightness change sends exactly what set_brightness_level sends."""
+        threaded = make_lamp(lcm.LIVING_ROOM_LAMP, on=True, brightness=30)
+        with patch('lamp_control_mqtt.send_rf') as mock_send:
+            threaded.set_brightness_level(75)
+        expected = [c.args[0] for c in mock_send.call_args_list]
+
+        lamp = make_lamp(lcm.LIVING_ROOM_LAMP, on=True, brightness=30)
+        scheduler = self.scheduler(loop)
+
+        async def scenario():
+            scheduler.submit(lamp, 'brightness', "75")
+            await scheduler.wait_idle()
+
+        loop.run_until_complete(scenario())
+        self.finish(loop, scheduler)
+
+        assert [code for code, _ in radio] == expected
+        assert lamp.brightness == threaded.brightness
+
+
+class FakeReceiver:
+    def __init__(self, frames):
+        self.frames = list(frames)
+        self.closed = False
+
+    def get(self, timeout=None):
+        if self.frames:
+            return self.frames.pop(0)
+        while not self.closed:
+            time.sleep(0.01)
+        return None
+
+    def close(self):
+        self.closed = True
+
+
+class TestAsyncBridge:
+    """Test frame delivery and shutdown."""
+
+    def test_frames_handled_on_loop(self, loop):
+        frames = [lcm.RxFrame(lcm.LIVING_ROOM_LAMP, 1000000, 350, 1),
+                  lcm.RxFrame(lcm.LIVING_ROOM_LAMP, 1050000, 350, 1)]
+        handled = []
+
+        def handler(code, timestamp, gap):
+            handled.append((code, gap, threading.current_thread()))
+            if len(handled) == len(frames):
+                bridge.stop()
+
+        bridge = async_bridge.AsyncBridge(loop, FakeReceiver(frames), handler)
+        loop.run_until_complete(asyncio.wait_for(bridge.run(), 5))
+
+        assert [(code, gap) for code, gap, _ in handled] == \
+            [(lcm.LIVING_ROOM_LAMP, lcm.MIN_GAP + 1), (lcm.LIVING_ROOM_LAMP, 50000)]
+        assert all(thread is threading.current_thread() for _, _, thread in handled)
+        assert bridge.receiver.closed
+
+    def test_state_publisher_uses_loop_timer(self, loop):
+        client = Mock()
+        publisher = async_bridge.LoopStatePublisher(client, 0.05, loop)
+
+        async def scenario():
+            for level in (10, 20, 30):
+                publisher.publish("getBrightness", level)
+            await asyncio.sleep(0.1)
+
+        loop.run_until_complete(scenario())
+        client.publish.assert_called_once_with("getBrightness", payload="30", qos=0, retain=True)
+
+    def test_burst_released_by_loop_timer(self, loop):
+        lamp = make_lamp(lcm.LIVING_ROOM_LAMP, on=True, brightness=50)
+        aggregator = async_bridge.LoopBurstAggregator(loop, gap=0.05)
+
+        async def scenario():
+            for _ in range(3):
+                aggregator.add(lamp, lcm.BRIGHTNESS_UP_OFFSET)
+            await asyncio.sleep(0.15)
+
+        with patch('lamp_control_mqtt.state_publisher', None):
+            loop.run_until_complete(scenario())
+
+        assert aggregator.bursts == {}
+        lamp.client.publish.assert_called_once()
+
+
+class QueueingClient:
+    """paho Client that, like paho, only queues packets until loop_write()."""
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.outbox = []
+
+    def reconnect_delay_set(self, min_delay, max_delay):
+        pass
+
+    def queue(self, packet):
+        self.outbox.append(packet)
+        self.on_socket_register_write(self, None, self.sock)
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        self.queue(f"PUBLISH {topic} {payload}\n".encode())
+
+    def disconnect(self):
+        self.queue(b"DISCONNECT\n")
+
+    def loop_stop(self):
+        pass
+
+    def want_write(self):
+        return bool(self.outbox)
+
+    def loop_write(self):
+        if self.outbox:
+            self.sock.send(self.outbox.pop(0))
+        if not self.outbox:
+            self.on_socket_unregister_write(self, None, self.sock)
+        return 0
+
+
+class TestMqttSocket:
+    """Test paho's socket is serviced by the loop."""
+
+    def test_reads_and_writes_on_loop(self, loop):
+        ours, theirs = socket.socketpair()
+        client = Mock()
+        client.loop_misc.return_value = 0
+        async_bridge.MqttSocket(client, loop)
+
+        async def scenario():
+            client.on_socket_open(client, None, ours)
+            client.on_socket_register_write(client, None, ours)
+            theirs.send(b"x")
+            await asyncio.sleep(0.05)
+            client.on_socket_unregister_write(client, None, ours)
+            client.on_socket_close(client, None, ours)
+
+        with patch('lamp_control_mqtt.mqtt', Mock(MQTT_ERR_SUCCESS=0)):
+            loop.run_until_complete(scenario())
+        ours.close()
+        theirs.close()
+
+        assert client.loop_read.called
+        assert client.loop_write.called
+        assert client.loop_misc.called
+
+    def test_reconnects_until_broker_is_back(self, loop):
+        client = Mock()
+        client.reconnect.side_effect = [ConnectionRefusedError("broker down"), 0]
+        mqtt_socket = async_bridge.MqttSocket(client, loop, min_delay=0.01, max_delay=0.05)
+        client.reconnect_delay_set.assert_called_once_with(0.01, 0.05)
+
+        async def scenario():
+            client.on_disconnect(client, None, 1)
+            # Disconnects while already reconnecting don't start another retry loop
+            client.on_disconnect(client, None, 1)
+            await mqtt_socket.reconnecting
+
+        loop.run_until_complete(asyncio.wait_for(scenario(), 5))
+        assert client.reconnect.call_count == 2
+
+    def test_shutdown_writes_last_messages(self, loop):
+        """Test the last state and the DISCONNECT reach the socket before the loop stops."""
+        ours, theirs = socket.socketpair()
+        client = QueueingClient(ours)
+        mqtt_socket = async_bridge.MqttSocket(client, loop)
+        publisher = async_bridge.LoopStatePublisher(client, 10, loop)
+        scheduler = async_bridge.AsyncTxScheduler(loop, None)
+        publisher.publish("getBrightness", 42)
+
+        with patch('lamp_control_mqtt.mqtt', Mock(MQTT_ERR_SUCCESS=0)), \
+                patch('lamp_control_mqtt.tx_worker', scheduler), \
+                patch('lamp_control_mqtt.state_publisher', publisher):
+            loop.run_until_complete(async_bridge.shutdown(client, mqtt_socket, None, None))
+        ours.close()
+        written = theirs.recv(4096)
+        theirs.close()
+
+        assert written == b"PUBLISH getBrightness 42\nDISCONNECT\n"
+
+    def test_clean_disconnect_not_retried(self, loop):
+        client = Mock()
+        mqtt_socket = async_bridge.MqttSocket(client, loop)
+        client.on_disconnect(client, None, 0)
+        assert mqtt_socket.reconnecting is None
+        assert not client.reconnect.called
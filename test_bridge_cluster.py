@@ -0,0 +1,248 @@
+"""
+Tests for bridge_cluster.py
+
+Run with: pytest test_bridge_cluster.py -v
+"""
+
+import json
+from unittest.mock import patch
+
+import pytest
+
+import bridge_cluster
+
+LAMPS = [3513633, 13470497, 9513633, 4513633]
+
+
+def lamp_of(code):
+    for lamp_id in LAMPS:
+        if 0 <= code - lamp_id <= 7:
+            return lamp_id
+    return None
+
+
+class FakeMessage:
+    def __init__(self, topic, payload):
+        self.topic = topic
+        self.payload = payload.encode("utf-8")
+
+
+class FakeBroker:
+    """Delivers every publish to every node straight away, keeping retained ones."""
+
+    def __init__(self):
+        self.nodes = []
+        self.retained = {}
+        self.published = []
+
+    def client(self):
+        return FakeClient(self)
+
+    def publish(self, topic, payload, retain):
+        self.published.append((topic, payload))
+        if retain:
+            self.retained[topic] = payload
+        for node in self.nodes:
+            node.on_message(None, None, FakeMessage(topic, payload))
+
+
+class FakeClient:
+    def __init__(self, broker):
+        self.broker = broker
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        self.broker.publish(topic, payload, retain)
+
+
+class Clock:
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def cluster():
+    """Two started nodes on one broker; handled frames are recorded per node."""
+    broker = FakeBroker()
+    clock = Clock()
+    handled = {}
+    nodes = {}
+    for name in ("pi-a", "pi-b"):
+        handled[name] = []
+        node = bridge_cluster.ClusterNode(
+            broker.client(), name, lambda code, ts, gap, name=name: handled[name].append((code, gap)),
+            lamp_of, clock=clock)
+        # As if both nodes' clocks were exactly in step
+        node.wall_offset = 0
+        broker.nodes.append(node)
+        nodes[name] = node
+    for node in nodes.values():
+        node.send_heartbeat()
+    return broker, clock, nodes, handled
+
+
+def owned_by(nodes, name):
+    return [lamp_id for lamp_id in LAMPS if nodes[name].owner(lamp_id) == name]
+
+
+class TestRendezvousOwner:
+    """Test picking one owner per lamp."""
+
+    def test_every_lamp_has_one_owner(self):
+        nodes = ["pi-a", "pi-b", "pi-c"]
+        owners = [bridge_cluster.rendezvous_owner(lamp_id, nodes) for lamp_id in range(300)]
+        assert set(owners) == set(nodes)
+        # Order of the membership list doesn't matter
+        assert owners == [bridge_cluster.rendezvous_owner(lamp_id, list(reversed(nodes)))
+                          for lamp_id in range(300)]
+
+    def test_removing_a_node_moves_only_its_lamps(self):
+        nodes = ["pi-a", "pi-b", "pi-c"]
+        before = {lamp_id: bridge_cluster.rendezvous_owner(lamp_id, nodes) for lamp_id in range(300)}
+        after = {lamp_id: bridge_cluster.rendezvous_owner(lamp_id, ["pi-a", "pi-c"])
+                 for lamp_id in range(300)}
+        assert all(after[lamp_id] == owner for lamp_id, owner in before.items() if owner != "pi-b")
+
+    def test_no_nodes(self):
+        assert bridge_cluster.rendezvous_owner(1, []) is None
+
+
+class TestFrameDeduplicator:
+    """Test merging frames heard by several receivers."""
+
+    def test_same_frame_from_two_nodes(self):
+        dedupe = bridge_cluster.FrameDeduplicator(window=50000)
+        assert dedupe.accept("pi-a", 100, 1000000)
+        assert not dedupe.accept("pi-b", 100, 1012000)
+        assert dedupe.duplicates == 1
+
+    def test_held_button_frames_not_merged(self):
+        """Test successive frames from one receiver all count."""
+        dedupe = bridge_cluster.FrameDeduplicator(window=50000)
+        assert all(dedupe.accept("pi-a", 103, 1000000 + 10000 * i) for i in range(5))
+
+    def test_each_frame_absorbs_one_per_node(self):
+        dedupe = bridge_cluster.FrameDeduplicator(window=50000)
+        frames = [1000000 + 90000 * i for i in range(4)]
+        assert all(dedupe.accept("pi-a", 103, ts) for ts in frames)
+        # The other receiver's copies, a little late, are all duplicates
+        assert not any(dedupe.accept("pi-b", 103, ts + 20000) for ts in frames)
+        assert dedupe.duplicates == 4
+
+    def test_outside_window_or_other_code(self):
+        dedupe = bridge_cluster.FrameDeduplicator(window=50000)
+        assert dedupe.accept("pi-a", 100, 1000000)
+        assert dedupe.accept("pi-b", 100, 1060000)
+        assert dedupe.accept("pi-b", 101, 1000000)
+
+    def test_old_frames_forgotten(self):
+        dedupe = bridge_cluster.FrameDeduplicator(window=50000)
+        for i in range(1000):
+            dedupe.accept("pi-a", 100, 2 * bridge_cluster.DEDUPE_HISTORY * i)
+        assert len(dedupe.recent) == 1
+
+
+class TestClusterNode:
+    """Test nodes sharing frames and lamps over the broker."""
+
+    def test_lamps_split_between_nodes(self, cluster):
+        _, _, nodes, _ = cluster
+        assert nodes["pi-a"].nodes() == nodes["pi-b"].nodes() == ["pi-a", "pi-b"]
+        assert sorted(owned_by(nodes, "pi-a") + owned_by(nodes, "pi-b")) == sorted(LAMPS)
+        assert all(nodes["pi-a"].owns(lamp_id) != nodes["pi-b"].owns(lamp_id) for lamp_id in LAMPS)
+
+    def test_frame_heard_by_both_handled_once(self, cluster):
+        _, _, nodes, handled = cluster
+        for lamp_id in LAMPS:
+            nodes["pi-a"].local_frame(lamp_id, 5000000, 0)
+            nodes["pi-b"].local_frame(lamp_id, 5010000, 0)
+        assert sorted(code for code, _ in handled["pi-a"] + handled["pi-b"]) == sorted(LAMPS)
+        assert {code for code, _ in handled["pi-a"]} == set(owned_by(nodes, "pi-a"))
+
+    def test_frame_heard_by_one_reaches_owner(self, cluster):
+        _, _, nodes, handled = cluster
+        lamp_id = owned_by(nodes, "pi-a")[0]
+        nodes["pi-b"].local_frame(lamp_id + 3, 5000000, 0)
+        assert handled == {"pi-a": [(lamp_id + 3, bridge_cluster.MIN_GAP + 1)], "pi-b": []}
+        assert nodes["pi-a"].remote == 1
+
+    def test_gap_across_receivers(self, cluster):
+        """Test a repeat of a toggle heard by the other node still looks like a repeat."""
+        _, _, nodes, handled = cluster
+        lamp_id = owned_by(nodes, "pi-a")[0]
+        nodes["pi-a"].local_frame(lamp_id, 5000000, 0)
+        nodes["pi-b"].local_frame(lamp_id, 5100000, 0)
+        assert [gap for _, gap in handled["pi-a"]] == [bridge_cluster.MIN_GAP + 1, 100000]
+
+    def test_unknown_codes_handled_locally(self, cluster):
+        _, _, nodes, handled = cluster
+        nodes["pi-b"].local_frame(42, 5000000, 123)
+        assert handled == {"pi-a": [], "pi-b": [(42, 123)]}
+
+    def test_failover_on_missed_heartbeats(self, cluster):
+        broker, clock, nodes, _ = cluster
+        clock.now += bridge_cluster.MISSED_HEARTBEATS * bridge_cluster.HEARTBEAT_INTERVAL
+        nodes["pi-a"].send_heartbeat()
+        assert nodes["pi-a"].nodes() == ["pi-a"]
+        assert all(nodes["pi-a"].owns(lamp_id) for lamp_id in LAMPS)
+
+    def test_skewed_heartbeat_clock(self, cluster):
+        """Test liveness goes by when heartbeats arrive, not the sender's clock."""
+        broker, clock, nodes, _ = cluster
+        for skew in (-3600, 3600):
+            broker.publish(nodes["pi-b"].topic("nodes"),
+                           json.dumps({'node': "pi-b", 'state': "online", 'time': clock.now + skew}),
+                           retain=True)
+            assert nodes["pi-a"].nodes() == ["pi-a", "pi-b"]
+        clock.now += bridge_cluster.MISSED_HEARTBEATS * bridge_cluster.HEARTBEAT_INTERVAL
+        assert nodes["pi-a"].nodes() == ["pi-a"]
+
+    def test_failover_on_last_will(self, cluster):
+        broker, _, nodes, _ = cluster
+        topic, payload = nodes["pi-b"].will()
+        broker.publish(topic, payload, retain=True)
+        assert nodes["pi-a"].nodes() == ["pi-a"]
+        assert json.loads(broker.retained[topic])['state'] == "offline"
+
+    def test_retained_heartbeats_seen_on_join(self, cluster):
+        broker, clock, nodes, _ = cluster
+        late = bridge_cluster.ClusterNode(broker.client(), "pi-c", lambda *frame: None,
+                                          lamp_of, clock=clock)
+        for topic, payload in broker.retained.items():
+            late.on_message(None, None, FakeMessage(topic, payload))
+        assert late.nodes() == ["pi-a", "pi-b", "pi-c"]
+
+    def test_follows_wall_clock_step(self, cluster):
+        """Test shared frames pick up the clock being set after the node started."""
+        broker, _, nodes, _ = cluster
+        nodes["pi-a"].synced -= bridge_cluster.WALL_RESYNC
+        with patch('bridge_cluster.wall_offset', return_value=10 ** 15):
+            nodes["pi-a"].local_frame(42, 5000000, 0)
+        topic, payload = broker.published[-1]
+        assert topic == nodes["pi-a"].topic("frames")
+        assert json.loads(payload)['timestamp'] == 10 ** 15 + 5000000
+
+    def test_owner_transmission_heard_by_other_node(self, cluster):
+        """Test the owner doesn't act on its own frame reported by another node."""
+        _, _, nodes, handled = cluster
+        lamp_id = owned_by(nodes, "pi-a")[0]
+        sent = {lamp_id + 1}
+        nodes["pi-a"].own_frame = lambda code: code in sent
+        # pi-a's receiver dropped its copy; pi-b only hears the frame on the air
+        nodes["pi-b"].local_frame(lamp_id + 1, 5000000, 0)
+        nodes["pi-b"].local_frame(lamp_id + 1, 5090000, 0)
+        assert handled == {"pi-a": [], "pi-b": []}
+        assert nodes["pi-a"].echoes == 2
+        # A remote press heard by pi-b still reaches the owner
+        nodes["pi-b"].local_frame(lamp_id, 6000000, 0)
+        assert [code for code, _ in handled["pi-a"]] == [lamp_id]
+
+    def test_ignores_own_messages(self, cluster):
+        _, _, nodes, handled = cluster
+        lamp_id = owned_by(nodes, "pi-a")[0]
+        nodes["pi-a"].local_frame(lamp_id, 5000000, 0)
+        # Our frame comes back from the broker but isn't handled again
+        assert len(handled["pi-a"]) == 1
+        assert nodes["pi-a"].remote == 0
@@ -0,0 +1,108 @@
+"""
+Tests for lamp_calibration.py
+
+Run with: pytest test_lamp_calibration.py -v
+"""
+
+import json
+from unittest.mock import patch
+
+import pytest
+
+import lamp_calibration as cal
+import lamp_control_mqtt as lcm
+import virtual_radio as vr
+
+LAMP = lcm.LIVING_ROOM_LAMP
+
+
+@pytest.fixture
+def radio():
+    """A simulated-time virtual radio the bridge transmits on."""
+    medium = vr.RadioMedium(clock=vr.SimClock(), seed=1)
+    with patch('lamp_control_mqtt.radio_medium', medium), \
+            patch('lamp_control_mqtt.transmitter', None), \
+            patch('lamp_control_mqtt.RF_DELAY', 0):
+        yield medium
+
+
+class TestFitting:
+    """Test readings are turned into steps."""
+
+    def test_parse_light(self):
+        assert cal.parse_light(b"12.5") == 12.5
+        assert cal.parse_light('{"illuminance": 40, "battery": 90}', 'illuminance') == 40
+        assert cal.parse_light('{"battery": 90}', 'illuminance') is None
+        assert cal.parse_light("dark") is None
+
+    def test_fit_ramp(self):
+        changes = [True, True, False, True, True, False, False, False]
+        assert cal.fit_ramp(changes) == cal.Ramp(8, 4, 1)
+
+    def test_changed_is_relative(self):
+        assert cal.changed(100, 102, 0.01)
+        assert not cal.changed(100, 100.5, 0.01)
+        assert not cal.changed(0, 0, 0.01)
+
+    def test_fit_padding(self):
+        assert cal.fit_padding(0, 36) == cal.PADDING_MARGIN
+        assert cal.fit_padding(0.1, 36) == 4 + cal.PADDING_MARGIN
+
+
+class TestCalibrateBridge:
+    """Test stepping a simulated lamp from the bridge."""
+
+    def test_measures_levels(self, radio):
+        lamp = vr.SimulatedLamp(LAMP, radio, levels=30)
+        up, down, padding = cal.calibrate_bridge(LAMP, cal.SimulatedLightSensor(lamp), 0, 0.01)
+        assert (up, down, padding) == (30, 30, cal.PADDING_MARGIN)
+        assert lamp.on and lamp.level == 1
+
+    def test_lost_frames_raise_padding(self, radio):
+        radio.loss = 0.1
+        lamp = vr.SimulatedLamp(LAMP, radio)
+        up, down, padding = cal.calibrate_bridge(LAMP, cal.SimulatedLightSensor(lamp), 0, 0.01)
+        assert (up, down) == (lcm.BR_LEVELS, lcm.BR_LEVELS)
+        assert padding > cal.PADDING_MARGIN
+
+    def test_no_reading(self, radio):
+        with pytest.raises(RuntimeError):
+            cal.calibrate_bridge(LAMP, cal.FileLightSensor("/nonexistent"), 0, 0.01)
+
+
+class TestCalibrateRemote:
+    """Test counting the frames of a held remote button."""
+
+    def test_counts_only_the_button(self, radio):
+        receiver = lcm.RFReceiver(vr.VirtualRFDevice(23, radio))
+        receiver.device.enable_rx()
+        remote = vr.VirtualRemote(radio)
+        for _ in range(6):
+            radio.wait(remote.press(LAMP, lcm.BRIGHTNESS_UP_OFFSET).end)
+        radio.wait(remote.press(lcm.STUDY_DESK_LAMP, lcm.BRIGHTNESS_UP_OFFSET).end)
+        radio.flush()
+        assert cal.count_remote(receiver, LAMP + lcm.BRIGHTNESS_UP_OFFSET, 0.5, 0.05) == 30
+
+    def test_nothing_heard(self, radio):
+        receiver = lcm.RFReceiver(vr.VirtualRFDevice(23, radio))
+        assert cal.count_remote(receiver, LAMP + lcm.BRIGHTNESS_UP_OFFSET, 0.05, 0.05) == 0
+
+
+class TestSaveSteps:
+    """Test the measured steps end up in the lamps file."""
+
+    def test_round_trip(self, tmp_path):
+        path = tmp_path / "lamps.json"
+        path.write_text(json.dumps({"lamps": [{"id": LAMP, "name": "LIVING_ROOM_LAMP"},
+                                              {"id": lcm.STUDY_DESK_LAMP, "name": "DESK"}]}))
+        steps = lcm.StepTable(30, 32, 28, 31, 2)
+        cal.save_steps(str(path), LAMP, steps)
+        registry = lcm.LampRegistry.load(str(path))
+        assert registry.lamps[LAMP].steps == steps
+        assert registry.lamps[lcm.STUDY_DESK_LAMP].steps == lcm.DEFAULT_STEPS
+
+    def test_unknown_lamp(self, tmp_path):
+        path = tmp_path / "lamps.json"
+        path.write_text(json.dumps({"lamps": []}))
+        with pytest.raises(ValueError):
+            cal.save_steps(str(path), LAMP, lcm.DEFAULT_STEPS)
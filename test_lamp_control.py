@@ -4,29 +4,49 @@ Tests for lamp_control_mqtt.py
 Run with: pytest test_lamp_control.py -v
 """
 
+import json
+import logging
+import math
+import os
+
 import pytest
-from unittest.mock import Mock, MagicMock, patch, call
+from unittest.mock import Mock, patch, call
+import subprocess
 import sys
-
-# Mock hardware and MQTT dependencies before importing
-sys.modules['RPi'] = MagicMock()
-sys.modules['RPi.GPIO'] = MagicMock()
-sys.modules['rpi_rf'] = MagicMock()
-sys.modules['paho'] = MagicMock()
-sys.modules['paho.mqtt'] = MagicMock()
-sys.modules['paho.mqtt.client'] = MagicMock()
-
-# Now we can import the module
-# We need to mock argparse to avoid it trying to parse test runner args
-with patch('argparse.ArgumentParser.parse_args') as mock_args:
-    mock_args.return_value = Mock(
-        code=None,
-        gpio_tx=4,
-        gpio_rx=23,
-        pulselength=None,
-        protocol=None
-    )
-    import lamp_control_mqtt as lcm
+import threading
+import time
+
+import lamp_control_mqtt as lcm
+
+
+class TestImport:
+    """Test importing the bridge has no side effects."""
+
+    def test_import_is_side_effect_free(self):
+        """Test a fresh import parses no arguments and loads no hardware, MQTT or logging."""
+        script = ("import logging, sys\n"
+                  "import lamp_control_mqtt as lcm\n"
+                  "loaded = [m for m in ('paho', 'RPi', 'rpi_rf', 'pigpio', 'numpy') if m in sys.modules]\n"
+                  "assert not loaded, loaded\n"
+                  "assert not logging.getLogger().handlers\n"
+                  "assert lcm.args.gpio_tx == 4 and lcm.args.code is None\n")
+        subprocess.run([sys.executable, '-c', script, '-c', '42', '--bogus'],
+                       cwd=os.path.dirname(os.path.abspath(lcm.__file__)), check=True)
+
+    def test_init_parses_command_line(self):
+        saved = lcm.args
+        try:
+            paho = Mock()
+            with patch('lamp_control_mqtt.logging.basicConfig'), \
+                    patch.dict(sys.modules, {'paho': paho, 'paho.mqtt': paho.mqtt,
+                                             'paho.mqtt.client': paho.mqtt.client}):
+                args = lcm.init(['-g', '17', '--state-file', ''])
+            assert lcm.args is args
+            assert args.gpio_tx == 17 and args.state_file == ""
+            assert lcm.mqtt is paho.mqtt.client
+        finally:
+            lcm.args = saved
+            lcm.mqtt = None
 
 
 class TestConstants:
@@ -85,12 +105,11 @@ class TestJoofoLamp:
         assert lamp.reset == False
         assert lamp.color_temp == 0
     
-    def test_lamp_registers_callbacks(self, mock_client):
-        """Test lamp registers MQTT callbacks on init."""
+    def test_lamp_registers_no_callbacks(self, mock_client):
+        """Test lamps leave MQTT dispatch to the topic router."""
         lamp = lcm.joofo_lamp(lcm.LIVING_ROOM_LAMP, mock_client)
         
-        # Should register 4 callbacks (reset + 3 lamp-specific)
-        assert mock_client.message_callback_add.call_count == 4
+        mock_client.message_callback_add.assert_not_called()
     
     def test_on_off_toggle(self, lamp, mock_client):
         """Test on/off toggling."""
@@ -209,30 +228,148 @@ class TestJoofoLamp:
             # At least 5 extra calls should happen
             assert mock_send.call_count >= 5
 
-    def test_set_brightness_low_sends_extra_commands(self, lamp):
-        """Test setting brightness to 3 or below sends 5 extra BRDOWN commands."""
+    def test_set_brightness_low_uses_low_anchor(self, lamp):
+        """Test setting brightness to 3 or below uses off-then-BRUP instead of padding."""
+        lamp.on = True
         lamp.brightness = 10
 
         with patch('lamp_control_mqtt.send_rf') as mock_send:
             lamp.set_brightness_level(3)
 
-            # Should send commands to get to 3, plus 5 extra
-            assert mock_send.call_count >= 5
+            # OFF, BRUP to the low anchor, one BRDOWN to the minimum
+            sent = [c.args[0] - lcm.LIVING_ROOM_LAMP for c in mock_send.call_args_list]
+            assert sent == [lcm.ON_OFF_OFFSET, lcm.BRIGHTNESS_UP_OFFSET,
+                            lcm.BRIGHTNESS_DOWN_OFFSET]
+            assert lamp.on == True
+            assert lamp.brightness == 1
+
+    def test_set_brightness_from_off_turns_on_low(self, lamp):
+        """Test BRUP from off is modelled as landing one step above minimum."""
+        lamp.on = False
+        lamp.brightness = 80
+
+        with patch('lamp_control_mqtt.send_rf') as mock_send:
+            lamp.set_brightness_level(5)
+
+            assert mock_send.call_count == 2
+            assert lamp.on == True
+            assert math.ceil(lamp.brightness) >= 5
+
+
+class TestBrightnessPlanner:
+    """Test the brightness planner."""
+
+    def test_step_plan_small_change(self):
+        """Test small changes are stepped."""
+        plan = lcm.plan_brightness(50, True, 60)
+
+        assert plan.strategy == 'step'
+        assert plan.commands == [lcm.BRIGHTNESS_UP_OFFSET] * 4
+        assert plan.brightness >= 60
+
+    def test_step_plan_pads_at_max(self):
+        """Test reaching 100 sends the boundary padding."""
+        plan = lcm.plan_brightness(95, True, 100)
+
+        assert plan.commands == [lcm.BRIGHTNESS_UP_OFFSET] * (2 + lcm.BOUNDARY_PADDING)
+        assert plan.brightness == lcm.HK_BR_MAX
+
+    def test_large_decrease_uses_low_anchor(self):
+        """Test 100->5 is far cheaper than stepping down."""
+        plan = lcm.plan_brightness(100, True, 5)
+        stepping, _ = lcm.step_commands(100, 5)
+
+        assert plan.strategy == 'low_anchor'
+        assert plan.commands[:2] == [lcm.ON_OFF_OFFSET, lcm.BRIGHTNESS_UP_OFFSET]
+        assert len(plan.commands) == 3
+        assert len(stepping) > 30
+        assert math.ceil(plan.brightness) >= 5
+
+    def test_low_target_lands_at_minimum(self):
+        """Test low targets from the anchor reach the minimum without padding."""
+        plan = lcm.plan_brightness(60, True, 1)
+
+        assert plan.strategy == 'low_anchor'
+        assert plan.brightness == 1
+        assert len(plan.commands) == 3
+
+    def test_plan_matches_lamp_state(self):
+        """Test the planned brightness is what the lamp ends up tracking."""
+        client = Mock()
+        for start, on, level in [(0, False, 40), (30, True, 100), (99, True, 2), (50, True, 47)]:
+            lamp = lcm.joofo_lamp(lcm.LIVING_ROOM_LAMP, client)
+            lamp.brightness = start
+            lamp.on = on
+            plan = lcm.plan_brightness(start, on, level)
+            with patch('lamp_control_mqtt.send_rf') as mock_send:
+                lamp.set_brightness_level(level)
+            assert mock_send.call_count == len(plan.commands)
+            assert lamp.brightness == pytest.approx(plan.brightness)
+
+    def test_calibrated_steps(self):
+        """Test a calibrated lamp is planned with its own steps and padding."""
+        steps = lcm.StepTable(30, 30, 25, 25, 1)
+        plan = lcm.plan_brightness(95, True, 100, steps)
+        assert plan.commands == [lcm.BRIGHTNESS_UP_OFFSET] * 3
+
+        plan = lcm.plan_brightness(0, False, 50, steps)
+        assert len(plan.commands) == 1 + math.ceil((50 - steps.low_anchor) * 30 / 100)
+
+    def test_lamp_uses_registry_steps(self):
+        """Test a lamp tracks bridge and remote frames with its calibrated increments."""
+        steps = lcm.StepTable(20, 25, 10, 50, 1)
+        registry = lcm.LampRegistry([(lcm.LIVING_ROOM_LAMP, "LIVING_ROOM_LAMP", (), (), steps)])
+        lamp = lcm.joofo_lamp(lcm.LIVING_ROOM_LAMP, Mock())
+        lamp.on, lamp.brightness = True, 50
+        with patch('lamp_control_mqtt.registry', registry), \
+                patch('lamp_control_mqtt.send_rf') as mock_send:
+            lamp.brup(False, False)
+            assert lamp.brightness == 55
+            lamp.brdown(True, False)
+            assert lamp.brightness == 53
+            lamp.brup(True, False)
+            assert lamp.brightness == 63
+            lamp.set_brightness_level(100)
+        assert lamp.brightness == 100
+        assert mock_send.call_count == 1 + 8 + steps.padding
+
+    def test_group_plans_for_finest_member(self):
+        """Test a group ramps for the member with the most steps and the most padding."""
+        registry = lcm.LampRegistry([
+            (lcm.STUDY_LAMPS, "STUDY_LAMPS", (), (lcm.STUDY_DESK_LAMP, lcm.STUDY_TABLE_LAMP)),
+            (lcm.STUDY_DESK_LAMP, "STUDY_DESK_LAMP", (), (), lcm.StepTable(30, 30, 30, 30, 1)),
+            (lcm.STUDY_TABLE_LAMP, "STUDY_TABLE_LAMP", (), (), lcm.StepTable(40, 20, 30, 30, 2))])
+        with patch('lamp_control_mqtt.registry', registry):
+            group = lcm.find_or_create_lamp({}, lcm.STUDY_LAMPS, Mock())
+            assert group.steps == lcm.StepTable(40, 30, 30, 30, 2)
+
+    def test_step_table_from_config(self):
+        assert lcm.StepTable.from_config({}) == lcm.DEFAULT_STEPS
+        assert lcm.StepTable.from_config({"up": 30, "padding": 0}).up_increment == pytest.approx(100 / 30)
+        for config in ({"sideways": 3}, {"up": 0}, {"padding": -1}):
+            with pytest.raises(ValueError):
+                lcm.StepTable.from_config(config)
+
+    def test_estimate_airtime(self):
+        """Test airtime estimate includes the frame and RF_DELAY."""
+        frame = lcm.FRAME_PULSES * 161 * lcm.TX_REPEAT / 1e6
+        assert lcm.estimate_airtime(3, 161) == pytest.approx(3 * (frame + lcm.RF_DELAY))
+        assert lcm.estimate_airtime(1) > lcm.estimate_airtime(1, 161)
 
 
 class TestDecodeRx:
     """Test RF code decoding."""
     
     def setup_method(self):
-        """Set up test lamp list."""
-        lcm.lamp_list.clear()
+        """Set up test lamps."""
+        lcm.lamps.clear()
         mock_client = Mock()
         self.lamp = lcm.joofo_lamp(lcm.LIVING_ROOM_LAMP, mock_client)
-        lcm.lamp_list.append(self.lamp)
+        lcm.lamps[self.lamp.lamp_id] = self.lamp
     
     def teardown_method(self):
-        """Clean up lamp list."""
-        lcm.lamp_list.clear()
+        """Clean up lamps."""
+        lcm.lamps.clear()
     
     def test_decode_on_off(self):
         """Test decoding ON/OFF command."""
@@ -275,19 +412,254 @@ class TestDecodeRx:
         assert command is None
 
 
+class TestLogging:
+    """Test the rate limit filter and the background log writer."""
+
+    def record(self, msg, *args, rate_limit=True):
+        record = logging.LogRecord("root", logging.WARNING, __file__, 1, msg, args, None)
+        if rate_limit:
+            record.rate_limit = True
+        return record
+
+    def test_unmarked_records_pass(self):
+        log_filter = lcm.RateLimitFilter(interval=10, clock=lambda: 0)
+        assert all(log_filter.filter(self.record("received message = %s", n, rate_limit=False))
+                   for n in range(5))
+
+    def test_repeats_dropped_within_interval(self):
+        now = [0]
+        log_filter = lcm.RateLimitFilter(interval=10, clock=lambda: now[0])
+        assert log_filter.filter(self.record("Lamp not found!  Code: %s", 1))
+        # Keyed by the unformatted message, so different codes count as repeats
+        assert not any(log_filter.filter(self.record("Lamp not found!  Code: %s", code))
+                       for code in range(2, 6))
+        assert log_filter.filter(self.record("Reset for unknown lamp: %s", 1))
+
+        now[0] = 10
+        record = self.record("Lamp not found!  Code: %s", 7)
+        assert log_filter.filter(record)
+        assert record.getMessage() == "Lamp not found!  Code: 7 (4 similar suppressed)"
+
+    def test_unknown_code_flood(self, caplog):
+        lcm.lamps.clear()
+        log_filter = lcm.RateLimitFilter()
+        logging.getLogger().addFilter(log_filter)
+        try:
+            with caplog.at_level(logging.WARNING):
+                for code in range(1000):
+                    lcm.decode_rx(code, 0)
+        finally:
+            logging.getLogger().removeFilter(log_filter)
+        assert [r.getMessage() for r in caplog.records] == ["Lamp not found!  Code: 0"]
+
+    def test_listener_writes_off_the_calling_thread(self):
+        written = []
+
+        class Recorder(logging.Handler):
+            def emit(self, record):
+                written.append((self.format(record), threading.current_thread()))
+
+        root = logging.getLogger()
+        recorder = Recorder()
+        root.addHandler(recorder)
+        handlers = root.handlers[:]
+        try:
+            listener = lcm.start_log_listener()
+            assert [type(h) for h in root.handlers] == [lcm.LogQueueHandler]
+            logging.warning("Code: %s", 42)
+            lcm.stop_log_listener(listener)
+            assert root.handlers == handlers
+        finally:
+            root.removeHandler(recorder)
+        assert written[0][0] == "Code: 42"
+        assert written[0][1] is not threading.current_thread()
+
+
+class TestLampRegistry:
+    """Test the lamp registry and its code table."""
+
+    def test_default_registry(self):
+        """Test the built-in registry covers the lamp constants."""
+        assert len(lcm.registry) == 4
+        assert lcm.LIVING_ROOM_LAMP in lcm.registry
+        assert lcm.registry.name(lcm.STUDY_DESK_LAMP) == "STUDY_DESK_LAMP"
+        assert lcm.registry.name(1234) == "UNKNOWN_1234"
+
+    def test_decode_every_command(self):
+        """Test every valid code maps back to its lamp and command."""
+        for offset in lcm.CMDS2NAMES:
+            info, command = lcm.registry.decode(lcm.STUDY_LAMPS + offset)
+            assert info.lamp_id == lcm.STUDY_LAMPS
+            assert command == offset
+
+    def test_decode_invalid_offsets(self):
+        """Test codes between or below command offsets are unknown."""
+        assert lcm.registry.decode(lcm.STUDY_LAMPS + 2) is None
+        assert lcm.registry.decode(lcm.STUDY_LAMPS - 1) is None
+        assert lcm.registry.decode(9999999) is None
+
+    def test_clashing_codes_rejected(self):
+        """Test lamps whose code ranges overlap are rejected."""
+        with pytest.raises(ValueError):
+            lcm.LampRegistry([(1000, "A"), (1003, "B")])
+
+    def test_load(self, tmp_path):
+        """Test loading a registry from a lamps file."""
+        path = tmp_path / "lamps.json"
+        path.write_text('{"lamps": [{"id": 5000, "name": "HALL"}]}')
+
+        registry = lcm.LampRegistry.load(str(path))
+
+        assert len(registry) == 1
+        assert registry.decode(5000 + lcm.BRIGHTNESS_DOWN_OFFSET)[0].name == "HALL"
+
+    def test_load_tx_pins(self, tmp_path):
+        """Test lamps can name a TX pin or a list of pins to fall back through."""
+        path = tmp_path / "lamps.json"
+        path.write_text('{"lamps": [{"id": 5000, "name": "HALL", "tx": 17},'
+                        ' {"id": 6000, "name": "DEN", "tx": [27, 4]},'
+                        ' {"id": 7000, "name": "ATTIC"}]}')
+
+        registry = lcm.LampRegistry.load(str(path))
+
+        assert [info.tx for info in registry] == [(17,), (27, 4), ()]
+
+    def test_load_groups(self, tmp_path):
+        """Test a group code lists its member lamps."""
+        path = tmp_path / "lamps.json"
+        path.write_text('{"lamps": [{"id": 5000, "name": "HALL", "members": [6000, 7000]},'
+                        ' {"id": 6000, "name": "DEN"}, {"id": 7000, "name": "ATTIC"}]}')
+
+        registry = lcm.LampRegistry.load(str(path))
+
+        assert registry.lamps[5000].members == (6000, 7000)
+        assert registry.groups_of(6000) == (5000,)
+        assert registry.groups_of(5000) == ()
+
+    def test_group_members_must_be_lamps(self):
+        with pytest.raises(ValueError):
+            lcm.LampRegistry([(5000, "HALL", (), [6000])])
+        with pytest.raises(ValueError):
+            lcm.LampRegistry([(5000, "HALL", (), [6000]), (6000, "DEN", (), [7000]),
+                              (7000, "ATTIC")])
+
+    def test_shipped_lamps_file(self):
+        """Test the shipped lamps file matches the built-in lamps."""
+        registry = lcm.LampRegistry.load(
+            os.path.join(os.path.dirname(os.path.abspath(lcm.__file__)), "lamps.json"))
+
+        assert registry.codes == lcm.registry.codes
+
+    def test_large_registry(self):
+        """Test decoding with hundreds of lamps."""
+        registry = lcm.LampRegistry((1000000 + 10 * i, f"LAMP_{i}") for i in range(400))
+
+        assert len(registry.codes) == 400 * len(lcm.CMDS2NAMES)
+        info, command = registry.decode(1000000 + 10 * 399 + lcm.CCT_OFFSET)
+        assert info.name == "LAMP_399"
+        assert command == lcm.CCT_OFFSET
+
+    def test_sniffer_uses_registry(self):
+        """Test rf_sniffer decodes codes exactly as the daemon does."""
+        import rf_sniffer
+
+        for code in list(lcm.registry.codes) + [lcm.STUDY_LAMPS + 2, 42]:
+            decoded = lcm.registry.decode(code)
+            sniffed = rf_sniffer.decode_rf_code(code)
+            if decoded is None:
+                assert sniffed is None
+            else:
+                assert sniffed[0] == decoded[0].lamp_id
+                assert sniffed[2] == decoded[1]
+
+
+class TestSniffer:
+    """Test rf_sniffer's frame classification and summary mode."""
+
+    def test_classify(self):
+        import rf_sniffer
+
+        decoded = rf_sniffer.decode_rf_code(lcm.LIVING_ROOM_LAMP)
+        assert rf_sniffer.classify(lcm.LIVING_ROOM_LAMP, None, None, decoded) == (False, False)
+        assert rf_sniffer.classify(lcm.LIVING_ROOM_LAMP, 100000, lcm.LIVING_ROOM_LAMP, decoded) == \
+            (True, True)
+        assert rf_sniffer.classify(lcm.LIVING_ROOM_LAMP, 20000, lcm.LIVING_ROOM_LAMP, decoded) == \
+            (True, False)
+        assert rf_sniffer.classify(42, 100000, 41, None) == (False, False)
+
+    def test_decode_frames(self, tmp_path):
+        """Test the decode thread counts frames and writes each one to the sink."""
+        import rf_sniffer
+
+        device = FakeRxDevice()
+        receiver = lcm.RFReceiver(device, maxlen=rf_sniffer.RX_QUEUE_LEN)
+        codes = [lcm.LIVING_ROOM_LAMP, lcm.LIVING_ROOM_LAMP, 42] * 100
+        for code in codes:
+            device.emit(code)
+        receiver.close()
+        stats = rf_sniffer.SnifferStats()
+        with open(tmp_path / "frames.txt", "w") as sink:
+            rf_sniffer.decode_frames(receiver, lcm.registry, stats, sink=sink)
+
+        snapshot = stats.snapshot()
+        assert snapshot['total'] == len(codes)
+        assert snapshot['unknown'] == 100
+        assert snapshot['commands'] == {("LIVING_ROOM_LAMP", "ON_OFF_OFFSET"): 200}
+        # Codes emitted back to back repeat within MIN_GAP
+        assert snapshot['duplicates'] == 100
+        assert len(snapshot['recent']) == rf_sniffer.RECENT_FRAMES
+        lines = (tmp_path / "frames.txt").read_text().splitlines()
+        assert len(lines) == len(codes)
+        assert "Code: 42 " in lines[2] and "Decoded: UNKNOWN" in lines[2]
+
+    def test_render_summary(self):
+        import rf_sniffer
+
+        stats = rf_sniffer.SnifferStats()
+        frame = lcm.RxFrame(lcm.LIVING_ROOM_LAMP + lcm.BRIGHTNESS_UP_OFFSET, 1000, 350, 1)
+        stats.add(frame, rf_sniffer.decode_rf_code(frame.code), None, False, False)
+        screen = rf_sniffer.render_summary(stats.snapshot(), 12.5, 3)
+        assert "12.5" in screen
+        assert "BRIGHTNESS_UP_OFFSET" in screen
+        assert str(frame.code) in screen
+
+    def test_summary_mode_renders_at_fixed_rate(self, capsys):
+        """Test a burst of frames costs a few redraws, not one per frame."""
+        import rf_sniffer
+
+        device = FakeRxDevice()
+        receiver = lcm.RFReceiver(device, maxlen=rf_sniffer.RX_QUEUE_LEN)
+        stats = rf_sniffer.SnifferStats()
+
+        def burst():
+            for _ in range(1000):
+                device.emit(lcm.LIVING_ROOM_LAMP)
+            time.sleep(0.3)
+            receiver.close()
+
+        thread = threading.Thread(target=burst)
+        thread.start()
+        rf_sniffer.run_summary(receiver, lcm.registry, stats, refresh=20)
+        thread.join()
+
+        assert stats.total == 1000
+        redraws = capsys.readouterr().out.count("\033[2J")
+        assert 1 <= redraws <= 20
+
+
 class TestHandleRx:
     """Test RF message handling."""
     
     def setup_method(self):
-        """Set up test lamp list."""
-        lcm.lamp_list.clear()
+        """Set up test lamps."""
+        lcm.lamps.clear()
         mock_client = Mock()
         self.lamp = lcm.joofo_lamp(lcm.LIVING_ROOM_LAMP, mock_client)
-        lcm.lamp_list.append(self.lamp)
+        lcm.lamps[self.lamp.lamp_id] = self.lamp
     
     def teardown_method(self):
-        """Clean up lamp list."""
-        lcm.lamp_list.clear()
+        """Clean up lamps."""
+        lcm.lamps.clear()
     
     def test_handle_on_off(self):
         """Test handling ON/OFF command."""
@@ -353,48 +725,237 @@ class TestHandleRx:
             lcm.handle_rx(12345, 12345, lcm.MIN_GAP + 1)
 
 
+class FakeRxDevice:
+    """Receive side of rpi_rf's RFDevice, decoding one code per emit()."""
+
+    def __init__(self):
+        self.rx_code = None
+        self.rx_code_timestamp = None
+        self.rx_pulselength = None
+        self.rx_proto = None
+        self.next_code = None
+
+    def rx_callback(self, gpio):
+        self.rx_code = self.next_code
+        self.rx_code_timestamp = int(time.perf_counter() * 1000000)
+        self.rx_pulselength = 161
+        self.rx_proto = 1
+
+    def emit(self, code):
+        # The last edge of a frame, as delivered by the GPIO callback thread
+        self.next_code = code
+        self.rx_callback(23)
+
+
+class TestRxModes:
+    """Test the polling and event-driven receive loops."""
+
+    CODES = [lcm.LIVING_ROOM_LAMP, lcm.LIVING_ROOM_LAMP + lcm.BRIGHTNESS_UP_OFFSET,
+             lcm.STUDY_LAMPS]
+
+    def emit_codes(self, device):
+        for code in self.CODES:
+            time.sleep(0.1)
+            device.emit(code)
+        time.sleep(0.1)
+
+    def test_receiver_queues_frames(self):
+        """Test the receiver hands over every decoded frame in order."""
+        device = FakeRxDevice()
+        receiver = lcm.RFReceiver(device)
+        device.emit(1)
+        device.emit(2)
+
+        assert receiver.get(0).code == 1
+        frame = receiver.get(0)
+        assert frame.code == 2
+        assert frame.pulselength == 161
+        assert receiver.get(0) is None
+
+    def test_receiver_close_ends_wait(self):
+        """Test closing the receiver ends wait_rx."""
+        receiver = lcm.RFReceiver(FakeRxDevice())
+        thread = threading.Thread(target=lcm.wait_rx, args=(receiver, Mock()))
+        thread.start()
+        receiver.close()
+        thread.join(timeout=5)
+
+        assert not thread.is_alive()
+
+    def test_poll_and_event_modes_agree(self):
+        """Test both RX modes deliver the same codes in order."""
+        device = FakeRxDevice()
+        polled = []
+        stop = threading.Event()
+        thread = threading.Thread(
+            target=lcm.poll_rx, args=(device, lambda c, t, g: polled.append(c), stop))
+        thread.start()
+        self.emit_codes(device)
+        stop.set()
+        thread.join(timeout=5)
+
+        device = FakeRxDevice()
+        receiver = lcm.RFReceiver(device)
+        waited = []
+        thread = threading.Thread(
+            target=lcm.wait_rx, args=(receiver, lambda c, t, g: waited.append(c)))
+        thread.start()
+        self.emit_codes(device)
+        receiver.close()
+        thread.join(timeout=5)
+
+        assert polled == waited == self.CODES
+
+    def test_frames_journaled(self, tmp_path):
+        """Test wait_rx journals every frame with its decoded command."""
+        path = str(tmp_path / "rx.journal")
+        journal = lcm.rf_journal.JournalWriter(path)
+        device = FakeRxDevice()
+        receiver = lcm.RFReceiver(device)
+        for code in self.CODES + [12345]:
+            device.emit(code)
+        receiver.close()
+        with patch('lamp_control_mqtt.rx_journal', journal):
+            lcm.wait_rx(receiver, Mock())
+        journal.close()
+
+        records = list(lcm.rf_journal.query(path))
+        assert [record.code for record in records] == self.CODES + [12345]
+        assert [record.command for record in records] == [
+            lcm.ON_OFF_OFFSET, lcm.BRIGHTNESS_UP_OFFSET, lcm.ON_OFF_OFFSET, None]
+        assert lcm.rf_journal.lamp_of(records[1]) == lcm.LIVING_ROOM_LAMP
+        assert records[0].pulselength == 161
+
+    def test_journal_command_names_match_bridge(self):
+        """Test the journal names the bridge's command offsets."""
+        assert set(lcm.rf_journal.COMMAND_NAMES) == set(lcm.CMDS2NAMES)
+
+
+class TestBurstAggregator:
+    """Test aggregation of held remote buttons."""
+
+    def setup_method(self):
+        lcm.lamps.clear()
+        self.client = Mock()
+        self.lamp = lcm.joofo_lamp(lcm.LIVING_ROOM_LAMP, self.client)
+        self.lamp.on = True
+        self.lamp.brightness = 20
+        lcm.lamps[self.lamp.lamp_id] = self.lamp
+
+    def teardown_method(self):
+        lcm.lamps.clear()
+
+    def brightness_publishes(self):
+        topic = f"{lcm.BASE_TOPIC}{lcm.LIVING_ROOM_LAMP}/get{lcm.BRIGHTNESS_TOPIC}"
+        return [c for c in self.client.publish.call_args_list if c.args[0] == topic]
+
+    def wait_for_release(self, aggregator):
+        deadline = time.monotonic() + 5
+        while aggregator.bursts and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+    def test_held_button_publishes_once(self):
+        """Test a held BRUP updates brightness per frame but publishes once."""
+        aggregator = lcm.BurstAggregator(gap=0.05)
+        code = lcm.LIVING_ROOM_LAMP + lcm.BRIGHTNESS_UP_OFFSET
+        with patch('lamp_control_mqtt.burst_aggregator', aggregator):
+            for i in range(10):
+                lcm.handle_rx(code, 1000 + i, 40000)
+
+        assert self.lamp.brightness == pytest.approx(20 + 10 * lcm.REMOTE_BRUP_INCREMENT)
+        assert self.brightness_publishes() == []
+
+        self.wait_for_release(aggregator)
+
+        publishes = self.brightness_publishes()
+        assert len(publishes) == 1
+        assert publishes[0].kwargs['payload'] == math.ceil(self.lamp.brightness)
+
+    def test_direction_change_ends_burst(self):
+        """Test switching from BRUP to BRDOWN publishes the first burst."""
+        aggregator = lcm.BurstAggregator(gap=60)
+        aggregator.add(self.lamp, lcm.BRIGHTNESS_UP_OFFSET)
+        aggregator.add(self.lamp, lcm.BRIGHTNESS_UP_OFFSET)
+        aggregator.add(self.lamp, lcm.BRIGHTNESS_DOWN_OFFSET)
+
+        assert len(self.brightness_publishes()) == 1
+        assert aggregator.bursts[lcm.LIVING_ROOM_LAMP].command == lcm.BRIGHTNESS_DOWN_OFFSET
+
+        aggregator.flush()
+        assert len(self.brightness_publishes()) == 2
+        assert aggregator.bursts == {}
+
+    def test_throttled_updates(self):
+        """Test intermediate updates are published at most every update_interval."""
+        aggregator = lcm.BurstAggregator(gap=60, update_interval=0.05)
+        aggregator.add(self.lamp, lcm.BRIGHTNESS_DOWN_OFFSET)
+        aggregator.add(self.lamp, lcm.BRIGHTNESS_DOWN_OFFSET)
+        time.sleep(0.06)
+        aggregator.add(self.lamp, lcm.BRIGHTNESS_DOWN_OFFSET)
+
+        assert len(self.brightness_publishes()) == 1
+        aggregator.flush()
+
+    def test_on_off_not_aggregated(self):
+        """Test on/off frames are still handled immediately."""
+        aggregator = lcm.BurstAggregator(gap=60)
+        with patch('lamp_control_mqtt.burst_aggregator', aggregator), \
+                patch.object(self.lamp, 'on_off') as mock_on_off:
+            lcm.handle_rx(lcm.LIVING_ROOM_LAMP + lcm.ON_OFF_OFFSET, 1000, lcm.MIN_GAP + 1)
+            mock_on_off.assert_called_once_with(None, False)
+
+        assert aggregator.bursts == {}
+
+
 class TestFindOrCreateLamp:
     """Test lamp finding/creation."""
 
     def setup_method(self):
-        """Set up test lamp list."""
-        lcm.lamp_list.clear()
+        """Set up test lamps."""
+        lcm.lamps.clear()
 
     def teardown_method(self):
-        """Clean up lamp list."""
-        lcm.lamp_list.clear()
+        """Clean up lamps."""
+        lcm.lamps.clear()
 
     def test_find_existing_lamp(self):
         """Test finding an existing lamp."""
         mock_client = Mock()
         lamp1 = lcm.joofo_lamp(lcm.LIVING_ROOM_LAMP, mock_client)
-        lcm.lamp_list.append(lamp1)
+        lcm.lamps[lamp1.lamp_id] = lamp1
 
-        found = lcm.find_or_create_lamp(lcm.lamp_list, lcm.LIVING_ROOM_LAMP, mock_client)
+        found = lcm.find_or_create_lamp(lcm.lamps, lcm.LIVING_ROOM_LAMP, mock_client)
 
         assert found == lamp1
-        assert len(lcm.lamp_list) == 1
+        assert len(lcm.lamps) == 1
 
     def test_create_new_lamp(self):
         """Test creating a new lamp."""
         mock_client = Mock()
 
-        lamp = lcm.find_or_create_lamp(lcm.lamp_list, lcm.STUDY_LAMPS, mock_client)
+        lamp = lcm.find_or_create_lamp(lcm.lamps, lcm.STUDY_DESK_LAMP, mock_client)
+
+        assert lamp.lamp_id == lcm.STUDY_DESK_LAMP
+        assert len(lcm.lamps) == 1
+
+    def test_create_group(self):
+        """Test creating a group creates its members too."""
+        group = lcm.find_or_create_lamp(lcm.lamps, lcm.STUDY_LAMPS, Mock())
 
-        assert lamp.lamp_id == lcm.STUDY_LAMPS
-        assert len(lcm.lamp_list) == 1
+        assert isinstance(group, lcm.joofo_group)
+        assert group.members == [lcm.lamps[lcm.STUDY_DESK_LAMP], lcm.lamps[lcm.STUDY_TABLE_LAMP]]
 
     def test_multiple_lamps(self):
         """Test managing multiple lamps."""
         mock_client = Mock()
 
-        lamp1 = lcm.find_or_create_lamp(lcm.lamp_list, lcm.LIVING_ROOM_LAMP, mock_client)
-        lamp2 = lcm.find_or_create_lamp(lcm.lamp_list, lcm.STUDY_LAMPS, mock_client)
-        lamp1_again = lcm.find_or_create_lamp(lcm.lamp_list, lcm.LIVING_ROOM_LAMP, mock_client)
+        lamp1 = lcm.find_or_create_lamp(lcm.lamps, lcm.LIVING_ROOM_LAMP, mock_client)
+        lamp2 = lcm.find_or_create_lamp(lcm.lamps, lcm.STUDY_DESK_LAMP, mock_client)
+        lamp1_again = lcm.find_or_create_lamp(lcm.lamps, lcm.LIVING_ROOM_LAMP, mock_client)
 
         assert lamp1 == lamp1_again
         assert lamp1 != lamp2
-        assert len(lcm.lamp_list) == 2
+        assert len(lcm.lamps) == 2
 
 
 class TestCallbackFactory:
@@ -420,7 +981,7 @@ class TestCallbackFactory:
 
     def test_callback_execution_on_off(self):
         """Test executing an on/off callback."""
-        lcm.lamp_list.clear()
+        lcm.lamps.clear()
         mock_client = Mock()
         callback = lcm.create_lamp_callback(lcm.LIVING_ROOM_LAMP, "Living Room", "on_off")
 
@@ -432,14 +993,14 @@ class TestCallbackFactory:
             callback(mock_client, None, mock_message)
 
         # Should have created a lamp
-        assert len(lcm.lamp_list) == 1
-        assert lcm.lamp_list[0].on == True
+        assert len(lcm.lamps) == 1
+        assert lcm.lamps[lcm.LIVING_ROOM_LAMP].on == True
 
-        lcm.lamp_list.clear()
+        lcm.lamps.clear()
 
     def test_callback_execution_brightness(self):
         """Test executing a brightness callback."""
-        lcm.lamp_list.clear()
+        lcm.lamps.clear()
         mock_client = Mock()
         callback = lcm.create_lamp_callback(lcm.LIVING_ROOM_LAMP, "Living Room", "brightness")
 
@@ -452,27 +1013,27 @@ class TestCallbackFactory:
             with patch.object(lcm.joofo_lamp, 'set_brightness_level'):
                 callback(mock_client, None, mock_message)
                 # Should have created a lamp
-                assert len(lcm.lamp_list) == 1
+                assert len(lcm.lamps) == 1
 
-        lcm.lamp_list.clear()
+        lcm.lamps.clear()
 
 
 class TestResetLamp:
     """Test the reset_lamp callback."""
 
     def setup_method(self):
-        """Set up test lamp list."""
-        lcm.lamp_list.clear()
+        """Set up test lamps."""
+        lcm.lamps.clear()
 
     def teardown_method(self):
-        """Clean up lamp list."""
-        lcm.lamp_list.clear()
+        """Clean up lamps."""
+        lcm.lamps.clear()
 
     def test_reset_lamp_callback(self):
         """Test reset lamp callback."""
         mock_client = Mock()
         lamp = lcm.joofo_lamp(lcm.LIVING_ROOM_LAMP, mock_client)
-        lcm.lamp_list.append(lamp)
+        lcm.lamps[lamp.lamp_id] = lamp
 
         # Create mock message
         mock_message = Mock()
@@ -483,6 +1044,965 @@ class TestResetLamp:
             mock_reset.assert_called_once()
 
 
+class TestTxWorker:
+    """Test the background TX worker."""
+
+    @pytest.fixture
+    def lamp(self):
+        lamp = lcm.joofo_lamp(lcm.LIVING_ROOM_LAMP, Mock())
+        lamp.on = True
+        lamp.brightness = 50
+        return lamp
+
+    def test_latest_brightness_wins(self, lamp):
+        """Test a newer brightness target replaces an unsent one."""
+        worker = lcm.TxWorker()
+        for level in (30, 60, 90):
+            worker.submit(lamp, 'brightness', str(level))
+
+        assert worker.pending[lamp] == {'brightness': "90"}
+        assert worker.coalesced == 2
+
+    def test_off_drops_pending_brightness(self, lamp):
+        """Test turning off supersedes a queued brightness change."""
+        worker = lcm.TxWorker()
+        worker.submit(lamp, 'brightness', "30")
+        worker.submit(lamp, 'on_off', "false")
+
+        assert worker.pending[lamp] == {'on_off': "false"}
+
+    def test_cct_presses_counted(self, lamp):
+        """Test cct commands accumulate rather than coalesce."""
+        worker = lcm.TxWorker()
+        worker.submit(lamp, 'cct', "")
+        worker.submit(lamp, 'cct', "")
+
+        assert worker.pending[lamp] == {'cct': 2}
+
+    def test_on_off_jumps_queue(self, lamp):
+        """Test lamps with on/off pending are served before brightness ramps."""
+        other = lcm.joofo_lamp(lcm.STUDY_LAMPS, Mock())
+        worker = lcm.TxWorker()
+        worker.submit(lamp, 'brightness', "10")
+        worker.submit(other, 'on_off', "true")
+
+        assert worker.next_lamp() is other
+        assert worker.preempted(lamp)
+
+    def test_preempted_ramp_is_requeued(self, lamp):
+        """Test an interrupted ramp puts its target back in the queue."""
+        worker = lcm.TxWorker()
+        with patch('lamp_control_mqtt.send_rf') as mock_send:
+            with patch.object(worker, 'preempted', side_effect=[False, False, True]):
+                worker.execute(lamp, 'brightness', "80")
+
+        assert mock_send.call_count == 2
+        assert worker.pending[lamp] == {'brightness': "80"}
+
+    def test_worker_drains_queue(self, lamp):
+        """Test the worker thread sends queued commands and goes idle."""
+        worker = lcm.TxWorker()
+        with patch('lamp_control_mqtt.send_rf'):
+            worker.start()
+            try:
+                worker.submit(lamp, 'on_off', "false")
+                worker.submit(lamp, 'brightness', "70")
+                assert worker.wait_idle(timeout=5)
+            finally:
+                worker.stop(timeout=5)
+
+        assert lamp.on == True
+        assert math.ceil(lamp.brightness) >= 70
+        assert not worker.is_alive()
+
+    def test_submit_command_uses_worker(self, lamp):
+        """Test callbacks queue work instead of transmitting inline."""
+        worker = lcm.TxWorker()
+        with patch('lamp_control_mqtt.tx_worker', worker), \
+                patch('lamp_control_mqtt.send_rf') as mock_send:
+            lcm.submit_command(lamp, 'brightness', "20")
+            mock_send.assert_not_called()
+
+        assert worker.pending[lamp] == {'brightness': "20"}
+
+
+class TestMultipleTransmitters:
+    """Test lamps assigned to their own transmitters."""
+
+    @pytest.fixture(autouse=True)
+    def registry(self):
+        registry = lcm.LampRegistry([(lcm.LIVING_ROOM_LAMP, "LIVING_ROOM_LAMP", [17]),
+                                     (lcm.STUDY_DESK_LAMP, "STUDY_DESK_LAMP", [27, 17]),
+                                     (lcm.STUDY_TABLE_LAMP, "STUDY_TABLE_LAMP")])
+        with patch('lamp_control_mqtt.registry', registry), \
+                patch('lamp_control_mqtt.transmitter', None), \
+                patch('lamp_control_mqtt.transmitters', {}), \
+                patch('lamp_control_mqtt.sleep'):
+            yield registry
+
+    def test_tx_pins(self):
+        assert lcm.tx_pins(lcm.LIVING_ROOM_LAMP) == (17,)
+        assert lcm.tx_pins(lcm.STUDY_DESK_LAMP) == (27, 17)
+        # Lamps without their own pins use -g
+        assert lcm.tx_pins(lcm.STUDY_TABLE_LAMP) == (4,)
+
+    def test_send_rf_uses_lamp_transmitter(self):
+        with patch('lamp_control_mqtt.RFDevice') as mock_device_class:
+            lcm.send_rf(lcm.LIVING_ROOM_LAMP + lcm.CCT_OFFSET)
+            lcm.send_rf(lcm.STUDY_TABLE_LAMP)
+
+        assert [c.args[0] for c in mock_device_class.call_args_list] == [17, 4]
+        assert set(lcm.transmitters) == {17}
+        assert lcm.transmitter.gpio == 4
+
+    def test_send_rf_falls_back(self):
+        """Test a lamp is sent on its next pin when a transmitter fails."""
+        def make_device(gpio, **kwargs):
+            if gpio == 27:
+                raise RuntimeError("no transmitter")
+            return Mock()
+
+        with patch('lamp_control_mqtt.make_rf_device', side_effect=make_device):
+            lcm.send_rf(lcm.STUDY_DESK_LAMP)
+
+        assert lcm.transmitters[17].device.tx_code.call_args.args[0] == lcm.STUDY_DESK_LAMP
+
+    def test_send_rf_raises_when_every_transmitter_fails(self):
+        with patch('lamp_control_mqtt.make_rf_device', side_effect=RuntimeError("no transmitter")):
+            with pytest.raises(RuntimeError):
+                lcm.send_rf(lcm.STUDY_DESK_LAMP)
+
+    def test_pool_drives_radios_in_parallel(self):
+        """Test lamps on different transmitters are sent at the same time."""
+        lamps = {lamp_id: lcm.joofo_lamp(lamp_id, Mock())
+                 for lamp_id in (lcm.LIVING_ROOM_LAMP, lcm.STUDY_DESK_LAMP, lcm.STUDY_TABLE_LAMP)}
+        threads = {}
+        # Only lets a command finish once one is running on every radio
+        all_sending = threading.Barrier(len(lamps), timeout=5)
+
+        def slow_command(lamp, command_type, payload, preempt=None, trace=None):
+            threads[lamp.lamp_id] = threading.current_thread().name
+            all_sending.wait()
+            return True
+
+        pool = lcm.TxPool()
+        with patch('lamp_control_mqtt.run_command', side_effect=slow_command):
+            pool.start()
+            try:
+                for lamp in lamps.values():
+                    pool.submit(lamp, 'on_off', "true")
+                assert pool.wait_idle(timeout=5)
+            finally:
+                pool.stop(timeout=5)
+
+        assert not all_sending.broken
+        assert threads == {lcm.LIVING_ROOM_LAMP: "rf-tx-17", lcm.STUDY_DESK_LAMP: "rf-tx-27",
+                           lcm.STUDY_TABLE_LAMP: "rf-tx-4"}
+        assert not any(worker.is_alive() for worker in pool.workers.values())
+
+    def test_pool_serializes_lamps_on_one_transmitter(self):
+        pool = lcm.TxPool()
+        first = lcm.joofo_lamp(lcm.LIVING_ROOM_LAMP, Mock())
+        with patch('lamp_control_mqtt.tx_pins', return_value=(4,)), \
+                patch('lamp_control_mqtt.TxWorker.start'):
+            assert pool.worker(lcm.LIVING_ROOM_LAMP) is pool.worker(lcm.STUDY_DESK_LAMP)
+            pool.submit(first, 'brightness', "30")
+            pool.submit(first, 'brightness', "60")
+
+        assert pool.coalesced == 1
+
+
+class TestStatePublisher:
+    """Test coalesced, retained state publishing."""
+
+    def test_batches_to_final_value(self):
+        """Test only the last value per topic is published, retained."""
+        client = Mock()
+        publisher = lcm.StatePublisher(client, 60)
+        for level in (10, 20, 30):
+            publisher.publish("a/getBrightness", level)
+        publisher.publish("a/getOnOff", "true")
+        client.publish.assert_not_called()
+
+        publisher.close()
+
+        assert client.publish.call_args_list == [
+            call("a/getBrightness", payload="30", qos=0, retain=True),
+            call("a/getOnOff", payload="true", qos=0, retain=True),
+        ]
+        assert publisher.sent == 2
+        assert publisher.suppressed == 2
+
+    def test_unchanged_value_suppressed(self):
+        """Test republishing the current value is suppressed."""
+        client = Mock()
+        publisher = lcm.StatePublisher(client, 0)
+        publisher.publish("a/getOnOff", "true")
+        publisher.publish("a/getOnOff", "true")
+
+        client.publish.assert_called_once()
+        assert publisher.sent == 1
+        assert publisher.suppressed == 1
+
+    def test_window_timer_flushes(self):
+        """Test pending updates go out when the window closes."""
+        client = Mock()
+        publisher = lcm.StatePublisher(client, 0.01)
+        publisher.publish("a/getBrightness", 50)
+
+        deadline = time.monotonic() + 5
+        while not client.publish.called and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+        client.publish.assert_called_once_with("a/getBrightness", payload="50",
+                                               qos=0, retain=True)
+
+    def test_ramp_publishes_once(self):
+        """Test a brightness ramp through the publisher ends in one publish."""
+        client = Mock()
+        lamp = lcm.joofo_lamp(lcm.LIVING_ROOM_LAMP, client)
+        lamp.on = True
+        lamp.brightness = 50
+        publisher = lcm.StatePublisher(client, 60)
+        with patch('lamp_control_mqtt.state_publisher', publisher), \
+                patch('lamp_control_mqtt.send_rf'):
+            for level in (60, 70, 80):
+                lamp.set_brightness_level(level)
+            publisher.close()
+
+        topic = f"{lcm.BASE_TOPIC}{lcm.LIVING_ROOM_LAMP}/get{lcm.BRIGHTNESS_TOPIC}"
+        client.publish.assert_called_once_with(topic, payload=str(math.ceil(lamp.brightness)),
+                                               qos=0, retain=True)
+
+
+class TestLatencyTracing:
+    """Test command latency traces and stats."""
+
+    def setup_method(self):
+        lcm.lamps.clear()
+        self.stats = lcm.LatencyStats()
+
+    def teardown_method(self):
+        lcm.lamps.clear()
+
+    def send_message(self, command_type, payload):
+        callback = lcm.create_lamp_callback(lcm.LIVING_ROOM_LAMP, "Living Room", command_type)
+        message = Mock()
+        message.payload.decode.return_value = payload
+        callback(Mock(), None, message)
+
+    def test_percentile(self):
+        """Test nearest-rank percentiles."""
+        values = list(range(1, 101))
+        assert lcm.percentile(values, 50) == 50
+        assert lcm.percentile(values, 99) == 99
+        assert lcm.percentile([7], 95) == 7
+
+    def test_inline_command_traced(self):
+        """Test an MQTT command records RF and publish timings."""
+        with patch('lamp_control_mqtt.latency_stats', self.stats), \
+                patch('lamp_control_mqtt.transmitter', Mock()), \
+                patch('lamp_control_mqtt.sleep'):
+            self.send_message('on_off', "true")
+
+        summary = self.stats.summary()['on_off']
+        assert summary['total']['count'] == 1
+        assert summary['tx']['count'] == 1
+        assert summary['publish']['count'] == 1
+        assert summary['first_tx']['p50'] <= summary['total']['p50']
+
+    def test_queued_command_traced(self):
+        """Test commands through the TX worker record their queue wait."""
+        worker = lcm.TxWorker()
+        with patch('lamp_control_mqtt.latency_stats', self.stats), \
+                patch('lamp_control_mqtt.tx_worker', worker), \
+                patch('lamp_control_mqtt.transmitter', Mock()), \
+                patch('lamp_control_mqtt.sleep'):
+            self.send_message('brightness', "40")
+            self.send_message('brightness', "60")
+            worker.start()
+            try:
+                assert worker.wait_idle(timeout=5)
+            finally:
+                worker.stop(timeout=5)
+
+        summary = self.stats.summary()['brightness']
+        # The coalesced first target never reached the radio
+        assert summary['total']['count'] == 1
+        assert summary['queue']['count'] == 1
+        assert summary['tx']['count'] == 1
+
+    def test_stats_published(self):
+        """Test setStats publishes the summary as JSON."""
+        client = Mock()
+        with patch('lamp_control_mqtt.latency_stats', self.stats), \
+                patch('lamp_control_mqtt.transmitter', Mock()), \
+                patch('lamp_control_mqtt.sleep'):
+            self.send_message('on_off', "true")
+            lcm.publish_stats(client, None, Mock())
+
+        topic, = client.publish.call_args.args
+        assert topic == f"{lcm.BASE_TOPIC}getStats"
+        assert 'on_off' in json.loads(client.publish.call_args.kwargs['payload'])
+
+    def test_stats_dump(self, tmp_path):
+        """Test dumping the stats to a file."""
+        trace = lcm.CommandTrace('cct', lcm.LIVING_ROOM_LAMP)
+        trace.done = trace.received + 0.25
+        self.stats.record(trace)
+        path = tmp_path / "stats.json"
+
+        self.stats.dump(str(path))
+
+        assert json.loads(path.read_text())['cct']['total']['p99'] == 250.0
+
+
+class TestRFTransmitter:
+    """Test the long-lived RF transmitter."""
+
+    def test_device_created_once(self):
+        """Test the RF device is set up once and reused for every code."""
+        with patch('lamp_control_mqtt.RFDevice') as mock_device_class:
+            tx = lcm.RFTransmitter(4, 1, 161)
+            tx.send(lcm.LIVING_ROOM_LAMP)
+            tx.send(lcm.LIVING_ROOM_LAMP + lcm.BRIGHTNESS_UP_OFFSET)
+
+            mock_device_class.assert_called_once_with(4, tx_repeat=lcm.TX_REPEAT)
+            device = mock_device_class.return_value
+            device.enable_tx.assert_called_once()
+            assert device.tx_code.call_count == 2
+            device.disable_tx.assert_not_called()
+
+    def test_close_releases_pin(self):
+        """Test closing the transmitter releases only the TX pin."""
+        with patch('lamp_control_mqtt.RFDevice') as mock_device_class, \
+                patch('lamp_control_mqtt.GPIO') as mock_gpio:
+            tx = lcm.RFTransmitter(4)
+            tx.send(lcm.LIVING_ROOM_LAMP)
+            tx.close()
+
+            mock_device_class.return_value.disable_tx.assert_called_once()
+            mock_gpio.cleanup.assert_called_once_with(4)
+            assert tx.device is None
+
+    def test_close_unused(self):
+        """Test closing a transmitter that never sent is a no-op."""
+        with patch('lamp_control_mqtt.GPIO') as mock_gpio:
+            tx = lcm.RFTransmitter(4)
+            tx.close()
+            mock_gpio.cleanup.assert_not_called()
+
+    def test_send_rf_reuses_transmitter(self):
+        """Test send_rf shares one transmitter between calls."""
+        with patch('lamp_control_mqtt.transmitter', None), \
+                patch('lamp_control_mqtt.RFDevice') as mock_device_class, \
+                patch('lamp_control_mqtt.sleep'):
+            lcm.send_rf(lcm.LIVING_ROOM_LAMP)
+            lcm.send_rf(lcm.LIVING_ROOM_LAMP)
+
+            mock_device_class.assert_called_once()
+
+
+class TestVirtualRadioBackend:
+    """Test running the bridge on the virtual radio."""
+
+    def test_lamp_model_matches_bridge(self):
+        """Test the simulated lamp uses the bridge's codes and step count."""
+        vr = lcm.virtual_radio
+        assert vr.ON_OFF_OFFSET == lcm.ON_OFF_OFFSET
+        assert vr.CCT_OFFSET == lcm.CCT_OFFSET
+        assert vr.BRIGHTNESS_UP_OFFSET == lcm.BRIGHTNESS_UP_OFFSET
+        assert vr.BRIGHTNESS_DOWN_OFFSET == lcm.BRIGHTNESS_DOWN_OFFSET
+        assert vr.BR_LEVELS == lcm.BR_LEVELS
+        assert vr.HK_BR_MAX == lcm.HK_BR_MAX
+        assert vr.FRAME_PULSES == lcm.FRAME_PULSES
+        assert vr.TOGGLE_GAP == lcm.MIN_GAP
+
+    def test_make_rf_device(self):
+        """Test the backend follows radio_medium."""
+        medium = lcm.virtual_radio.RadioMedium(clock=lcm.virtual_radio.SimClock())
+        with patch('lamp_control_mqtt.radio_medium', medium), \
+                patch('lamp_control_mqtt.GPIO') as mock_gpio:
+            device = lcm.make_rf_device(4, tx_repeat=lcm.TX_REPEAT)
+            assert isinstance(device, lcm.virtual_radio.VirtualRFDevice)
+            assert device.node == lcm.RADIO_NODE
+            lcm.release_gpio(4)
+            mock_gpio.cleanup.assert_not_called()
+        with patch('lamp_control_mqtt.RFDevice') as mock_device_class:
+            assert lcm.make_rf_device(4) is mock_device_class.return_value
+
+    def test_no_rpi_rf(self):
+        """Test the GPIO backend explains itself when rpi_rf is missing."""
+        with patch('lamp_control_mqtt.RFDevice', None):
+            with pytest.raises(RuntimeError):
+                lcm.make_rf_device(4)
+
+    def test_lamp_converges(self):
+        """Test the simulated lamp ends up where the bridge thinks it is."""
+        vr = lcm.virtual_radio
+        medium = vr.RadioMedium(clock=vr.SimClock())
+        simulated = vr.SimulatedLamp(lcm.LIVING_ROOM_LAMP, medium)
+        client = Mock()
+        with patch('lamp_control_mqtt.radio_medium', medium), \
+                patch('lamp_control_mqtt.transmitter', None), \
+                patch('lamp_control_mqtt.state_publisher', None), \
+                patch('lamp_control_mqtt.sleep', lambda seconds: medium.clock.advance(seconds * 1e6)):
+            lamp = lcm.joofo_lamp(lcm.LIVING_ROOM_LAMP, client)
+            lamp.reset_lamp()
+            for level in (60, 20, 95, 4, 40):
+                lamp.set_brightness_level(level)
+                assert simulated.on == lamp.on
+                assert abs(simulated.brightness - lamp.brightness) <= lcm.BR_INCREMENT
+            lamp.on_off("false", True)
+            assert not simulated.on
+
+
+class TestVerifiedSend:
+    """Test resending only the transmissions the bridge didn't hear itself."""
+
+    CODE = lcm.LIVING_ROOM_LAMP + lcm.BRIGHTNESS_UP_OFFSET
+
+    def send(self, verifier, heard_on):
+        """Send CODE; the receiver hears the sends numbered in heard_on."""
+        sends = []
+
+        def send_code(code):
+            sends.append(code)
+            if len(sends) in heard_on:
+                verifier.heard(code)
+
+        return verifier.send(self.CODE, send_code), sends
+
+    def test_heard_first_time(self):
+        verifier = lcm.TxVerifier(0.01, 2)
+        assert self.send(verifier, {1}) == (True, [self.CODE])
+        assert verifier.summary() == {"LIVING_ROOM_LAMP": {
+            'codes': 1, 'first_try': 1, 'retries': 0, 'lost': 0, 'success': 100.0}}
+        assert verifier.pending == {}
+
+    def test_resent_until_heard(self):
+        verifier = lcm.TxVerifier(0.01, 2)
+        assert self.send(verifier, {2}) == (True, [self.CODE] * 2)
+        assert self.send(verifier, set()) == (False, [self.CODE] * 3)
+
+        stats = verifier.summary()["LIVING_ROOM_LAMP"]
+        assert stats == {'codes': 2, 'first_try': 0, 'retries': 3, 'lost': 1, 'success': 50.0}
+
+    def test_only_waited_for_codes_are_ours(self):
+        verifier = lcm.TxVerifier(0.01, 0)
+        assert not verifier.heard(self.CODE)
+        with patch('lamp_control_mqtt.tx_verifier', verifier):
+            assert not lcm.own_frame(self.CODE)
+        assert verifier.stats == {}
+
+    def test_own_frames_not_handled_as_remote(self):
+        """Test frames heard while verifying skip the handler, and don't count towards gaps."""
+        device = FakeRxDevice()
+        receiver = lcm.RFReceiver(device)
+        verifier = lcm.TxVerifier(1, 0)
+        verifier.pending[self.CODE] = False
+        handled = []
+        for code in (lcm.LIVING_ROOM_LAMP, self.CODE, lcm.STUDY_LAMPS):
+            time.sleep(0.01)
+            device.emit(code)
+        receiver.close()
+        with patch('lamp_control_mqtt.tx_verifier', verifier):
+            lcm.wait_rx(receiver, lambda code, timestamp, gap: handled.append((code, gap)))
+
+        assert [code for code, _ in handled] == [lcm.LIVING_ROOM_LAMP, lcm.STUDY_LAMPS]
+        assert handled[1][1] >= 20000
+        assert verifier.pending[self.CODE]
+
+    def test_lossy_virtual_radio(self):
+        """Test verified sends on a lossy virtual radio reach the lamp more often."""
+        vr = lcm.virtual_radio
+        medium = vr.RadioMedium(loss=0.3, clock=vr.SimClock(), seed=3)
+        lamp = vr.SimulatedLamp(lcm.LIVING_ROOM_LAMP, medium)
+        rxdevice = vr.VirtualRFDevice(23, medium)
+        receiver = lcm.RFReceiver(rxdevice)
+        rxdevice.enable_rx()
+        verifier = lcm.TxVerifier(0.1, 3)
+        handler = Mock()
+        with patch('lamp_control_mqtt.radio_medium', medium), \
+                patch('lamp_control_mqtt.transmitter', None), \
+                patch('lamp_control_mqtt.tx_verifier', verifier):
+            thread = threading.Thread(target=lcm.wait_rx, args=(receiver, handler))
+            thread.start()
+            for _ in range(20):
+                lcm.transmit(self.CODE)
+            receiver.close()
+            thread.join(timeout=5)
+
+        stats = verifier.stats[lcm.LIVING_ROOM_LAMP]
+        assert stats.codes == 20
+        assert stats.retries > 0 and stats.lost == 0
+        assert medium.sent == 20 + stats.retries
+        assert not handler.called
+        # Resends the bridge needed make up for some of the lamp's losses too
+        assert lamp.level > 1
+
+
+class TestEchoFilter:
+    """Test dropping our own transmissions when the receiver hears them."""
+
+    CODE = lcm.LIVING_ROOM_LAMP + lcm.BRIGHTNESS_UP_OFFSET
+
+    def test_window(self):
+        clock = lcm.virtual_radio.SimClock(1000000)
+        echoes = lcm.EchoFilter(200000, clock)
+        echoes.sent(self.CODE)
+
+        assert echoes.echo(self.CODE, 1090000)
+        assert not echoes.echo(self.CODE, 1300000)
+        assert not echoes.echo(self.CODE, 900000)
+        assert not echoes.echo(lcm.LIVING_ROOM_LAMP, 1090000)
+        assert echoes.suppressed == 1
+
+    def test_table_stays_small(self):
+        clock = lcm.virtual_radio.SimClock()
+        echoes = lcm.EchoFilter(200000, clock)
+        for i in range(100):
+            echoes.sent(self.CODE + (i % 2) * 4)
+            clock.advance(50000)
+
+        assert len(echoes.recent) <= 5
+        assert set(echoes.last_sent) == {self.CODE, self.CODE + 4}
+        clock.advance(1000000)
+        echoes.sent(lcm.LIVING_ROOM_LAMP)
+        assert list(echoes.last_sent) == [lcm.LIVING_ROOM_LAMP]
+
+    def test_echo_does_not_move_brightness(self):
+        """Test hearing our own BRUP doesn't add a remote step on top of ours."""
+        lcm.lamps.clear()
+        lamp = lcm.find_or_create_lamp(lcm.lamps, lcm.LIVING_ROOM_LAMP, Mock())
+        lamp.on, lamp.brightness = True, 50
+        device = FakeRxDevice()
+        receiver = lcm.RFReceiver(device)
+        with patch('lamp_control_mqtt.echo_filter', lcm.EchoFilter()) as echoes, \
+                patch('lamp_control_mqtt.get_transmitter'), \
+                patch('lamp_control_mqtt.RF_DELAY', 0), \
+                patch('lamp_control_mqtt.burst_aggregator', None), \
+                patch('lamp_control_mqtt.state_publisher', None):
+            lamp.brup(False, False)
+            device.emit(self.CODE)
+            receiver.close()
+            lcm.wait_rx(receiver, lcm.handle_rx)
+        lcm.lamps.clear()
+
+        assert lamp.brightness == pytest.approx(50 + lcm.BR_INCREMENT)
+        assert echoes.suppressed == 1
+
+    def test_echo_heard_by_other_cluster_node(self):
+        """Test our transmission reported by another node isn't a remote press."""
+        handler = Mock()
+        node = lcm.bridge_cluster.ClusterNode(Mock(), "pi-a", handler, lcm.lamp_of,
+                                              own_frame=lcm.own_frame)
+
+        def heard_by_pi_b(code):
+            payload = json.dumps({'node': "pi-b", 'code': code, 'timestamp': 5000000})
+            node.on_message(None, None, FakeMessage(node.topic("frames", "pi-b"), payload))
+
+        with patch('lamp_control_mqtt.echo_filter', lcm.EchoFilter()) as echoes, \
+                patch('lamp_control_mqtt.get_transmitter'):
+            lcm.send_code(self.CODE)
+            heard_by_pi_b(self.CODE)
+            heard_by_pi_b(lcm.LIVING_ROOM_LAMP)
+
+        handler.assert_called_once()
+        assert handler.call_args[0][0] == lcm.LIVING_ROOM_LAMP
+        assert node.echoes == echoes.suppressed == 1
+
+    def test_drifted_receiver_timestamp(self):
+        """Test echoes are matched on our clock, whatever clock the receiver stamps frames with."""
+        echoes = lcm.EchoFilter()
+        handled = []
+
+        class DriftedReceiver:
+            # pigpio ticks an hour away from perf_counter
+            frames = [lcm.RxFrame(self.CODE, lcm.rx_clock() + 3600 * 1000000, 350, 1)]
+
+            def get(self):
+                return self.frames.pop(0) if self.frames else None
+
+        with patch('lamp_control_mqtt.echo_filter', echoes):
+            echoes.sent(self.CODE)
+            lcm.wait_rx(DriftedReceiver(), lambda *frame: handled.append(frame))
+
+        assert handled == []
+        assert echoes.suppressed == 1
+
+    def test_verifier_sees_frames_first(self):
+        verifier = lcm.TxVerifier(1, 0)
+        verifier.pending[self.CODE] = False
+        echoes = lcm.EchoFilter()
+        echoes.sent(self.CODE)
+        with patch('lamp_control_mqtt.tx_verifier', verifier), \
+                patch('lamp_control_mqtt.echo_filter', echoes):
+            assert lcm.own_frame(self.CODE)
+            assert verifier.pending[self.CODE] and echoes.suppressed == 0
+            del verifier.pending[self.CODE]
+            # A second decode of the same transmission
+            assert lcm.own_frame(self.CODE)
+        assert echoes.suppressed == 1
+
+
+class TestLampGroups:
+    """Test group codes and scenes."""
+
+    @pytest.fixture
+    def study(self):
+        """The study group, its members, and the codes sent."""
+        lcm.lamps.clear()
+        sent = []
+        with patch('lamp_control_mqtt.send_rf', side_effect=sent.append), \
+                patch('lamp_control_mqtt.tx_worker', None), \
+                patch('lamp_control_mqtt.state_publisher', None):
+            group = lcm.find_or_create_lamp(lcm.lamps, lcm.STUDY_LAMPS, Mock())
+            yield group, group.members, sent
+        lcm.lamps.clear()
+
+    def test_ramp_updates_every_member(self, study):
+        group, (desk, table), sent = study
+        for lamp in (desk, table):
+            lamp.on, lamp.brightness = True, 30
+        group.set_brightness_level(70)
+
+        assert sent and all(lcm.lamp_of(code) == lcm.STUDY_LAMPS for code in sent)
+        assert len(sent) == len(lcm.plan_brightness(30, True, 70).commands)
+        assert desk.brightness == table.brightness == group.brightness
+        assert math.ceil(desk.brightness) >= 70
+
+    def test_members_apart_are_brought_together(self, study):
+        """Test members at different levels, one of them off, still end up at the target."""
+        group, (desk, table), sent = study
+        desk.on, desk.brightness = True, 80
+        table.on, table.brightness = False, 10
+        group.set_brightness_level(40)
+
+        assert sent[:3] == [lcm.STUDY_LAMPS + lcm.BRIGHTNESS_UP_OFFSET,
+                            lcm.STUDY_LAMPS + lcm.ON_OFF_OFFSET,
+                            lcm.STUDY_LAMPS + lcm.BRIGHTNESS_UP_OFFSET]
+        assert desk.on and table.on
+        assert desk.brightness == table.brightness == group.brightness
+
+    def test_group_matches_simulated_lamps(self):
+        """Test simulated lamps paired with the group end up where the bridge thinks."""
+        vr = lcm.virtual_radio
+        medium = vr.RadioMedium(clock=vr.SimClock())
+        simulated = [vr.SimulatedLamp(lamp_id, medium, (lcm.STUDY_LAMPS,))
+                     for lamp_id in (lcm.STUDY_DESK_LAMP, lcm.STUDY_TABLE_LAMP)]
+        lcm.lamps.clear()
+        with patch('lamp_control_mqtt.radio_medium', medium), \
+                patch('lamp_control_mqtt.transmitter', None), \
+                patch('lamp_control_mqtt.state_publisher', None), \
+                patch('lamp_control_mqtt.sleep', lambda seconds: medium.clock.advance(seconds * 1e6)):
+            group = lcm.find_or_create_lamp(lcm.lamps, lcm.STUDY_LAMPS, Mock())
+            desk, table = group.members
+            group.reset_lamp()
+            desk.set_brightness_level(90)
+            for level in (50, 20, 75):
+                group.set_brightness_level(level)
+                for sim, lamp in zip(simulated, group.members):
+                    assert sim.on == lamp.on
+                    assert abs(sim.brightness - lamp.brightness) <= lcm.BR_INCREMENT
+            table.on_off("false", True)
+            group.on_off("false", True)
+            assert not any(sim.on for sim in simulated)
+        lcm.lamps.clear()
+
+    def test_on_off_only_uses_group_when_members_agree(self, study):
+        group, (desk, table), sent = study
+        desk.on = True
+        group.on_off("true", True)
+        assert sent == [lcm.STUDY_TABLE_LAMP + lcm.ON_OFF_OFFSET]
+
+        sent.clear()
+        group.on_off("false", True)
+        assert sent == [lcm.STUDY_LAMPS + lcm.ON_OFF_OFFSET]
+        assert not desk.on and not table.on
+
+    def test_remote_group_press_updates_members(self, study):
+        group, (desk, table), _ = study
+        lcm.handle_rx(lcm.STUDY_LAMPS + lcm.ON_OFF_OFFSET, 0, lcm.MIN_GAP + 1)
+        assert desk.on and table.on
+        lcm.handle_rx(lcm.STUDY_LAMPS + lcm.BRIGHTNESS_UP_OFFSET, 0, lcm.MIN_GAP + 1)
+        assert desk.brightness == table.brightness == lcm.REMOTE_BRUP_INCREMENT
+
+    def test_scene_uses_group_code(self, study):
+        """Test setting the whole study costs one ramp rather than one per lamp."""
+        group, (desk, table), sent = study
+        living = lcm.find_or_create_lamp(lcm.lamps, lcm.LIVING_ROOM_LAMP, Mock())
+        payload = json.dumps({str(lcm.STUDY_LAMPS): {"brightness": 60},
+                              str(lcm.LIVING_ROOM_LAMP): {"on": True}})
+        targets = {lcm.STUDY_DESK_LAMP: (True, 60), lcm.STUDY_TABLE_LAMP: (True, 60),
+                   lcm.LIVING_ROOM_LAMP: (True, None)}
+        commands, frames = lcm.plan_scene(targets)
+        separate = desk.plan_scene(True, 60)[1] + table.plan_scene(True, 60)[1] + 1
+
+        lcm.set_scene(Mock(), None, FakeMessage(f"{lcm.BASE_TOPIC}setScene", payload))
+
+        assert [(lamp, command_type) for lamp, command_type, _ in commands] == \
+            [(group, 'brightness'), (living, 'on_off')]
+        assert len(sent) == frames < separate
+        assert {lcm.lamp_of(code) for code in sent} == {lcm.STUDY_LAMPS, lcm.LIVING_ROOM_LAMP}
+        assert desk.on and table.on and living.on
+        assert desk.brightness == table.brightness
+        assert abs(desk.brightness - 60) <= lcm.BR_INCREMENT
+
+    def test_scene_member_settings_win(self, study):
+        group, (desk, table), sent = study
+        payload = json.dumps({str(lcm.STUDY_LAMPS): {"on": True},
+                              str(lcm.STUDY_TABLE_LAMP): {"on": False}})
+        lcm.set_scene(Mock(), None, FakeMessage(f"{lcm.BASE_TOPIC}setScene", payload))
+
+        assert sent == [lcm.STUDY_DESK_LAMP + lcm.ON_OFF_OFFSET]
+        assert desk.on and not table.on
+
+    def test_bad_scene_ignored(self, study):
+        _, _, sent = study
+        for payload in ("not json", "[1]", '{"3513633": 5}', '{"42": {"on": true}}'):
+            lcm.set_scene(Mock(), None, FakeMessage(f"{lcm.BASE_TOPIC}setScene", payload))
+        assert sent == []
+
+
+class FakeMessage:
+    """Minimal paho MQTTMessage."""
+
+    def __init__(self, topic, payload):
+        self.topic = topic
+        self.payload = payload.encode("utf-8")
+
+
+class TestTopicRouter:
+    """Test the single-pass MQTT topic router."""
+
+    def setup_method(self):
+        lcm.lamps.clear()
+
+    def teardown_method(self):
+        lcm.lamps.clear()
+
+    def test_routes_for_registry(self):
+        """Test a route exists for the shared topics plus every lamp command topic."""
+        router = lcm.TopicRouter(lcm.registry)
+
+        # setReset, setStats and setScene plus three commands per lamp
+        assert len(router.routes) == 3 + 3 * len(lcm.registry)
+        assert f"{lcm.BASE_TOPIC}{lcm.STUDY_LAMPS}/setBrightness" in router.routes
+
+    def test_dispatch_command(self):
+        """Test a set topic reaches the lamp."""
+        router = lcm.TopicRouter(lcm.registry)
+        message = FakeMessage(f"{lcm.BASE_TOPIC}{lcm.LIVING_ROOM_LAMP}/setOnOff", "true")
+
+        with patch('lamp_control_mqtt.send_rf'):
+            router(Mock(), None, message)
+
+        assert lcm.lamps[lcm.LIVING_ROOM_LAMP].on == True
+
+    def test_unknown_lamp_rejected(self):
+        """Test topics for unknown lamps are dropped without creating lamps."""
+        router = lcm.TopicRouter(lcm.registry)
+
+        router(Mock(), None, FakeMessage(f"{lcm.BASE_TOPIC}1234/setOnOff", "true"))
+        router(Mock(), None, FakeMessage(f"{lcm.BASE_TOPIC}{lcm.STUDY_LAMPS}/setFoo", "1"))
+
+        assert router.rejected == 2
+        assert len(lcm.lamps) == 0
+
+    def test_state_topics_ignored(self):
+        """Test our own get topics are ignored without counting as rejects."""
+        router = lcm.TopicRouter(lcm.registry)
+
+        router(Mock(), None, FakeMessage(f"{lcm.BASE_TOPIC}{lcm.STUDY_LAMPS}/getOnOff", "true"))
+
+        assert router.rejected == 0
+
+    def test_reset_unknown_lamp_rejected(self):
+        """Test a reset for an unknown lamp is dropped."""
+        router = lcm.TopicRouter(lcm.registry)
+
+        router(Mock(), None, FakeMessage(f"{lcm.BASE_TOPIC}setReset", "1234"))
+        router(Mock(), None, FakeMessage(f"{lcm.BASE_TOPIC}setReset", "bogus"))
+
+        assert len(lcm.lamps) == 0
+
+    def test_dispatch_is_one_lookup(self):
+        """Test routing is a single dict lookup whatever the lamp count."""
+        class CountingRoutes(dict):
+            lookups = 0
+
+            def get(self, key, default=None):
+                CountingRoutes.lookups += 1
+                return super().get(key, default)
+
+        for count in (4, 400):
+            registry = lcm.LampRegistry((1000000 + 10 * i, f"LAMP_{i}") for i in range(count))
+            router = lcm.TopicRouter(registry)
+            assert len(router.routes) == 3 + count * len(lcm.TOPIC_COMMANDS)
+            topic = f"{lcm.BASE_TOPIC}1000000/set{lcm.ON_OFF_TOPIC}"
+            handler = Mock()
+            router.routes = CountingRoutes(router.routes, **{topic: handler})
+            CountingRoutes.lookups = 0
+            router(None, None, FakeMessage(topic, "1"))
+            router(None, None, FakeMessage(f"{lcm.BASE_TOPIC}42/set{lcm.ON_OFF_TOPIC}", "1"))
+            assert CountingRoutes.lookups == 2
+            handler.assert_called_once()
+
+
+class TestClusterMode:
+    """Test the bridge as one node of a cluster."""
+
+    @pytest.fixture
+    def node(self):
+        """A node that owns every lamp but the living room lamp."""
+        node = Mock()
+        node.owns.side_effect = lambda lamp_id: lamp_id != lcm.LIVING_ROOM_LAMP
+        node.owner.return_value = "pi-b"
+        lcm.lamps.clear()
+        with patch('lamp_control_mqtt.cluster', node), \
+                patch('lamp_control_mqtt.tx_worker', None), \
+                patch('lamp_control_mqtt.state_publisher', None):
+            yield node
+        lcm.lamps.clear()
+
+    def test_commands_left_to_owner(self, node):
+        lamp = lcm.joofo_lamp(lcm.LIVING_ROOM_LAMP, Mock())
+        owned = lcm.joofo_lamp(lcm.STUDY_DESK_LAMP, Mock())
+        with patch('lamp_control_mqtt.send_rf') as mock_send:
+            lcm.submit_command(lamp, 'on_off', "true")
+            lcm.submit_command(owned, 'on_off', "true")
+
+        mock_send.assert_called_once_with(lcm.STUDY_DESK_LAMP + lcm.ON_OFF_OFFSET)
+        assert not lamp.on and owned.on
+
+    def test_mirrors_state_of_lamps_owned_elsewhere(self, node):
+        router = lcm.TopicRouter(lcm.registry)
+        client = Mock()
+        router(client, None, FakeMessage(f"{lcm.BASE_TOPIC}{lcm.LIVING_ROOM_LAMP}/getOnOff", "true"))
+        router(client, None,
+               FakeMessage(f"{lcm.BASE_TOPIC}{lcm.LIVING_ROOM_LAMP}/getBrightness", "42"))
+        # Our own state echoed back for a lamp we own is not applied
+        router(client, None,
+               FakeMessage(f"{lcm.BASE_TOPIC}{lcm.STUDY_DESK_LAMP}/getBrightness", "42"))
+
+        assert lcm.lamps[lcm.LIVING_ROOM_LAMP].on
+        assert lcm.lamps[lcm.LIVING_ROOM_LAMP].brightness == 42
+        assert lcm.STUDY_DESK_LAMP not in lcm.lamps
+        assert router.rejected == 0
+
+    def test_mirrored_state_not_republished(self, node):
+        publisher = lcm.StatePublisher(Mock(), 0)
+        topic = f"{lcm.BASE_TOPIC}{lcm.LIVING_ROOM_LAMP}/getBrightness"
+        with patch('lamp_control_mqtt.state_publisher', publisher):
+            lcm.mirror_state(Mock(), None, FakeMessage(topic, "42"))
+            publisher.publish(topic, 42)
+
+        publisher.client.publish.assert_not_called()
+
+    def test_no_mirror_routes_without_cluster(self):
+        router = lcm.TopicRouter(lcm.registry)
+        assert not any("/get" in topic for topic in router.routes)
+
+    def test_lamp_of(self):
+        assert lcm.lamp_of(lcm.STUDY_LAMPS + lcm.CCT_OFFSET) == lcm.STUDY_LAMPS
+        assert lcm.lamp_of(42) is None
+
+
+class TestLampStateStore:
+    """Test saving lamp state and the warm start from it."""
+
+    @pytest.fixture
+    def store(self, tmp_path):
+        lcm.lamps.clear()
+        with patch('lamp_control_mqtt.state_store', None), \
+                patch('lamp_control_mqtt.state_publisher', None):
+            yield lcm.LampStateStore(str(tmp_path / "lamp_state.json"), delay=0.05)
+        lcm.lamps.clear()
+
+    def test_save_and_load(self, store):
+        lamp = lcm.find_or_create_lamp(lcm.lamps, lcm.LIVING_ROOM_LAMP, Mock())
+        lamp.on, lamp.brightness, lamp.color_temp, lamp.reset = True, 42.5, 3, True
+        store.save()
+
+        saved = store.load()
+        assert saved[lcm.LIVING_ROOM_LAMP] == {'on': True, 'brightness': 42.5,
+                                               'color_temp': 3, 'reset': True}
+        assert not os.path.exists(store.path + ".tmp")
+
+    def test_unchanged_state_not_rewritten(self, store):
+        lcm.find_or_create_lamp(lcm.lamps, lcm.LIVING_ROOM_LAMP, Mock())
+        store.save()
+        store.save()
+        assert store.saves == 1
+
+    def test_saves_do_not_overlap(self, store):
+        """Test a save from another thread waits for the one writing the file."""
+        lamp = lcm.find_or_create_lamp(lcm.lamps, lcm.LIVING_ROOM_LAMP, Mock())
+        fsync = os.fsync
+        other = threading.Thread(target=store.save)
+
+        def first_fsync(fd):
+            if other.ident is None:
+                lamp.brightness = 77
+                other.start()
+                other.join(timeout=0.2)
+                assert other.is_alive()
+            fsync(fd)
+
+        with patch('lamp_control_mqtt.os.fsync', side_effect=first_fsync):
+            store.save()
+            other.join(timeout=5)
+
+        assert store.saves == 2
+        assert store.load()[lcm.LIVING_ROOM_LAMP]['brightness'] == 77
+
+    def test_missing_or_corrupt_file(self, store):
+        assert store.load() == {}
+        with open(store.path, 'w') as f:
+            f.write('{"lamps": {"3513633": {"on": tr')
+        assert store.load() == {}
+
+    def test_changes_saved_once_after_delay(self, store):
+        lamp = lcm.find_or_create_lamp(lcm.lamps, lcm.LIVING_ROOM_LAMP, Mock())
+        with patch('lamp_control_mqtt.state_store', store), \
+                patch('lamp_control_mqtt.send_rf'):
+            lamp.on = True
+            for _ in range(5):
+                lamp.brup(False, True)
+            time.sleep(0.2)
+
+        assert store.saves == 1
+        assert store.load()[lcm.LIVING_ROOM_LAMP]['brightness'] == lamp.brightness
+
+    def test_warm_start(self, store):
+        """Test restored state is published retained and nothing is transmitted."""
+        with open(store.path, 'w') as f:
+            json.dump({'lamps': {str(lcm.STUDY_DESK_LAMP): {
+                'on': True, 'brightness': 60, 'color_temp': 2, 'reset': False}}}, f)
+        client = Mock()
+        with patch('lamp_control_mqtt.send_rf') as mock_send:
+            lcm.warm_start(client, store)
+            lcm.on_connect(client, None, None, 0)
+            store.close()
+
+        lamp = lcm.lamps[lcm.STUDY_DESK_LAMP]
+        assert lamp.on and lamp.brightness == 60 and lamp.color_temp == 2
+        # The study group follows its desk lamp
+        assert store.restored == [lcm.STUDY_DESK_LAMP, lcm.STUDY_LAMPS]
+        topic = f"{lcm.BASE_TOPIC}{lcm.STUDY_DESK_LAMP}/get"
+        assert client.publish.call_args_list[:3] == [
+            call(f"{topic}OnOff", payload="true", qos=0, retain=True),
+            call(f"{topic}Brightness", payload=60, qos=0, retain=True),
+            call(f"{topic}cct", payload=2, qos=0, retain=True)]
+        group_topic = f"{lcm.BASE_TOPIC}{lcm.STUDY_LAMPS}/get"
+        assert call(f"{group_topic}Brightness", payload=60, qos=0, retain=True) in \
+            client.publish.call_args_list
+        mock_send.assert_not_called()
+        assert store.load()[lcm.STUDY_DESK_LAMP] == {'on': True, 'brightness': 60,
+                                                     'color_temp': 2, 'reset': False}
+
+
 class TestMQTTCallbacks:
     """Test MQTT connection callbacks."""
 
@@ -490,11 +2010,13 @@ class TestMQTTCallbacks:
         """Test on_connect callback."""
         mock_client = Mock()
 
-        with patch('lamp_control_mqtt.joofo_lamp') as mock_lamp_class:
+        with patch('lamp_control_mqtt.joofo_lamp') as mock_lamp_class, \
+                patch('lamp_control_mqtt.joofo_group') as mock_group_class:
             lcm.on_connect(mock_client, None, None, 0)
 
-            # Should create 4 lamps
-            assert mock_lamp_class.call_count == 4
+            # Should create 3 lamps and the study group
+            assert mock_lamp_class.call_count == 3
+            assert mock_group_class.call_count == 1
 
     def test_on_disconnect_unexpected(self):
         """Test on_disconnect with unexpected disconnect."""
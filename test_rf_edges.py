@@ -0,0 +1,305 @@
+"""
+Tests for rf_edges.py
+
+Run with: pytest test_rf_edges.py -v
+"""
+
+import random
+import time
+from unittest.mock import patch
+
+import pytest
+
+import rf_edges
+
+LAMP = 3513633
+# Protocols whose sync gap is long enough for rpi_rf's decoder to see it
+RECEIVABLE = [pnum for pnum in range(1, len(rf_edges.PROTOCOLS))
+              if rf_edges.PROTOCOLS[pnum].sync_low * rf_edges.PROTOCOLS[pnum].pulselength
+              > rf_edges.SYNC_GAP]
+
+
+def noisy_stream(seed, count):
+    """Codes from every protocol with jitter and noise edges in between.
+
+    Returns:
+        (edge timestamps, codes sent)
+    """
+    rnd = random.Random(seed)
+    edges = []
+    sent = []
+    now = 100000
+    for _ in range(count):
+        protocol = rnd.choice(RECEIVABLE)
+        code = rnd.randrange(1, 1 << 24)
+        frame = rf_edges.code_edges(code, protocol, repeat=rnd.choice([2, 3, 10]), start=now)
+        edges.extend(edge + rnd.randint(-30, 30) for edge in frame)
+        sent.append(code)
+        now = frame[-1] + rnd.randint(1000, 40000)
+        for _ in range(rnd.randint(0, 20)):
+            now += rnd.randint(50, 3000)
+            edges.append(now)
+        now += 20000
+    edges.sort()
+    return edges, sent
+
+
+class TestEdgeDecoder:
+    """Test decoding edge timestamps."""
+
+    @pytest.mark.parametrize("protocol", RECEIVABLE)
+    def test_every_protocol(self, protocol):
+        edges = rf_edges.code_edges(LAMP, protocol, repeat=10)
+        frames = rf_edges.EdgeDecoder().feed(edges)
+        assert frames
+        assert all(frame.code == LAMP for frame in frames)
+        assert all(frame.protocol == protocol for frame in frames)
+        assert frames[0].pulselength == pytest.approx(rf_edges.PROTOCOLS[protocol].pulselength, abs=2)
+
+    def test_short_sync_not_received(self):
+        """Test protocols 4 and 6 are missed, as they are by rpi_rf."""
+        assert RECEIVABLE == [1, 2, 3, 5]
+        edges = rf_edges.code_edges(LAMP, 4, repeat=10)
+        assert rf_edges.EdgeDecoder().feed(edges) == []
+
+    def test_decoded_once_per_two_syncs(self):
+        edges = rf_edges.code_edges(LAMP, repeat=10, start=1000)
+        frames = rf_edges.EdgeDecoder().feed(edges)
+        assert len(frames) == 4
+        # Timestamped at the edge that ends the second matching sync
+        assert frames[0].timestamp in edges
+        assert [frame.timestamp for frame in frames] == sorted(frame.timestamp for frame in frames)
+
+    def test_batches_match_single_pass(self):
+        edges, _ = noisy_stream(1, 50)
+        whole = rf_edges.EdgeDecoder().feed(edges)
+        decoder = rf_edges.EdgeDecoder()
+        batched = []
+        for i in range(0, len(edges), 37):
+            batched.extend(decoder.feed(edges[i:i + 37]))
+        assert batched == whole
+        assert len(whole) > 0
+
+    def test_noisy_stream(self):
+        edges, sent = noisy_stream(2, 100)
+        codes = [frame.code for frame in rf_edges.EdgeDecoder().feed(edges)]
+        # Like rpi_rf, noise right after a frame can still decode to junk
+        genuine = [code for code in codes if code in sent]
+        assert len(genuine) > 0.8 * len(codes)
+        assert len(set(genuine)) > len(sent) / 2
+
+    def test_noise_alone_decodes_nothing(self):
+        rnd = random.Random(3)
+        now = 0
+        edges = []
+        for _ in range(5000):
+            now += rnd.randint(50, 3000)
+            edges.append(now)
+        assert rf_edges.EdgeDecoder().feed(edges) == []
+
+
+class FakePi:
+    """pigpio.pi with just what PigpioReceiver uses."""
+
+    def __init__(self, tick=0):
+        self.connected = True
+        self.tick = tick
+        self.glitch = {}
+        self.closed = []
+        self.stopped = False
+
+    def set_mode(self, gpio, mode):
+        pass
+
+    def set_glitch_filter(self, gpio, steady):
+        self.glitch[gpio] = steady
+
+    def get_current_tick(self):
+        return self.tick
+
+    def read(self, gpio):
+        return 0
+
+    def notify_open(self):
+        return 0
+
+    def notify_begin(self, handle, bits):
+        self.bits = bits
+
+    def notify_close(self, handle):
+        self.closed.append(handle)
+
+    def stop(self):
+        self.stopped = True
+
+
+def write_reports(path, gpio, edges, tick=0, flags=0):
+    """Write notification reports for a pin toggling at each edge."""
+    report = rf_edges.PigpioReceiver.REPORT
+    with open(path, 'wb') as f:
+        level = 0
+        for seqno, edge in enumerate(edges):
+            level ^= 1 << gpio
+            f.write(report.pack(seqno & 0xFFFF, flags, (tick + edge) % (1 << 32), level))
+
+
+class TestPigpioReceiver:
+    """Test reading codes from a pigpio notification pipe."""
+
+    def receiver(self, tmp_path, edges, tick=0, **kwargs):
+        write_reports(tmp_path / "pigpio0", 23, edges, tick=tick)
+        pi = FakePi(tick)
+        pipe = str(tmp_path / "pigpio{}")
+        with pytest.MonkeyPatch.context() as monkeypatch:
+            monkeypatch.setattr(rf_edges.PigpioReceiver, 'NOTIFY_PIPE', pipe)
+            receiver = rf_edges.PigpioReceiver(23, glitch=150, pi=pi, batch_interval=0, **kwargs)
+        return receiver, pi
+
+    def test_decodes_codes(self, tmp_path):
+        edges = rf_edges.code_edges(LAMP, repeat=10, start=1000)
+        receiver, pi = self.receiver(tmp_path, edges)
+        frame = receiver.get(timeout=1)
+        assert frame.code == LAMP
+        assert frame.protocol == 1
+        assert pi.glitch[23] == 150
+        assert pi.bits == 1 << 23
+
+    def test_returns_none_at_end_of_stream(self, tmp_path):
+        edges = rf_edges.code_edges(LAMP, repeat=4, start=1000)
+        receiver, _ = self.receiver(tmp_path, edges)
+        frames = []
+        while True:
+            frame = receiver.get(timeout=1)
+            if frame is None:
+                break
+            frames.append(frame)
+        assert [frame.code for frame in frames] == [LAMP]
+        assert receiver.edges == len(edges)
+
+    def test_timestamps_on_perf_counter_clock(self, tmp_path):
+        edges = rf_edges.code_edges(LAMP, repeat=4, start=1000)
+        before = time.perf_counter() * 1e6
+        receiver, _ = self.receiver(tmp_path, edges)
+        frame = receiver.get(timeout=1)
+        after = time.perf_counter() * 1e6
+        assert before + edges[0] <= frame.timestamp <= after + edges[-1]
+
+    def test_tick_wraparound(self, tmp_path):
+        edges = rf_edges.code_edges(LAMP, repeat=4, start=1000)
+        receiver, _ = self.receiver(tmp_path, edges, tick=(1 << 32) - 5000)
+        frame = receiver.get(timeout=1)
+        assert frame.code == LAMP
+
+    def test_skips_flagged_reports(self, tmp_path):
+        receiver = rf_edges.PigpioReceiver.__new__(rf_edges.PigpioReceiver)
+        receiver.gpio = 23
+        receiver.level = 0
+        receiver.anchor_tick = 0
+        receiver.anchor_timestamp = 0
+        report = rf_edges.PigpioReceiver.REPORT
+        data = (report.pack(0, 0x40, 100, 1 << 23) +  # keep-alive
+                report.pack(1, 0, 200, 1 << 23) +
+                report.pack(2, 0, 300, (1 << 23) | 1) +  # another pin
+                report.pack(3, 0, 400, 0))
+        assert receiver.edge_timestamps(data) == [200, 400]
+
+    def test_timestamps_from_latest_anchor(self):
+        """Test timestamps count from the last anchor, so tick drift doesn't add up."""
+        receiver = rf_edges.PigpioReceiver.__new__(rf_edges.PigpioReceiver)
+        receiver.gpio = 23
+        receiver.level = 0
+        receiver.pi = FakePi(tick=5000)
+        report = rf_edges.PigpioReceiver.REPORT
+        with patch('rf_edges.time.perf_counter', return_value=10.0):
+            receiver.anchor()
+        # Edges that happened before the anchor but were read after it
+        data = report.pack(0, 0, 4000, 1 << 23) + report.pack(1, 0, 3000, 0)
+        assert receiver.edge_timestamps(data) == [9999000, 9998000]
+        # Anchored just before the tick wraps
+        receiver.pi.tick = (1 << 32) - 1000
+        with patch('rf_edges.time.perf_counter', return_value=20.0):
+            receiver.anchor()
+        data = report.pack(2, 0, 500, 1 << 23)
+        assert receiver.edge_timestamps(data) == [20001500]
+
+    def test_close(self, tmp_path):
+        receiver, pi = self.receiver(tmp_path, [])
+        receiver.close()
+        receiver.close()
+        assert pi.closed == [0]
+        assert pi.glitch[23] == 0
+        # The receiver did not open the connection, so leaves it up
+        assert not pi.stopped
+        assert receiver.get(timeout=0) is None
+
+    def test_needs_daemon(self):
+        pi = FakePi()
+        pi.connected = False
+        with pytest.raises(RuntimeError):
+            rf_edges.PigpioReceiver(23, pi=pi)
+
+
+def adversarial_stream(seed, count):
+    """Edges that exercise the decoder's corner cases: long noise bursts that
+    overflow the timing buffer, 32 bit codes, and gaps near the sync limits."""
+    rnd = random.Random(seed)
+    now = 0
+    edges = []
+    while len(edges) < count:
+        choice = rnd.random()
+        if choice < 0.3:
+            frame = rf_edges.code_edges(rnd.randrange(1, 1 << 32), rnd.choice(RECEIVABLE),
+                                        repeat=rnd.randint(1, 6), length=rnd.choice([24, 32]),
+                                        start=now)
+            edges.extend(frame)
+            now = frame[-1] + rnd.randint(1, 12000)
+        elif choice < 0.6:
+            for _ in range(rnd.randint(50, 200)):
+                now += rnd.randint(50, 4000)
+                edges.append(now)
+        else:
+            now += rnd.choice([5001, 5100, 10850, 10900, rnd.randint(1, 20000)])
+            edges.append(now)
+    return edges
+
+
+class TestDecodeEdges:
+    """Test the vectorized decoder against EdgeDecoder."""
+
+    @pytest.fixture(autouse=True)
+    def numpy(self):
+        return pytest.importorskip("numpy")
+
+    @pytest.mark.parametrize("seed", range(5))
+    def test_matches_edge_decoder(self, seed):
+        edges, _ = noisy_stream(seed, 60)
+        expected = rf_edges.EdgeDecoder().feed(edges)
+        assert rf_edges.decode_edges(edges) == expected
+        assert len(expected) > 0
+
+    @pytest.mark.parametrize("seed", range(20))
+    def test_matches_edge_decoder_corner_cases(self, seed):
+        edges = adversarial_stream(seed, 3000)
+        assert rf_edges.decode_edges(edges) == rf_edges.EdgeDecoder().feed(edges)
+
+    def test_tolerance(self, numpy):
+        edges = adversarial_stream(1, 3000)
+        assert rf_edges.decode_edges(numpy.array(edges), rx_tolerance=40) == \
+            rf_edges.EdgeDecoder(rx_tolerance=40).feed(edges)
+
+    def test_levels_drop_repeated_reports(self):
+        edges = rf_edges.code_edges(LAMP, repeat=10, start=1000)
+        levels = [(i + 1) % 2 for i in range(len(edges))]
+        # A repeated report of the same level is not an edge
+        edges.insert(10, edges[9] + 1)
+        levels.insert(10, levels[9])
+        frames = rf_edges.decode_edges(edges, levels)
+        assert [frame.code for frame in frames] == [LAMP] * 4
+
+    def test_returns_python_ints(self):
+        frame = rf_edges.decode_edges(rf_edges.code_edges(LAMP, repeat=4))[0]
+        assert all(type(value) is int for value in frame)
+
+    def test_empty(self):
+        assert rf_edges.decode_edges([]) == []
+        assert rf_edges.decode_edges([100, 200, 300]) == []
@@ -0,0 +1,187 @@
+"""
+Tests for rf_journal.py
+
+Run with: pytest test_rf_journal.py -v
+"""
+
+import os
+from unittest.mock import patch
+
+import pytest
+
+import rf_journal
+from rf_journal import Record
+
+LAMP = 3513633
+
+
+class Frame:
+    """A received frame as rpi_rf reports it."""
+
+    def __init__(self, code, timestamp, pulselength=350, protocol=1):
+        self.code = code
+        self.timestamp = timestamp
+        self.pulselength = pulselength
+        self.protocol = protocol
+
+
+def writer(path, **kwargs):
+    journal = rf_journal.JournalWriter(str(path), **kwargs)
+    # Record frame timestamps as they are, to keep the expectations simple
+    journal.wall_offset = 0
+    return journal
+
+
+def write(path, frames, **kwargs):
+    journal = writer(path, **kwargs)
+    for frame, command in frames:
+        journal.append(frame, command)
+    journal.close()
+    return journal
+
+
+class TestJournalWriter:
+    """Test appending and rotating."""
+
+    def test_fixed_width_records(self, tmp_path):
+        path = tmp_path / "rx.journal"
+        write(path, [(Frame(LAMP, 1000), 0), (Frame(LAMP + 3, 2000), 3)])
+        assert rf_journal.RECORD.size == 16
+        assert os.path.getsize(path) == rf_journal.HEADER.size + 2 * rf_journal.RECORD.size
+
+    def test_round_trip(self, tmp_path):
+        path = tmp_path / "rx.journal"
+        write(path, [(Frame(LAMP, 1000), 0), (Frame(12345, 2000, 161, 2), None)])
+        with rf_journal.Journal(str(path)) as journal:
+            assert len(journal) == 2
+            assert list(journal.records()) == [Record(1000, LAMP, 350, 1, 0),
+                                               Record(2000, 12345, 161, 2, None)]
+            assert journal.record(1).code == 12345
+
+    def test_wall_clock_timestamps(self, tmp_path):
+        path = tmp_path / "rx.journal"
+        journal = rf_journal.JournalWriter(str(path))
+        journal.append(Frame(LAMP, 0), 0)
+        journal.close()
+        with rf_journal.Journal(str(path)) as reader:
+            assert reader.record(0).timestamp == journal.wall_offset
+
+    def test_follows_wall_clock_step(self, tmp_path):
+        """Test records pick up the clock being set after the writer started."""
+        path = tmp_path / "rx.journal"
+        journal = writer(path)
+        journal.append(Frame(LAMP, 1000), 0)
+        journal.synced -= rf_journal.WALL_RESYNC
+        with patch('rf_journal.wall_offset', return_value=10 ** 15):
+            journal.append(Frame(LAMP, 2000), 0)
+        journal.close()
+        with rf_journal.Journal(str(path)) as reader:
+            assert [record.timestamp for record in reader.records()] == [1000, 10 ** 15 + 2000]
+
+    def test_clock_set_back(self, tmp_path):
+        """Test records stay sorted when the offset steps backwards, so bisect still works."""
+        path = tmp_path / "rx.journal"
+        journal = writer(path)
+        journal.append(Frame(LAMP, 5000), 0)
+        journal.synced -= rf_journal.WALL_RESYNC
+        with patch('rf_journal.wall_offset', return_value=-3000):
+            journal.append(Frame(LAMP, 6000), 0)
+            journal.append(Frame(LAMP, 9000), 0)
+        journal.close()
+        # A writer reopening the file doesn't go back past its last record either
+        write(path, [(Frame(LAMP, 1000), 0)])
+        with rf_journal.Journal(str(path)) as reader:
+            assert [record.timestamp for record in reader.records()] == [5000, 5000, 6000, 6000]
+        assert [record.timestamp for record in rf_journal.query(str(path), since=5500)] == \
+            [6000, 6000]
+
+    def test_appends_to_existing(self, tmp_path):
+        path = tmp_path / "rx.journal"
+        write(path, [(Frame(LAMP, 1000), 0)])
+        write(path, [(Frame(LAMP, 2000), 0)])
+        with rf_journal.Journal(str(path)) as journal:
+            assert [record.timestamp for record in journal.records()] == [1000, 2000]
+
+    def test_truncated_record_dropped(self, tmp_path):
+        path = tmp_path / "rx.journal"
+        write(path, [(Frame(LAMP, 1000), 0)])
+        with open(path, 'ab') as f:
+            f.write(b'\x01\x02\x03')
+        write(path, [(Frame(LAMP, 2000), 0)])
+        with rf_journal.Journal(str(path)) as journal:
+            assert [record.timestamp for record in journal.records()] == [1000, 2000]
+
+    def test_rotates_by_size(self, tmp_path):
+        path = tmp_path / "rx.journal"
+        max_bytes = rf_journal.HEADER.size + 3 * rf_journal.RECORD.size
+        write(path, [(Frame(LAMP, t), 0) for t in range(10)], max_bytes=max_bytes, backups=2)
+        files = rf_journal.journal_files(str(path))
+        assert files == [f"{path}.2", f"{path}.1", str(path)]
+        assert all(os.path.getsize(name) <= max_bytes for name in files)
+        # The oldest records rotated away; the rest are read back in order
+        timestamps = [record.timestamp for record in rf_journal.query(str(path))]
+        assert timestamps == list(range(3, 10))
+
+    def test_not_a_journal(self, tmp_path):
+        path = tmp_path / "other"
+        path.write_bytes(b'x' * 64)
+        with pytest.raises(ValueError):
+            rf_journal.Journal(str(path))
+
+
+class TestQuery:
+    """Test filtering and gap statistics."""
+
+    @pytest.fixture
+    def path(self, tmp_path):
+        path = tmp_path / "rx.journal"
+        frames = []
+        for i in range(100):
+            command = (0, 3, 7)[i % 3]
+            lamp = LAMP if i % 2 else 4513633
+            frames.append((Frame(lamp + command, i * 100000), command))
+        frames.append((Frame(99, 100 * 100000), None))
+        write(path, frames, max_bytes=rf_journal.HEADER.size + 30 * rf_journal.RECORD.size)
+        return str(path)
+
+    def test_everything(self, path):
+        assert len(list(rf_journal.query(path))) == 101
+
+    def test_by_lamp(self, path):
+        records = list(rf_journal.query(path, lamp=LAMP))
+        assert len(records) == 50
+        assert all(rf_journal.lamp_of(record) == LAMP for record in records)
+
+    def test_by_command(self, path):
+        records = list(rf_journal.query(path, command=3))
+        assert len(records) == 33
+        assert all(record.code - 3 in (LAMP, 4513633) for record in records)
+
+    def test_by_time_range(self, path):
+        records = list(rf_journal.query(path, since=2500000, until=4000000))
+        assert [record.timestamp for record in records] == list(range(2500000, 4000000, 100000))
+
+    def test_unknown_codes(self, path):
+        record = list(rf_journal.query(path))[-1]
+        assert record.command is None
+        assert rf_journal.lamp_of(record) is None
+
+    def test_bisect(self, tmp_path):
+        path = tmp_path / "rx.journal"
+        write(path, [(Frame(LAMP, t), 0) for t in (10, 20, 20, 30)])
+        with rf_journal.Journal(str(path)) as journal:
+            assert journal.bisect(0) == 0
+            assert journal.bisect(20) == 1
+            assert journal.bisect(25) == 3
+            assert journal.bisect(99) == 4
+
+    def test_gap_stats(self):
+        records = [Record(t, LAMP, 350, 1, 0) for t in (0, 100000, 400000, 1400000)]
+        stats = rf_journal.gap_stats(records)
+        assert stats == {'count': 3, 'min': 100000, 'median': 300000, 'p95': 1000000,
+                         'max': 1000000, 'duplicates': 1}
+        assert rf_journal.gap_stats(records[:1]) == {'count': 0}
+
+    def test_parse_time(self):
+        assert rf_journal.parse_time("1.5") == 1500000
+        assert rf_journal.parse_time("1970-01-01T00:00:01+00:00") == 1000000
@@ -0,0 +1,88 @@
+"""
+Tests for rf_trace.py
+
+Run with: pytest test_rf_trace.py -v
+"""
+
+import pytest
+
+np = pytest.importorskip("numpy")
+
+import rf_edges
+import rf_trace
+
+LAMP = 3513633
+
+
+def trace():
+    edges = rf_edges.code_edges(LAMP, repeat=4, start=1000)
+    levels = [(i + 1) % 2 for i in range(len(edges))]
+    return np.array(edges), np.array(levels)
+
+
+class TestLoadTrace:
+    """Test reading each trace format."""
+
+    def test_npz(self, tmp_path):
+        timestamps, levels = trace()
+        path = str(tmp_path / "trace.npz")
+        np.savez(path, timestamps=timestamps, levels=levels)
+        loaded, loaded_levels = rf_trace.load_trace(path)
+        assert np.array_equal(loaded, timestamps)
+        assert np.array_equal(loaded_levels, levels)
+
+    def test_npz_without_levels(self, tmp_path):
+        timestamps, _ = trace()
+        path = str(tmp_path / "trace.npz")
+        np.savez(path, timestamps=timestamps)
+        assert rf_trace.load_trace(path)[1] is None
+
+    def test_npy_pairs(self, tmp_path):
+        timestamps, levels = trace()
+        path = str(tmp_path / "trace.npy")
+        np.save(path, np.column_stack([timestamps, levels]))
+        loaded, loaded_levels = rf_trace.load_trace(path)
+        assert np.array_equal(loaded, timestamps)
+        assert np.array_equal(loaded_levels, levels)
+
+    def test_text(self, tmp_path):
+        timestamps, _ = trace()
+        path = tmp_path / "trace.txt"
+        path.write_text("\n".join(str(t) for t in timestamps))
+        loaded, levels = rf_trace.load_trace(str(path))
+        assert np.array_equal(loaded, timestamps)
+        assert levels is None
+
+    def test_csv(self, tmp_path):
+        timestamps, levels = trace()
+        path = tmp_path / "trace.csv"
+        path.write_text("\n".join(f"{t},{l}" for t, l in zip(timestamps, levels)))
+        loaded, loaded_levels = rf_trace.load_trace(str(path))
+        assert np.array_equal(loaded, timestamps)
+        assert np.array_equal(loaded_levels, levels)
+
+
+class TestAnalysis:
+    """Test the trace summaries."""
+
+    def test_pulse_widths_by_level(self):
+        timestamps, levels = trace()
+        high, low = rf_trace.pulse_widths(timestamps, levels, 350)
+        # Protocol 1 bits are 1+3 or 3+1 pulses; syncs are 1 high, 31 low
+        assert set(np.nonzero(high)[0]) == {1, 3}
+        assert set(np.nonzero(low)[0]) == {1, 3, 31}
+
+    def test_pulse_widths_without_levels(self):
+        timestamps, _ = trace()
+        counts, none = rf_trace.pulse_widths(timestamps, pulselength=350)
+        assert none is None
+        assert counts.sum() == len(timestamps) - 1
+
+    def test_protocol_stats(self):
+        frames = [rf_edges.Frame(LAMP, 1, 340, 1), rf_edges.Frame(LAMP, 2, 360, 1),
+                  rf_edges.Frame(LAMP, 3, 350, 1), rf_edges.Frame(LAMP, 4, 650, 2)]
+        assert rf_trace.protocol_stats(frames) == {1: (3, 350, 340, 360), 2: (1, 650, 650, 650)}
+
+    def test_format_frame(self):
+        frame = rf_edges.Frame(LAMP, 1234, 350, 1)
+        assert rf_trace.format_frame(frame) == "Code: 3513633 TS: 1234 Pulselength: 350 Protocol: 1"
@@ -0,0 +1,238 @@
+"""
+Tests for virtual_radio.py
+
+Run with: pytest test_virtual_radio.py -v
+"""
+
+import pytest
+
+import virtual_radio as vr
+
+LAMP = 3513633
+
+
+class Recorder:
+    """Receiver that keeps every frame it is handed."""
+
+    def __init__(self, medium):
+        self.frames = []
+        medium.attach(self)
+
+    def receive(self, frame):
+        self.frames.append(frame)
+
+
+def sim_medium(**kwargs):
+    return vr.RadioMedium(clock=vr.SimClock(), seed=1, **kwargs)
+
+
+class TestRadioMedium:
+    """Test delivery, loss, duplication, jitter and collisions."""
+
+    def test_decodes_once_per_two_repeats(self):
+        medium = sim_medium()
+        recorder = Recorder(medium)
+        tx = medium.transmit("remote", LAMP, tx_repeat=10)
+        medium.flush()
+        assert [frame.code for frame in recorder.frames] == [LAMP] * 5
+        # Decoded at the end of every second repeat
+        assert recorder.frames[0].timestamp == tx.start + 2 * tx.frame_time
+        assert recorder.frames[-1].timestamp == tx.end
+
+    def test_frames_stay_in_flight_until_sent(self):
+        medium = sim_medium()
+        recorder = Recorder(medium)
+        tx = medium.transmit("remote", LAMP, tx_repeat=2)
+        assert medium.deliver() == 0
+        medium.clock.advance_to(tx.end)
+        assert medium.deliver() == 1
+        assert recorder.frames[0].protocol == 1
+        assert recorder.frames[0].pulselength == 350
+
+    def test_reaches_every_receiver(self):
+        medium = sim_medium()
+        recorders = [Recorder(medium) for _ in range(3)]
+        medium.transmit("remote", LAMP, tx_repeat=2)
+        medium.flush()
+        assert all(len(recorder.frames) == 1 for recorder in recorders)
+        assert medium.delivered == 3
+
+    def test_overlapping_senders_collide(self):
+        medium = sim_medium()
+        recorder = Recorder(medium)
+        first = medium.transmit("remote", LAMP, tx_repeat=2, start=0)
+        second = medium.transmit("bridge", LAMP + 3, tx_repeat=2, start=first.end - 1)
+        third = medium.transmit("bridge", LAMP + 7, tx_repeat=2)
+        medium.flush()
+        assert first.collided and second.collided
+        # A sender queues behind its own transmission instead of colliding
+        assert third.start == second.end
+        assert not third.collided
+        assert [frame.code for frame in recorder.frames] == [LAMP + 7]
+        assert medium.collided == 2
+
+    def test_loss(self):
+        medium = sim_medium(loss=1.0)
+        recorder = Recorder(medium)
+        medium.transmit("remote", LAMP, tx_repeat=10)
+        medium.flush()
+        assert recorder.frames == []
+        assert medium.lost == 5
+
+    def test_duplication(self):
+        medium = sim_medium(duplication=1.0)
+        recorder = Recorder(medium)
+        medium.transmit("remote", LAMP, tx_repeat=2)
+        medium.flush()
+        assert len(recorder.frames) == 2
+        assert recorder.frames[1].timestamp > recorder.frames[0].timestamp
+        assert medium.duplicated == 1
+
+    def test_jitter_stays_in_bounds(self):
+        medium = sim_medium(jitter=500)
+        recorder = Recorder(medium)
+        tx = medium.transmit("remote", LAMP, tx_repeat=2)
+        medium.flush()
+        assert abs(recorder.frames[0].timestamp - tx.end) <= 500
+
+    def test_stats(self):
+        medium = sim_medium()
+        Recorder(medium)
+        medium.transmit("remote", LAMP, tx_repeat=4)
+        medium.flush()
+        assert medium.stats() == {'sent': 1, 'delivered': 2, 'lost': 0,
+                                  'duplicated': 0, 'collided': 0}
+
+
+class TestVirtualRFDevice:
+    """Test the RFDevice stand-in."""
+
+    def test_tx_reaches_rx(self):
+        medium = sim_medium()
+        tx = vr.VirtualRFDevice(4, medium, tx_repeat=2)
+        rx = vr.VirtualRFDevice(23, medium)
+        assert tx.enable_tx()
+        assert rx.enable_rx()
+        assert tx.tx_code(LAMP)
+        assert rx.rx_code == LAMP
+        assert rx.rx_proto == 1
+        assert rx.rx_code_timestamp == medium.clock()
+
+    def test_tx_advances_sim_clock_by_airtime(self):
+        medium = sim_medium()
+        tx = vr.VirtualRFDevice(4, medium, tx_repeat=2)
+        tx.enable_tx()
+        tx.tx_code(LAMP, tx_pulselength=200)
+        assert medium.clock() == 2 * vr.FRAME_PULSES * 200
+
+    def test_tx_needs_enable(self):
+        medium = sim_medium()
+        tx = vr.VirtualRFDevice(4, medium)
+        assert not tx.tx_code(LAMP)
+        assert medium.sent == 0
+
+    def test_same_node_not_heard(self):
+        medium = sim_medium()
+        tx = vr.VirtualRFDevice(4, medium, tx_repeat=2, node="bridge")
+        rx = vr.VirtualRFDevice(23, medium, node="bridge")
+        other = vr.VirtualRFDevice(23, medium, node="sniffer")
+        tx.enable_tx()
+        rx.enable_rx()
+        other.enable_rx()
+        tx.tx_code(LAMP)
+        assert rx.rx_code is None
+        assert other.rx_code == LAMP
+
+    def test_wrapped_rx_callback_sees_each_code(self):
+        medium = sim_medium()
+        rx = vr.VirtualRFDevice(23, medium)
+        seen = []
+        callback = rx.rx_callback
+
+        def wrapper(gpio):
+            callback(gpio)
+            seen.append(rx.rx_code)
+
+        rx.rx_callback = wrapper
+        rx.enable_rx()
+        vr.VirtualRemote(medium, tx_repeat=4).press(LAMP, vr.ON_OFF_OFFSET)
+        medium.flush()
+        assert seen == [LAMP, LAMP]
+
+    def test_cleanup_detaches(self):
+        medium = sim_medium()
+        rx = vr.VirtualRFDevice(23, medium)
+        rx.enable_rx()
+        rx.cleanup()
+        assert medium.receivers == []
+
+
+class TestSimulatedLamp:
+    """Test the Joofo step model."""
+
+    def press(self, medium, lamp, command, times=1):
+        remote = vr.VirtualRemote(medium, tx_repeat=2)
+        for _ in range(times):
+            remote.press(lamp.lamp_id, command)
+            medium.clock.advance(vr.TOGGLE_GAP)
+            medium.flush()
+
+    def test_on_off_toggles(self):
+        medium = sim_medium()
+        lamp = vr.SimulatedLamp(LAMP, medium)
+        self.press(medium, lamp, vr.ON_OFF_OFFSET)
+        assert lamp.on
+        self.press(medium, lamp, vr.ON_OFF_OFFSET)
+        assert not lamp.on
+
+    def test_held_toggle_is_one_press(self):
+        medium = sim_medium()
+        lamp = vr.SimulatedLamp(LAMP, medium)
+        vr.VirtualRemote(medium).press(LAMP, vr.ON_OFF_OFFSET)
+        medium.flush()
+        assert lamp.frames == 5
+        assert lamp.on
+
+    def test_brup_from_off_is_one_step_above_minimum(self):
+        medium = sim_medium()
+        lamp = vr.SimulatedLamp(LAMP, medium)
+        lamp.level = 20
+        self.press(medium, lamp, vr.BRIGHTNESS_UP_OFFSET)
+        assert lamp.on
+        assert lamp.level == 2
+        assert lamp.brightness == pytest.approx(1 + vr.HK_BR_MAX / vr.BR_LEVELS)
+
+    def test_brightness_limits(self):
+        medium = sim_medium()
+        lamp = vr.SimulatedLamp(LAMP, medium)
+        self.press(medium, lamp, vr.BRIGHTNESS_UP_OFFSET, vr.BR_LEVELS + 5)
+        assert lamp.level == vr.BR_LEVELS
+        assert lamp.brightness <= vr.HK_BR_MAX
+        self.press(medium, lamp, vr.BRIGHTNESS_DOWN_OFFSET, vr.BR_LEVELS + 5)
+        assert lamp.level == 1
+        assert lamp.on
+
+    def test_brdown_ignored_when_off(self):
+        medium = sim_medium()
+        lamp = vr.SimulatedLamp(LAMP, medium)
+        lamp.level = 10
+        self.press(medium, lamp, vr.BRIGHTNESS_DOWN_OFFSET)
+        assert lamp.level == 10
+        assert not lamp.on
+
+    def test_cct_cycles(self):
+        medium = sim_medium()
+        lamp = vr.SimulatedLamp(LAMP, medium)
+        self.press(medium, lamp, vr.ON_OFF_OFFSET)
+        self.press(medium, lamp, vr.CCT_OFFSET, vr.CCT_LEVELS)
+        assert lamp.color_temp == 0
+        self.press(medium, lamp, vr.CCT_OFFSET)
+        assert lamp.color_temp == 1
+
+    def test_other_lamps_ignored(self):
+        medium = sim_medium()
+        lamp = vr.SimulatedLamp(LAMP, medium)
+        vr.VirtualRemote(medium).press(LAMP + 1000, vr.ON_OFF_OFFSET)
+        medium.flush()
+        assert lamp.frames == 0
+        assert not lamp.on
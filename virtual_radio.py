@@ -0,0 +1,391 @@
+"""
+Virtual 433 MHz radio for running the bridge without hardware
+
+A RadioMedium stands in for the air between every transmitter and receiver
+in one process. Transmitted codes reach every attached receiver the way
+rpi_rf would decode them, with configurable loss, duplication and timestamp
+jitter; transmissions from different senders that overlap in time collide
+and nobody decodes either. VirtualRFDevice has the RFDevice interface, and
+SimulatedLamp follows the Joofo lamp's step model, so the bridge can be
+load-tested on an ordinary Linux machine.
+
+This module does not import the bridge, so the few lamp constants it needs
+are repeated here (the tests check they agree with lamp_control_mqtt).
+"""
+
+import random
+import threading
+import time
+from collections import deque, namedtuple
+
+# Joofo command offsets, added to the lamp's base code
+ON_OFF_OFFSET = 0
+CCT_OFFSET = 1
+BRIGHTNESS_UP_OFFSET = 3
+BRIGHTNESS_DOWN_OFFSET = 7
+
+BR_LEVELS = 36  # Number of brightness steps the lamp supports
+HK_BR_MAX = 100  # HomeKit brightness scale (0-100)
+CCT_LEVELS = 3  # Color temperatures the CCT button cycles through
+
+DEFAULT_PROTOCOL = 1
+# rpi_rf's base pulselength for each protocol (microseconds)
+PROTOCOL_PULSELENGTHS = {1: 350, 2: 650, 3: 100, 4: 380, 5: 500, 6: 200}
+# Protocol 1 frame: 24 bits of 4 pulses each, plus a 1+31 pulse sync
+FRAME_PULSES = 24 * 4 + 32
+DEFAULT_TX_REPEAT = 10  # rpi_rf's default, and roughly what a remote sends
+# A lamp ignores repeats of a toggle within this many microseconds
+TOGGLE_GAP = 200000
+
+# A code as rpi_rf hands it over after decoding
+Frame = namedtuple('Frame', ['code', 'timestamp', 'pulselength', 'protocol'])
+
+
+def perf_clock():
+    """Microseconds on the same clock rpi_rf timestamps codes with."""
+    return time.perf_counter() * 1e6
+
+
+class SimClock:
+    """Clock in microseconds that only moves when told to.
+
+    Lets a simulation run as fast as the CPU allows: devices on a medium
+    with a SimClock advance it instead of sleeping for the frame airtime.
+    """
+
+    def __init__(self, now=0):
+        self.now = now
+        self.lock = threading.Lock()
+
+    def __call__(self):
+        return self.now
+
+    def advance(self, us):
+        with self.lock:
+            self.now += us
+            return self.now
+
+    def advance_to(self, until):
+        with self.lock:
+            self.now = max(self.now, until)
+            return self.now
+
+
+def frame_airtime(pulselength=None, protocol=DEFAULT_PROTOCOL):
+    """Microseconds one repeat of a code takes on air."""
+    if not pulselength:
+        pulselength = PROTOCOL_PULSELENGTHS.get(protocol, PROTOCOL_PULSELENGTHS[DEFAULT_PROTOCOL])
+    return FRAME_PULSES * pulselength
+
+
+class Transmission:
+    """A code on air from start to end (microseconds)."""
+
+    def __init__(self, sender, code, protocol, pulselength, tx_repeat, start):
+        self.sender = sender
+        self.code = code
+        self.protocol = protocol
+        self.pulselength = pulselength
+        self.tx_repeat = tx_repeat
+        self.frame_time = frame_airtime(pulselength, protocol)
+        self.start = start
+        self.end = start + self.frame_time * tx_repeat
+        self.collided = False
+
+    def overlaps(self, other):
+        return self.start < other.end and other.start < self.end
+
+
+class RadioMedium:
+    """The shared air between virtual transmitters and receivers.
+
+    Transmissions stay in flight until their last repeat has been sent;
+    deliver() then hands each receiver the codes it decodes. rpi_rf decodes
+    a code once for every two repeats it hears, so a remote sending ten
+    repeats arrives five times, just as on real hardware.
+    """
+
+    def __init__(self, loss=0.0, duplication=0.0, jitter=0, clock=None, seed=None):
+        """
+        Args:
+            loss: Probability that a receiver misses a decode
+            duplication: Probability that a receiver decodes a code twice
+            jitter: Maximum timestamp error in microseconds, either way
+            clock: Callable returning microseconds (Default: perf_clock)
+            seed: Seed for the loss/duplication/jitter random numbers
+        """
+        self.loss = loss
+        self.duplication = duplication
+        self.jitter = jitter
+        self.clock = clock or perf_clock
+        self.random = random.Random(seed)
+        self.receivers = []
+        self.in_flight = []
+        # End of each sender's last transmission; a sender can't overlap itself
+        self.busy = {}
+        self.lock = threading.RLock()
+        self.sent = 0
+        self.delivered = 0
+        self.lost = 0
+        self.duplicated = 0
+        self.collided = 0
+
+    def attach(self, receiver):
+        """Start delivering decoded codes to receiver.receive(frame)."""
+        with self.lock:
+            if receiver not in self.receivers:
+                self.receivers.append(receiver)
+
+    def detach(self, receiver):
+        with self.lock:
+            if receiver in self.receivers:
+                self.receivers.remove(receiver)
+
+    def transmit(self, sender, code, protocol=DEFAULT_PROTOCOL, pulselength=None,
+                 tx_repeat=DEFAULT_TX_REPEAT, start=None):
+        """Put code on air.
+
+        Args:
+            sender: Any object identifying the transmitter
+            start: Microseconds the transmission starts (Default: now, or
+                when the sender's previous transmission ends)
+
+        Returns:
+            The Transmission
+        """
+        with self.lock:
+            if start is None:
+                start = self.clock()
+            start = max(start, self.busy.get(sender, start))
+            tx = Transmission(sender, int(code), protocol or DEFAULT_PROTOCOL,
+                              pulselength, tx_repeat, start)
+            for other in self.in_flight:
+                if other.sender is not sender and other.overlaps(tx):
+                    other.collided = True
+                    tx.collided = True
+            self.in_flight.append(tx)
+            self.busy[sender] = tx.end
+            self.sent += 1
+            return tx
+
+    def wait(self, until):
+        """Block the caller until the clock reaches until."""
+        if hasattr(self.clock, 'advance_to'):
+            self.clock.advance_to(until)
+            return
+        remaining = (until - self.clock()) / 1e6
+        if remaining > 0:
+            time.sleep(remaining)
+
+    def deliver(self, until=None):
+        """Hand receivers every code whose transmission ended by until.
+
+        Returns:
+            Number of frames delivered
+        """
+        with self.lock:
+            if until is None:
+                until = self.clock()
+            done = [tx for tx in self.in_flight if tx.end <= until]
+            if not done:
+                return 0
+            self.in_flight = [tx for tx in self.in_flight if tx.end > until]
+            events = []
+            for tx in done:
+                if tx.collided:
+                    self.collided += 1
+                    continue
+                events.extend(self._decodes(tx))
+            events.sort(key=lambda event: event[1].timestamp)
+            for receiver, frame in events:
+                receiver.receive(frame)
+            self.delivered += len(events)
+            return len(events)
+
+    def flush(self):
+        """Deliver everything still in flight."""
+        return self.deliver(float('inf'))
+
+    def _decodes(self, tx):
+        pulselength = tx.pulselength or PROTOCOL_PULSELENGTHS.get(tx.protocol)
+        node = getattr(tx.sender, 'node', None)
+        for receiver in self.receivers:
+            if node is not None and getattr(receiver, 'node', None) == node:
+                continue
+            for i in range(max(1, tx.tx_repeat // 2)):
+                if self.random.random() < self.loss:
+                    self.lost += 1
+                    continue
+                # Decoded at the sync that ends every second repeat
+                timestamp = tx.start + (2 * i + 2) * tx.frame_time
+                if self.jitter:
+                    timestamp += self.random.uniform(-self.jitter, self.jitter)
+                yield receiver, Frame(tx.code, int(timestamp), pulselength, tx.protocol)
+                if self.random.random() < self.duplication:
+                    self.duplicated += 1
+                    yield receiver, Frame(tx.code, int(timestamp + 2 * tx.frame_time),
+                                          pulselength, tx.protocol)
+
+    def stats(self):
+        return {
+            'sent': self.sent,
+            'delivered': self.delivered,
+            'lost': self.lost,
+            'duplicated': self.duplicated,
+            'collided': self.collided,
+        }
+
+
+class VirtualRFDevice:
+    """Drop-in for rpi_rf.RFDevice that sends and receives on a RadioMedium.
+
+    Devices with the same node (e.g. the TX and RX pins of one bridge) don't
+    hear each other's transmissions.
+    """
+
+    def __init__(self, gpio, medium, tx_proto=DEFAULT_PROTOCOL, tx_pulselength=None,
+                 tx_repeat=DEFAULT_TX_REPEAT, tx_length=24, rx_tolerance=80, node=None):
+        self.gpio = gpio
+        self.medium = medium
+        self.node = node
+        self.tx_enabled = False
+        self.tx_proto = tx_proto
+        self.tx_pulselength = tx_pulselength
+        self.tx_repeat = tx_repeat
+        self.tx_length = tx_length
+        self.rx_enabled = False
+        self.rx_tolerance = rx_tolerance
+        self.rx_code = None
+        self.rx_code_timestamp = None
+        self.rx_proto = None
+        self.rx_bitlength = None
+        self.rx_pulselength = None
+        self._incoming = deque()
+
+    def cleanup(self):
+        if self.tx_enabled:
+            self.disable_tx()
+        if self.rx_enabled:
+            self.disable_rx()
+
+    def enable_tx(self):
+        if self.rx_enabled:
+            return False
+        self.tx_enabled = True
+        return True
+
+    def disable_tx(self):
+        self.tx_enabled = False
+        return True
+
+    def tx_code(self, code, tx_proto=None, tx_pulselength=None, tx_length=None):
+        """Send code, returning once its last repeat is on air."""
+        if not self.tx_enabled:
+            return False
+        tx = self.medium.transmit(self, code, tx_proto or self.tx_proto,
+                                  tx_pulselength or self.tx_pulselength, self.tx_repeat)
+        self.medium.wait(tx.end)
+        self.medium.deliver()
+        return True
+
+    def enable_rx(self):
+        if self.tx_enabled:
+            return False
+        self.rx_enabled = True
+        self.medium.attach(self)
+        return True
+
+    def disable_rx(self):
+        self.medium.detach(self)
+        self.rx_enabled = False
+        return True
+
+    def receive(self, frame):
+        self._incoming.append(frame)
+        self.rx_callback(self.gpio)
+
+    def rx_callback(self, gpio):
+        """Latch the next decoded code, as rpi_rf does at the end of a frame."""
+        if not self._incoming:
+            return
+        frame = self._incoming.popleft()
+        self.rx_code = frame.code
+        self.rx_code_timestamp = frame.timestamp
+        self.rx_bitlength = self.tx_length
+        self.rx_pulselength = frame.pulselength
+        self.rx_proto = frame.protocol
+
+
+class SimulatedLamp:
+    """A Joofo lamp listening on a RadioMedium.
+
+    Follows the lamp's step model: levels brightness steps, BRUP on a
+    lamp that is off turns it on one step above the minimum, BRDOWN never
+    goes below the minimum or turns the lamp off, and the CCT button cycles
+    the color temperature. Repeats of a toggle within TOGGLE_GAP count as
+    one press; every decoded brightness code is a step. The lamp also acts
+    on the codes of any groups it is paired with.
+    """
+
+    def __init__(self, lamp_id, medium=None, groups=(), levels=BR_LEVELS):
+        self.lamp_id = lamp_id
+        # Base IDs this lamp acts on: its own, then its groups'
+        self.bases = (lamp_id,) + tuple(groups)
+        self.levels = levels
+        self.on = False
+        # 1..levels; remembered while the lamp is off
+        self.level = 1
+        self.color_temp = 0
+        self.frames = 0
+        self.last_toggle = {}
+        if medium is not None:
+            medium.attach(self)
+
+    @property
+    def brightness(self):
+        """Brightness on the HomeKit scale, as the bridge models it."""
+        return min(1 + (self.level - 1) * HK_BR_MAX / self.levels, HK_BR_MAX)
+
+    @property
+    def light(self):
+        """What a light sensor next to the lamp reads: the level, or 0 when off."""
+        return self.level if self.on else 0
+
+    def receive(self, frame):
+        for base in self.bases:
+            command = frame.code - base
+            if command in (ON_OFF_OFFSET, CCT_OFFSET, BRIGHTNESS_UP_OFFSET, BRIGHTNESS_DOWN_OFFSET):
+                break
+        else:
+            return
+        self.frames += 1
+        if command in (ON_OFF_OFFSET, CCT_OFFSET):
+            last = self.last_toggle.get(command)
+            self.last_toggle[command] = frame.timestamp
+            if last is not None and frame.timestamp - last < TOGGLE_GAP:
+                return
+        if command == ON_OFF_OFFSET:
+            self.on = not self.on
+        elif command == CCT_OFFSET:
+            if self.on:
+                self.color_temp = (self.color_temp + 1) % CCT_LEVELS
+        elif command == BRIGHTNESS_UP_OFFSET:
+            if not self.on:
+                self.on = True
+                self.level = 2
+            else:
+                self.level = min(self.level + 1, self.levels)
+        elif self.on:
+            self.level = max(self.level - 1, 1)
+
+
+class VirtualRemote:
+    """A lamp's handheld remote on a RadioMedium."""
+
+    def __init__(self, medium, tx_repeat=DEFAULT_TX_REPEAT):
+        self.medium = medium
+        self.tx_repeat = tx_repeat
+
+    def press(self, lamp_id, command, start=None):
+        """Send one button press; returns its Transmission."""
+        return self.medium.transmit(self, lamp_id + command, tx_repeat=self.tx_repeat, start=start)